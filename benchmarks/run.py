@@ -0,0 +1,465 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import warnings
+import resource
+import sqlite3
+import platform
+import subprocess
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from .synthetic import generate_study, mark_converted
+from .stubs import StubSpeechClient, StubGentleServer
+
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# (participants, items per participant)
+SCALES = {
+    'small': (2, 10),
+    'medium': (10, 40),
+    'large': (40, 72)}
+
+STAGES = ('convert', 'transcribe', 'extract', 'align', 'timing', 'noop',
+          'startup', 'workers')
+
+# Stages whose cost doesn't depend on the size of the study, which are only
+# run once
+UNSCALED = ('startup',)
+
+# Arguments that make each console script print its help and exit
+CLIS = {
+    'to_mp3': ('aligner.mp3', ['--help']),
+    'transcribe': ('aligner.stt', ['--help']),
+    'extract': ('aligner.transcriptions', ['--help']),
+    'align': ('aligner.aligner', ['--help']),
+    'aligner': ('aligner.pipeline', ['run', '--help'])}
+
+# Short enough that the units of the worker that's killed in the workers
+# benchmark are reclaimed quickly
+LEASE_SECONDS = 2
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 ** 2 if platform.system() == 'Darwin' else 1024)
+
+
+def unavailable(stage):
+    # Returns why a stage can't be benchmarked here, if it can't
+    if stage in ('convert', 'transcribe') and shutil.which('ffmpeg') is None:
+        return 'ffmpeg is not installed'
+    if stage == 'transcribe' and \
+            importlib.util.find_spec('google.cloud.speech') is None:
+        return 'google-cloud-speech is not installed'
+    return None
+
+
+def _cli(module, args, **kwargs):
+    # Runs a console script in a fresh interpreter, so that the time it
+    # takes includes starting up and importing everything it needs
+    return subprocess.run(
+        [sys.executable, '-c', f'from {module} import main; main()'] + args,
+        stdout=subprocess.DEVNULL, check=True, **kwargs)
+
+
+def _aligner_command(args, options):
+    # Runs one of aligner's subcommands in a fresh interpreter, like _cli,
+    # but with the Speech-to-Text stand-in in place of Google's client
+    return [sys.executable, '-c',
+            'from benchmarks.stubs import install_stub_speech; '
+            f'install_stub_speech({options["stt_latency"]!r}); '
+            'from aligner.pipeline import main; main()'] + args
+
+
+def _setup(stage, data_dir, participants, items, seed):
+    if stage == 'startup':
+        return {'items': len(CLIS)}
+    if stage == 'workers':
+        # The workers and the single-process run that their results are
+        # checked against each get their own copy of the same study
+        study = generate_study(data_dir, participants, items, seed,
+                               transcriptions=False)
+        reference = os.path.join(data_dir, 'reference')
+        study['reference'] = generate_study(
+            reference, participants, items, seed, transcriptions=False)
+        mark_converted(data_dir, study['tidy_csv'])
+        mark_converted(reference, study['reference']['tidy_csv'])
+        return study
+    return generate_study(
+        data_dir, participants, items, seed,
+        webm=stage == 'convert',
+        mp3=stage in ('transcribe', 'align', 'timing', 'noop'),
+        transcriptions=stage in ('align', 'timing', 'noop'))
+
+
+def run_benchmark(stage, participants, items, options):
+    # Runs in a fresh process, so that the peak memory use it reports is
+    # that of this benchmark alone
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore', module='pydub')
+    data_dir = tempfile.mkdtemp(prefix='aligner-bench-')
+    try:
+        study = _setup(stage, data_dir, participants, items,
+                       options['seed'])
+        run = _prepare(stage, data_dir, study, options)
+        rss_before = _peak_rss_mb()
+        start = time.perf_counter()
+        extra = run()
+        seconds = time.perf_counter() - start
+        peak = _peak_rss_mb()
+        return dict({
+            'stage': stage, 'participants': participants, 'items':
+            study['items'], 'seconds': seconds,
+            'items_per_second': study['items'] / seconds,
+            'peak_rss_mb': peak,
+            'peak_rss_delta_mb': peak - rss_before,
+            'children_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN)},
+            **(extra or {}))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _prepare(stage, data_dir, study, options):
+    # Does everything the stage needs that shouldn't be timed and returns
+    # a function that runs the stage itself
+    if stage == 'convert':
+        from aligner.mp3 import WebmToMp3Converter
+        converter = WebmToMp3Converter(
+            study['tidy_csv'], os.path.join(data_dir, 'mp3_files'),
+            os.path.join(data_dir, 'zip_archives'), True, options['jobs'])
+        return converter.convert_to_mp3
+
+    if stage == 'transcribe':
+        from aligner.stt import SpeechToText
+        csv = os.path.join(data_dir, 'ibex_results', 'to_transcribe.csv')
+        df = pd.read_csv(study['tidy_csv'])
+        df['Transcription'] = pd.NA
+        df.to_csv(csv, na_rep='NA', index=False)
+        transcriber = SpeechToText(
+            'mp3_files', data_dir, csv, 'Transcription', 50,
+            concurrency=options['concurrency'],
+            client=StubSpeechClient(options['stt_latency']))
+        return transcriber.transcribe
+
+    if stage == 'startup':
+        def run():
+            for module, args in CLIS.values():
+                _cli(module, args)
+        return run
+
+    if stage == 'extract':
+        from aligner.transcriptions import TranscriptionExtractor
+        extractor = TranscriptionExtractor(
+            study['transcribed_csv'], 'Transcription', data_dir, True,
+            jobs=options['jobs'])
+        return extractor.get_transcriptions
+
+    if stage == 'workers':
+        return _prepare_workers(data_dir, study, options)
+
+    from aligner.aligner import Aligner
+    from aligner.gentle import GentleClient
+    server = StubGentleServer(options['gentle_latency']).__enter__()
+    aligner = Aligner(
+        study['transcribed_csv'], data_dir, 'mp3_files', 'transcriptions',
+        'gentle_align', gentle=GentleClient(server.url),
+        concurrency=options['concurrency'])
+
+    if stage == 'align':
+        def run():
+            try:
+                aligner.align()
+            finally:
+                server.__exit__()
+        return run
+
+    aligner.align()
+    if stage == 'noop':
+        # Everything is already aligned and extracted, so this times
+        # starting align up and finding out that there's nothing to do
+        aligner.get_timing_info(options['jobs'])
+
+        def run():
+            try:
+                _cli('aligner.aligner',
+                     ['--file', study['transcribed_csv'], '--data-dir',
+                      data_dir, '--gentle-url', server.url, '--jobs',
+                      str(options['jobs']), '--log', 'critical'],
+                     stderr=subprocess.DEVNULL)
+            finally:
+                server.__exit__()
+        return run
+
+    server.__exit__()
+    return lambda: aligner.get_timing_info(options['jobs'], False)
+
+
+def _prepare_workers(data_dir, study, options):
+    # Times aligner enqueue followed by several aligner worker processes
+    # working through the queue, one of which is killed while it holds a
+    # lease, and checks that every unit still gets done and that the .csv
+    # file comes out the same as from a single aligner run
+    server = StubGentleServer(options['gentle_latency']).__enter__()
+    reference = study['reference']
+    try:
+        subprocess.run(_aligner_command(
+            ['run', '-f', reference['transcribed_csv'], '-d',
+             os.path.join(data_dir, 'reference'), '--gentle-url', server.url,
+             '--log', 'critical'], options),
+            stdout=subprocess.DEVNULL, check=True)
+    except BaseException:
+        server.__exit__()
+        raise
+
+    state = os.path.join(data_dir, 'state.db')
+    args = ['-f', study['transcribed_csv'], '-d', data_dir, '--gentle-url',
+            server.url, '--log', 'critical']
+
+    def run():
+        try:
+            subprocess.run(_aligner_command(
+                ['enqueue', '--state', state, '-f', study['transcribed_csv'],
+                 '--log', 'critical'], options),
+                stdout=subprocess.DEVNULL, check=True)
+            workers = [
+                subprocess.Popen(_aligner_command(
+                    ['worker', '--state', state, '--name', f'bench-{n}',
+                     '--threads', str(options['concurrency']), '--lease',
+                     str(LEASE_SECONDS), '--poll', '0.1'] + args, options),
+                    stdout=subprocess.DEVNULL)
+                for n in range(options['workers'])]
+            killed = False
+            if len(workers) > 1:
+                killed = _kill_when_leased(workers[0], state, 'bench-0')
+            for worker in workers[1:] if killed else workers:
+                if worker.wait() != 0:
+                    raise RuntimeError(
+                        f'A worker exited with code {worker.returncode}')
+        finally:
+            server.__exit__()
+        return dict(_check_workers(
+            state, study['transcribed_csv'], reference['transcribed_csv']),
+            killed=killed)
+    return run
+
+
+def _kill_when_leased(process, state, name):
+    # Kills the worker as soon as it holds a lease on something, the way a
+    # machine going down would, and returns whether it got the chance
+    connection = sqlite3.connect(state)
+    try:
+        while process.poll() is None:
+            leased = connection.execute(
+                "SELECT COUNT(*) FROM queue WHERE owner = ? AND status = "
+                "'leased'", (name,)).fetchone()[0]
+            if leased:
+                process.kill()
+                process.wait()
+                return True
+            time.sleep(0.01)
+    finally:
+        connection.close()
+    return False
+
+
+def _check_workers(state, csv, reference_csv):
+    connection = sqlite3.connect(state)
+    try:
+        statuses = dict(connection.execute(
+            'SELECT status, COUNT(*) FROM queue GROUP BY status').fetchall())
+        reclaimed = connection.execute(
+            'SELECT COUNT(*) FROM queue WHERE attempts > 1').fetchone()[0]
+    finally:
+        connection.close()
+    if set(statuses) != {'done'}:
+        raise RuntimeError(f'Not every unit in the queue is done: {statuses}')
+    with open(csv, 'rb') as a, open(reference_csv, 'rb') as b:
+        if a.read() != b.read():
+            raise RuntimeError(
+                f'{csv} differs from what a single aligner run wrote')
+    return {'reclaimed': reclaimed}
+
+
+def compare(results, baselines, tolerance):
+    # Flags benchmarks whose throughput has dropped, or whose peak memory
+    # use has grown, by more than the tolerance since the baseline
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None or baseline.get('options') != result['options']:
+            # Results from runs with different latencies or worker counts
+            # aren't comparable
+            continue
+        if result['items_per_second'] < \
+                baseline['items_per_second'] * (1 - tolerance):
+            regressions.append(
+                f'{key}: {result["items_per_second"]:.1f} items/s, down from '
+                f'{baseline["items_per_second"]:.1f}')
+        if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(
+                f'{key}: peak memory {result["peak_rss_mb"]:.0f} MB, up from '
+                f'{baseline["peak_rss_mb"]:.0f} MB')
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks each stage of the aligner package on '
+        'synthetic studies, with local stand-ins for Google\'s '
+        'Speech-to-Text API and the gentle forced aligner, and compares the '
+        'results with stored baselines.')
+
+    parser.add_argument(
+        '--stages', type=str, nargs='+', default=list(STAGES),
+        choices=STAGES,
+        help='Stages to benchmark (default is all of them).',
+        dest='stages')
+
+    parser.add_argument(
+        '--scales', type=str, nargs='+', default=['small', 'medium'],
+        choices=list(SCALES),
+        help='Study sizes to benchmark at (default is small and medium). '
+        'small is 2 participants with 10 items each, medium is 10 with 40 '
+        'and large is 40 with 72.',
+        dest='scales')
+
+    parser.add_argument(
+        '--stt-latency', type=float, default=0.2,
+        help='Seconds the Speech-to-Text stand-in takes to answer a request '
+        '(default is 0.2).',
+        dest='stt_latency')
+
+    parser.add_argument(
+        '--gentle-latency', type=float, default=0.2,
+        help='Seconds the gentle stand-in takes to answer a request (default'
+        ' is 0.2).',
+        dest='gentle_latency')
+
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='Number of requests to have in flight to each service at once '
+        '(default is 4).',
+        dest='concurrency')
+
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of worker processes for converting and for reading the '
+        'timing information (default is 1).',
+        dest='jobs')
+
+    parser.add_argument(
+        '--workers', type=int, default=3,
+        help='Number of aligner worker processes in the workers benchmark '
+        '(default is 3). The first is killed while it holds a lease.',
+        dest='workers')
+
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for generating the synthetic studies (default is 0).',
+        dest='seed')
+
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Number of times to run each benchmark, keeping the fastest run'
+        ' (default is 1).',
+        dest='repeat')
+
+    parser.add_argument(
+        '--baseline', type=str, default=BASELINES,
+        help='Path to the baselines file (default is '
+        'benchmarks/baselines.json).',
+        dest='baseline')
+
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='Stores these results as the new baselines instead of comparing'
+        ' against the old ones.',
+        dest='save_baseline')
+
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Fraction by which throughput may drop, or peak memory use may '
+        'grow, before a benchmark is flagged as a regression (default is '
+        '0.2).',
+        dest='tolerance')
+
+    parser.add_argument(
+        '--output', '-o', type=str, default=None,
+        help='Path to which to write the results as JSON.',
+        dest='output')
+
+    args = parser.parse_args()
+
+    options = {'stt_latency': args.stt_latency,
+               'gentle_latency': args.gentle_latency,
+               'concurrency': args.concurrency, 'jobs': args.jobs,
+               'workers': args.workers, 'seed': args.seed}
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for scale in args.scales:
+        participants, items = SCALES[scale]
+        for stage in args.stages:
+            key = stage if stage in UNSCALED else f'{stage}/{scale}'
+            if key in results:
+                continue
+            reason = unavailable(stage)
+            if reason is not None:
+                print(f'{key:<22} skipped: {reason}')
+                continue
+            # The fastest of several runs is the least affected by whatever
+            # else the machine was doing at the time
+            result = None
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    run = executor.submit(
+                        run_benchmark, stage, participants, items,
+                        options).result()
+                if result is None or run['seconds'] < result['seconds']:
+                    result = run
+            result['options'] = options
+            results[key] = result
+            print(f'{key:<22} {result["items"]:>6} items '
+                  f'{result["seconds"]:>8.2f} s '
+                  f'{result["items_per_second"]:>9.1f} items/s '
+                  f'{result["peak_rss_mb"]:>7.0f} MB peak')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Saved baselines to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baselines to compare against. Run with --save-baseline to '
+              'store some.')
+        return
+    with open(args.baseline, 'r') as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import json
+import time
+import threading
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubSpeechClient:
+    # Stands in for google.cloud.speech.SpeechClient: waits for the given
+    # latency and answers every request with the same transcript
+    def __init__(self, latency=0.0, transcript='synthetic transcript'):
+        self.latency = latency
+        self.transcript = transcript
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def recognize(self, config, audio):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        alternative = SimpleNamespace(transcript=self.transcript)
+        return SimpleNamespace(
+            results=[SimpleNamespace(alternatives=[alternative])])
+
+
+class _StubRecognitionConfig:
+    AudioEncoding = SimpleNamespace(FLAC=1)
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def install_stub_speech(latency=0.0):
+    # Puts stand-ins for Google's Speech-to-Text client library in place in
+    # aligner.stt, for console scripts that are run in a fresh interpreter
+    # (with or without google-cloud-speech installed)
+    import aligner.stt
+    aligner.stt.speech = SimpleNamespace(
+        SpeechClient=lambda: StubSpeechClient(latency),
+        RecognitionAudio=lambda content: SimpleNamespace(content=content),
+        RecognitionConfig=_StubRecognitionConfig)
+
+
+def _alignment(transcript):
+    # A plausible gentle result: every word aligned one after another, with
+    # a phone per letter
+    words = []
+    start = 0.25
+    offset = 0
+    for word in transcript.split():
+        offset = transcript.index(word, offset)
+        duration = 0.06 * len(word)
+        words.append({
+            'case': 'success', 'word': word, 'alignedWord': word.lower(),
+            'start': round(start, 3), 'end': round(start + duration, 3),
+            'startOffset': offset, 'endOffset': offset + len(word),
+            'phones': [{'phone': c + '_I', 'duration': 0.06}
+                       for c in word.lower()]})
+        start += duration + 0.05
+        offset += len(word)
+    return {'transcript': transcript, 'words': words}
+
+
+class StubGentleServer:
+    # Stands in for gentle's HTTP API on a local port. Each request waits
+    # for the given latency before it's answered, like a real aligner
+    # would while it works.
+    def __init__(self, latency=0.0):
+        latency_ = latency
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._reply(b'')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with server.lock:
+                    server.requests += 1
+                time.sleep(latency_)
+                transcript = _transcript(self.headers['Content-Type'], body)
+                self._reply(json.dumps(_alignment(transcript)).encode())
+
+            def _reply(self, body):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _transcript(content_type, body):
+    # Pulls the transcript part out of a multipart/form-data request body
+    boundary = content_type.split('boundary=')[1].encode()
+    for part in body.split(b'--' + boundary):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        if b'name="transcript"' in headers:
+            return content.rstrip(b'\r\n').decode('utf-8')
+    return ''
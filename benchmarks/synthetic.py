@@ -0,0 +1,135 @@
+import os
+import shutil
+import subprocess
+from zipfile import ZipFile
+import numpy as np
+import pandas as pd
+
+
+VOCABULARY = (
+    'which book did you order for the chicken why give a snack to penguin '
+    'and zookeeper what bring rooster walrus square circle triangle star '
+    'who send letter teacher farmer near under behind').split()
+
+# A frame of MPEG-1 Layer III audio at 128 kbps and 44.1 kHz is 417 bytes
+# and holds 1152 samples
+_MP3_HEADER = bytes([0xff, 0xfb, 0x90, 0x44])
+_MP3_FRAME_BYTES = 417
+_MP3_FRAME_SECONDS = 1152 / 44100
+
+
+def write_silent_mp3(path, seconds):
+    # Writes a constant-bitrate .mp3 file of the given length without an
+    # encoder, so that the alignment benchmarks don't depend on ffmpeg
+    frame = _MP3_HEADER + bytes(_MP3_FRAME_BYTES - len(_MP3_HEADER))
+    with open(path, 'wb') as f:
+        f.write(frame * max(1, int(seconds / _MP3_FRAME_SECONDS)))
+
+
+def write_webm(path, seconds, frequency):
+    subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi',
+         '-i', f'sine=frequency={frequency}:duration={seconds:.3f}',
+         '-c:a', 'libopus', '-f', 'webm', path],
+        check=True)
+
+
+def generate_study(data_dir, participants, items, seed=0, webm=False,
+                   mp3=True, transcriptions=True):
+    # Lays out a study like the example one in data/: a tidy .csv file (and
+    # a copy with a Transcription column), a zip archive of .webm
+    # recordings per participant and, so that each stage can be
+    # benchmarked on its own, the .mp3 files and transcription files that
+    # the earlier stages would have produced
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'ibex_results'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'zip_archives'), exist_ok=True)
+
+    rows = []
+    for p in range(1, participants + 1):
+        archive = f'participant-{p:04}.zip'
+        for i in range(1, items + 1):
+            n_words = int(rng.integers(3, 13))
+            sentence = ' '.join(rng.choice(VOCABULARY, n_words))
+            rows.append({
+                'Participant': p,
+                'ItemNumber': i,
+                'Sentence': sentence.capitalize() + '?',
+                'SecondsToStripFromFrontOfRecording': round(
+                    float(rng.uniform(0.5, 2.0)), 3),
+                'RecordingSeconds': round(float(rng.uniform(3.0, 6.0)), 3),
+                'WebmFileName': f'recorder-{i}.webm',
+                'RecordingsArchive': archive})
+    df = pd.DataFrame(rows)
+
+    tidy_csv = os.path.join(data_dir, 'ibex_results', 'tidy.csv')
+    df.drop(columns='RecordingSeconds').to_csv(tidy_csv, index=False)
+    transcribed = df.drop(columns='RecordingSeconds')
+    transcribed['Transcription'] = transcribed['Sentence']
+    transcribed_csv = os.path.join(
+        data_dir, 'ibex_results', 'tidy_transcribed.csv')
+    transcribed.to_csv(transcribed_csv, index=False)
+
+    scratch = os.path.join(data_dir, '.scratch')
+    for p, grp_df in df.groupby('Participant'):
+        if webm:
+            os.makedirs(scratch, exist_ok=True)
+            archive = os.path.join(
+                data_dir, 'zip_archives', grp_df['RecordingsArchive'].iloc[0])
+            with ZipFile(archive, 'w') as z:
+                for _, row in grp_df.iterrows():
+                    webm_file = os.path.join(scratch, row['WebmFileName'])
+                    write_webm(webm_file, row['RecordingSeconds'],
+                               220 + 20 * row['ItemNumber'])
+                    z.write(webm_file, row['WebmFileName'])
+
+        if mp3:
+            mp3_dir = os.path.join(data_dir, 'mp3_files', str(p))
+            os.makedirs(mp3_dir, exist_ok=True)
+            for _, row in grp_df.iterrows():
+                write_silent_mp3(
+                    os.path.join(
+                        mp3_dir, f'item_number_{row["ItemNumber"]:02}.mp3'),
+                    row['RecordingSeconds'] -
+                    row['SecondsToStripFromFrontOfRecording'] - 0.5)
+
+        if transcriptions:
+            transcriptions_dir = os.path.join(
+                data_dir, 'transcriptions', str(p))
+            os.makedirs(transcriptions_dir, exist_ok=True)
+            for _, row in grp_df.iterrows():
+                with open(os.path.join(
+                        transcriptions_dir,
+                        f'{row["ItemNumber"]:02}.txt'), 'w') as f:
+                    f.write(row['Sentence'] + '\n')
+
+    shutil.rmtree(scratch, ignore_errors=True)
+    return {'tidy_csv': tidy_csv, 'transcribed_csv': transcribed_csv,
+            'items': len(df)}
+
+
+def mark_converted(data_dir, tidy_csv):
+    # Makes the .mp3 files that generate_study wrote look as if they had
+    # been converted from the study's archives, so that tools that convert
+    # each item before anything else (aligner worker) skip straight past
+    # conversion without needing ffmpeg: each archive gets placeholder .webm
+    # files, and the conversion manifest records the .mp3 files as made
+    # from them
+    from aligner.mp3 import WebmToMp3Converter
+    df = pd.read_csv(tidy_csv)
+    zip_dir = os.path.join(data_dir, 'zip_archives')
+    for archive, grp_df in df.groupby('RecordingsArchive'):
+        path = os.path.join(zip_dir, archive)
+        if os.path.exists(path):
+            continue
+        with ZipFile(path, 'w') as z:
+            for name in grp_df['WebmFileName']:
+                z.writestr(name, f'placeholder for {name}')
+
+    converter = WebmToMp3Converter(
+        tidy_csv, os.path.join(data_dir, 'mp3_files'), zip_dir, False)
+    for p, grp_df in df.groupby('Participant'):
+        for n, (_, row) in enumerate(grp_df.iterrows(), 1):
+            unit, _ = converter._plan_one(p, n, row)
+            converter.manifest.record(unit['mp3'], unit['manifest_entry'])
+    converter.manifest.save()
@@ -17,11 +17,13 @@ setup(
             'to_mp3 = aligner.mp3:main',
             'transcribe = aligner.stt:main',
             'extract = aligner.transcriptions:main',
-            'align = aligner.aligner:main']},
+            'align = aligner.aligner:main',
+            'aligner = aligner.pipeline:main']},
     install_requires=[
         'PyYaml',
         'numpy',
         'pandas',
         'pydub',
+        'requests',
         'google-cloud-speech',
     ])
@@ -1,7 +1,15 @@
 import os
-import yaml
 
 
 module_dir, _ = os.path.split(__file__)
-with open(os.path.join(module_dir, 'log_conf.yml'), 'r') as f:
-    log_conf = yaml.load(f, Loader=yaml.FullLoader)
+
+
+def __getattr__(name):
+    # The logging config is only parsed the first time a CLI asks for it,
+    # so that importing the package doesn't pay for PyYAML
+    if name == 'log_conf':
+        import yaml
+        with open(os.path.join(module_dir, 'log_conf.yml'), 'r') as f:
+            globals()['log_conf'] = yaml.load(f, Loader=yaml.FullLoader)
+        return globals()['log_conf']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,18 +1,49 @@
 import os
+import re
+import csv
 import logging
 import logging.config
 import json
-import pandas as pd
-import numpy as np
-from pydub import AudioSegment
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, as_completed)
+from .audio_index import AudioIndex
+from .gentle import GentleClient, GentleError
+from .alignment_cache import AlignmentCache, AlignmentKeys
+from .alignment_store import AlignmentStore, ITEMS_FILE, WORDS_FILE
+from .textgrid import word_intervals, phone_intervals, write_textgrid
+from .file_index import FileIndex
+from .vad import decode, encode_flac, shift_alignment
+from .utils import load_json, dump_json_atomic, lazy_import
+from .metrics import metrics
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+pydub = lazy_import('pydub')
 
 
 logger = logging.getLogger(__name__)
 
+TIMING_STATE_FILE = '.timing_state.json'
+# Stands in for the audio hash in the keys of empty recordings, which are
+# never sent to gentle
+EMPTY_AUDIO = 'empty'
+GENTLE_SAMPLE_RATE = 8000
+_TIMING_COL = re.compile(r'Word.*(Onset|Offset)')
+LONG_TIMING_COLS = ['Participant', 'ItemNumber', 'WordIndex', 'Word', 'Case',
+                    'Onset', 'Offset']
+# The strings that pandas reads as missing values by default
+NA_VALUES = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null'])
+
 
 class Aligner:
     def __init__(self, transcribed_csv, data_dir,
-                 mp3_dir, transcriptions_dir, gentle_dir):
+                 mp3_dir, transcriptions_dir, gentle_dir, pcm_cache=None,
+                 gentle=None, concurrency=1, alignment_cache=None,
+                 write_json=True, state=None, files=None, transcripts='csv',
+                 vad=None):
         self.logger = logger.getChild(self.__class__.__name__)
         self.transcribed_csv = transcribed_csv
         self.data_dir = data_dir
@@ -20,37 +51,105 @@ class Aligner:
         self.transcriptions_dir = os.path.join(
             self.data_dir, transcriptions_dir)
         self.gentle_dir = os.path.join(self.data_dir, gentle_dir)
+        self.pcm_cache = pcm_cache
+        self.gentle = gentle if gentle is not None else GentleClient()
+        self.concurrency = concurrency
+        self.write_json = write_json
+        self.state = state
+        self.transcripts = transcripts
+        self.vad = vad
+        self.alignment_cache = alignment_cache if alignment_cache is not None \
+            else AlignmentCache(os.path.join(self.gentle_dir, '.cache'))
 
-        self.mp3_participants = [
-            p for p in os.listdir(self.mp3_dir) if p != '.DS_Store']
-        self.transcribed_participants = [
-            p for p in os.listdir(self.transcriptions_dir) if p != '.DS_Store']
+        self.files = files if files is not None else FileIndex(
+            self.mp3_dir, self.transcriptions_dir, self.gentle_dir)
+        self.files.refresh()
 
-        try:
-            assert self.mp3_participants == self.transcribed_participants
-        except AssertionError:
-            self.logger.error(
-                'The participant directories for the .mp3 files and the '
-                'participant directories for the transcription files do not '
-                'match.')
+        self.mp3_participants = self.files.participants('mp3')
+
+        # The transcription files are only needed if that's where the
+        # transcripts are read from
+        if self.transcripts == 'files':
+            self.transcribed_participants = self.files.participants(
+                'transcript')
+            try:
+                assert self.mp3_participants == self.transcribed_participants
+            except AssertionError:
+                self.logger.error(
+                    'The participant directories for the .mp3 files and the '
+                    'participant directories for the transcription files do '
+                    'not match.')
 
         self.participants = self.mp3_participants
 
         self.longest_sent = None
 
-    def align(self, overwrite=False, tg=True):
-        for p in self.participants:
+    def _read_transcripts(self, participants=None):
+        # The transcript for each item, keyed by participant and item number,
+        # from the state store or the .csv file. Items without a
+        # transcription are left out. Returns None if the transcripts are to
+        # be read from the transcription files instead.
+        if self.transcripts == 'files':
+            return None
+        if self.transcripts == 'state':
+            if participants is None:
+                known = self.state.transcriptions()
+            else:
+                known = {}
+                for p in participants:
+                    known.update(self.state.transcriptions(p))
+        else:
+            # Only two columns are needed, so this doesn't wait on pandas,
+            # which keeps a run with nothing to align quick
+            known = {}
+            counts = {}
+            with metrics.timer('csv.read'), \
+                    open(self.transcribed_csv, newline='',
+                         encoding='utf-8') as file_:
+                for row in csv.DictReader(file_):
+                    p = _participant(row['Participant'])
+                    n = counts[p] = counts.get(p, 0) + 1
+                    t = row.get('Transcription')
+                    if t is not None and t not in NA_VALUES:
+                        known[(p, n)] = t
+            metrics.add_bytes(
+                'csv.read', read=os.path.getsize(self.transcribed_csv))
+        # Written the same way as the transcription files
+        return {key: str(t) + '\n' for key, t in known.items()}
+
+    def align(self, overwrite=False, tg=True, phones=False,
+              participants=None):
+        # Alignments are keyed by the content of the audio and the
+        # transcript, so several items with the same key share one request
+        jobs = {}
+        items = []
+        alignment_keys = {}
+        alignments = {}
+        stores = {}
+        transcripts = self._read_transcripts(participants)
+        if participants is None:
+            participants = self.participants
+        for p in participants:
             self.logger.info('Force aligning audio for participant %(p)s' %
                              {'p': p})
-            mp3_files = [
-                f for f in os.listdir(os.path.join(self.mp3_dir, p))
-                if '.mp3' in f]
-            mp3_files.sort()
-
-            transcription_files = [
-                f for f in os.listdir(os.path.join(self.transcriptions_dir, p))
-                if '.txt' in f]
-            transcription_files.sort()
+            # Audio and transcriptions are paired by item number (as are the
+            # timings and the rows of the .csv file), so an item that's
+            # missing one of them is skipped without shifting the others
+            if transcripts is None:
+                gaps = self.files.gaps(p, ('mp3', 'transcript'))
+            else:
+                gaps = {n: ['transcript']
+                        for n in self.files.numbers(p, 'mp3')
+                        if (p, n) not in transcripts}
+            for n, missing in gaps.items():
+                self.logger.warning(
+                    'Item %(i)s for participant %(p)s has no %(missing)s. '
+                    'Skipping.' %
+                    {'i': n, 'p': p, 'missing': ' or '.join(
+                        '.mp3 file' if kind == 'mp3' else 'transcription'
+                        for kind in missing)})
+            numbers = [n for n in self.files.numbers(p, 'mp3')
+                       if n not in gaps]
 
             gdir = os.path.join(self.gentle_dir, p)
 
@@ -59,182 +158,523 @@ class Aligner:
                 self.logger.info(
                     'Created directory:\n%(dir)s' % {'dir': gdir})
 
-            for i, (m, t) in enumerate(zip(mp3_files, transcription_files)):
-                align_file = os.path.join(gdir, str(i + 1).zfill(2) + '.json')
-                with open(os.path.join(self.transcriptions_dir, p, t), 'r') \
-                     as file_:
-                    transcription = file_.read().strip().lower()
-                # If the participant didn't say anything, the transcriber
-                # was instructed to write 'empty' for the transcription
-                if transcription == 'empty':
-                    self.logger.warning(
-                        'Participant %(p)s\'s recording for item %(i)s was '
-                        'empty.' % {'p': p, 'i': i})
-                    faux_gentle = {'transcript': '',
-                                   'words': []}
-                    with open(align_file, 'w') as file_:
-                        json.dump(faux_gentle, file_, indent=2)
+            keys = alignment_keys[p] = AlignmentKeys(gdir)
+            store = stores[p] = AlignmentStore(gdir)
+            alignments[p] = {}
+
+            for n in numbers:
+                i = n - 1
+                align_file = os.path.join(gdir, str(n).zfill(2) + '.json')
+                mp3_file = self.files.get(p, n, 'mp3')['path']
+                items.append((p, i, os.path.basename(mp3_file), align_file))
+                if transcripts is not None:
+                    transcript = transcripts[(p, n)]
                 else:
-                    if os.path.exists(align_file) and overwrite:
-                        self.logger.info(
-                            'File, %(f)s, already exists. Overwriting.' %
-                            {'f': align_file})
-
-                    if os.path.exists(align_file) and not overwrite:
-                        self.logger.info(
-                            'File, %(f)s, already exists. Skipping.' %
-                            {'f': align_file})
-
-                    if overwrite or not os.path.isfile(align_file):
-                        command = (
-                            'curl -F "audio=@'
-                            f'{os.path.join(self.mp3_dir, p, m)}" '
-                            '-F "transcript=@'
-                            f'{os.path.join(self.transcriptions_dir, p, t)}" '
-                            '"http://localhost:8765/'
-                            'transcriptions?async=false" '
-                            f'> {align_file}')
-                        self.logger.debug('Running shell command:\n%(c)s' %
-                                          {'c': command})
-                        os.system(command)
-
-                if tg:
-                    tgf = os.path.join(
-                        self.mp3_dir, p,
-                        'item_number_' + str(i + 1).zfill(2) + '.TextGrid')
-                    self._write_textgrid_file(
-                        os.path.join(self.mp3_dir, p, m), align_file, tgf)
-                    self.logger.info('Wrote Praat TextGrid file:\n%(f)s' %
-                                     {'f': tgf})
-
-    def get_timing_info(self):
-        df = pd.read_csv(self.transcribed_csv)
+                    with open(self.files.get(p, n, 'transcript')['path'],
+                              'r') as file_:
+                        transcript = file_.read()
+                alignment, job = self._plan_alignment(
+                    keys, store, p, n, mp3_file, transcript, align_file,
+                    overwrite)
+                if alignment is not None:
+                    alignments[p][n] = alignment
+                    continue
+
+                key, entry = job
+                if key not in jobs:
+                    jobs[key] = (mp3_file, transcript, [])
+                jobs[key][2].append(entry)
+
+        self._run_alignments(jobs, alignments)
+
+        # The stores are written before the keys are saved, so that a key is
+        # never recorded for an alignment that didn't make it to disk
+        for p in alignments:
+            self._keep_existing(p, stores[p], alignments[p],
+                                self.files.numbers(p, 'mp3'))
+            AlignmentStore(os.path.join(self.gentle_dir, p)).write(
+                alignments[p])
+
+        for keys in alignment_keys.values():
+            keys.save()
+
+        if self.state is not None:
+            planned = {}
+            for p, i, _, _ in items:
+                planned.setdefault(p, []).append(i + 1)
+            for p, numbers in planned.items():
+                self._record_statuses(p, numbers, alignments[p])
+
+        if tg:
+            self._write_textgrids(items, alignments, phones)
+        self.files.save()
+
+    def _keep_existing(self, p, store, alignments, numbers):
+        # Items that didn't make it through this time (e.g., they have no
+        # transcription yet, or gentle failed on them) keep whatever
+        # alignment they had from an earlier run, instead of being dropped
+        # when the participant's store is rewritten
+        gdir = os.path.join(self.gentle_dir, p)
+        for n in numbers:
+            if n not in alignments:
+                existing = self._load_alignment(
+                    store, n, os.path.join(gdir, str(n).zfill(2) + '.json'))
+                if existing is not None:
+                    alignments[n] = existing
+
+    def _plan_alignment(self, keys, store, p, item, mp3_file, transcript,
+                        align_file, overwrite):
+        # Returns the item's alignment if it doesn't need to go to gentle,
+        # and otherwise the key it should be aligned under along with what's
+        # needed to record the result
+        transcription = transcript.strip().lower()
+        # If the participant didn't say anything, the transcriber
+        # was instructed to write 'empty' for the transcription
+        if transcription == 'empty':
+            self.logger.warning(
+                'Participant %(p)s\'s recording for item %(i)s was '
+                'empty.' % {'p': p, 'i': item - 1})
+            faux_gentle = {'transcript': '',
+                           'words': []}
+            if self.write_json:
+                with open(align_file, 'w') as file_:
+                    json.dump(faux_gentle, file_, indent=2)
+                self.files.record(p, item, 'alignment')
+            # Its key is made from the transcript alone, so that once the
+            # transcript is fixed, the item no longer matches it and is
+            # realigned
+            keys.record_empty(os.path.basename(align_file),
+                              self.alignment_cache.key(EMPTY_AUDIO,
+                                                       transcript))
+            return faux_gentle, None
+
+        align_name = os.path.basename(align_file)
+        recorded = keys.get(align_name)
+        audio_hash, stat = self.alignment_cache.audio_hash(
+            mp3_file, recorded)
+        key = self.alignment_cache.key(
+            audio_hash, transcript,
+            self.vad.settings() if self.vad is not None else None)
+        existing = self._load_alignment(store, item, align_file)
+        exists = existing is not None
+
+        if exists and recorded is None and not _is_faux(existing):
+            # Alignment files from before keys were recorded are
+            # assumed to match their current inputs, unless they're only
+            # standing in for an empty recording
+            keys.record(align_name, key, audio_hash, stat)
+            recorded = keys.get(align_name)
+
+        current = exists and recorded is not None and recorded['key'] == key
+        if current and overwrite:
+            self.logger.info(
+                'File, %(f)s, already exists. Overwriting.' %
+                {'f': align_file})
+
+        if current and not overwrite:
+            self.logger.info(
+                'File, %(f)s, is up to date. Skipping.' %
+                {'f': align_file})
+            return existing, None
+
+        if exists and not current:
+            self.logger.info(
+                'The audio or transcription for %(f)s has '
+                'changed. Realigning.' % {'f': align_file})
+
+        cached = None
+        if not overwrite:
+            cached = self.alignment_cache.get(key)
+        if cached is not None:
+            if self.write_json:
+                dump_json_atomic(cached, align_file, indent=2)
+                self.files.record(p, item, 'alignment')
+            keys.record(align_name, key, audio_hash, stat)
+            self.logger.info(
+                'Took alignment for %(f)s from cache.' %
+                {'f': align_file})
+            return cached, None
+
+        return None, (key, (keys, p, item, align_name, align_file,
+                            audio_hash, stat))
+
+    def _write_textgrids(self, items, alignments, phones=False):
+        audio_indexes = {}
+        for p, i, m, align_file in items:
+            alignment = alignments[p].get(i + 1)
+            if alignment is None:
+                self.logger.warning(
+                    'No alignment for item %(i)s for participant %(p)s. '
+                    'Not writing a Praat TextGrid file.' %
+                    {'i': i + 1, 'p': p})
+                continue
+            if p not in audio_indexes:
+                audio_indexes[p] = AudioIndex(
+                    os.path.join(self.mp3_dir, p))
+            tgf = os.path.join(
+                self.mp3_dir, p,
+                'item_number_' + str(i + 1).zfill(2) + '.TextGrid')
+            mp3_file = os.path.join(self.mp3_dir, p, m)
+            meta = None
+            if self.pcm_cache is not None:
+                meta = self.pcm_cache.lookup(p, i + 1, mp3_file)
+            if meta is None:
+                meta = audio_indexes[p].get(m)
+            self._write_textgrid_file(
+                mp3_file, alignment, tgf, meta['duration'], phones)
+            self.files.record(p, i + 1, 'textgrid')
+            self.logger.info('Wrote Praat TextGrid file:\n%(f)s' %
+                             {'f': tgf})
+
+        for audio_index in audio_indexes.values():
+            audio_index.save()
+
+    def _run_alignments(self, jobs, alignments):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self._submit_alignment, key, mp3_file, transcript): key
+                for key, (mp3_file, transcript, _) in jobs.items()}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except GentleError as e:
+                    self.logger.error(str(e))
+                    continue
+                self._record_alignment(
+                    futures[future], result, jobs[futures[future]][2],
+                    alignments)
+
+    def _submit_alignment(self, key, mp3_file, transcript):
+        self.logger.debug('Submitting %(f)s to gentle' % {'f': mp3_file})
+        if self.vad is None:
+            result = self.gentle.align(mp3_file, transcript)
+        else:
+            # gentle works on 8 kHz mono audio whatever it's sent, so only
+            # the speech is sent, already in that form, and the timings it
+            # finds are moved back by however much was trimmed off the front
+            samples = decode(mp3_file, GENTLE_SAMPLE_RATE, 1)
+            samples, offset = self.vad.trim(samples, GENTLE_SAMPLE_RATE)
+            result = shift_alignment(self.gentle.align(
+                mp3_file, transcript,
+                encode_flac(samples, GENTLE_SAMPLE_RATE)), offset)
+        # Only ever write complete, successful alignments to disk, so
+        # that a failure is retried on the next run instead of being
+        # mistaken for a result
+        self.alignment_cache.put(key, result)
+        return result
+
+    def _record_alignment(self, key, result, entries, alignments):
+        for keys, p, item, align_name, align_file, audio_hash, stat in \
+                entries:
+            alignments[p][item] = result
+            if self.write_json:
+                dump_json_atomic(result, align_file, indent=2)
+                self.files.record(p, item, 'alignment')
+                self.logger.info(
+                    'Wrote alignment file:\n%(f)s' % {'f': align_file})
+            keys.record(align_name, key, audio_hash, stat)
+
+    def _record_statuses(self, p, numbers, alignments):
+        if self.state is not None:
+            self.state.set_statuses(p, 'align', {
+                n: _alignment_status(alignments.get(n)) for n in numbers})
+
+    @staticmethod
+    def _load_alignment(store, item, align_file):
+        if store.exists():
+            alignment = store.to_gentle(item)
+            if alignment is not None:
+                return alignment
+        try:
+            with open(align_file, 'r') as file_:
+                alignment = json.load(file_)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(alignment, dict) or 'words' not in alignment:
+            return None
+        return alignment
+
+    def get_timing_info(self, jobs=1, incremental=True, long_output=None,
+                        wide=True):
+        # Only the participants whose alignments have changed since the last
+        # run are recomputed; the others keep the timing information that was
+        # already written
+        state_file = os.path.join(self.gentle_dir, TIMING_STATE_FILE)
+        state = load_json(state_file, {}) if incremental else {}
+        run = {'csv': _file_signature(self.transcribed_csv), 'wide': wide,
+               'long': os.path.abspath(long_output)
+               if long_output is not None else None,
+               'store': os.path.abspath(self.state.path)
+               if self.state is not None else None}
+        if self._unchanged(state, run):
+            self.logger.info(
+                'Timing information is up to date for all participants.')
+            return
+
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.transcribed_csv)
+        metrics.add_bytes(
+            'csv.read', read=os.path.getsize(self.transcribed_csv))
+
+        groups = [grp_df for _, grp_df in df.groupby('Participant')]
+        participants = [str(int(grp_df['Participant'].unique()[0]))
+                        for grp_df in groups]
+        signatures = [
+            {'alignments': _alignment_signature(
+                os.path.join(self.gentle_dir, p),
+                self.files.names(p, 'alignment')),
+             'rows': len(grp_df)}
+            for p, grp_df in zip(participants, groups)]
+
+        if wide:
+            self._write_wide_timing(
+                df, groups, participants, signatures, state, jobs)
+        if long_output is not None:
+            self._write_long_timing(
+                long_output, groups, participants, signatures, state, jobs)
+        if self.state is not None:
+            self._write_store_timing(
+                groups, participants, signatures, state, jobs)
+
+        run['csv'] = _file_signature(self.transcribed_csv)
+        state['run'] = run
+        dump_json_atomic(state, state_file, indent=2, sort_keys=True)
+
+    def _unchanged(self, state, run):
+        # If neither the .csv file nor any participant's alignments have
+        # changed since the last run with the same outputs, there's nothing
+        # to do, and that can be told without reading the .csv file
+        if state.get('run') != run:
+            return False
+        if run['long'] is not None and not os.path.exists(run['long']):
+            return False
+        if run['wide']:
+            recorded = state['participants']
+        elif run['long'] is not None:
+            recorded = state['long']['participants']
+        elif run['store'] is not None:
+            recorded = state['store']['participants']
+        else:
+            return True
+        try:
+            return all(
+                _alignment_signature(
+                    os.path.join(self.gentle_dir, p),
+                    self.files.names(p, 'alignment')) ==
+                signature['alignments']
+                for p, signature in recorded.items())
+        except FileNotFoundError:
+            return False
+
+    def _write_wide_timing(self, df, groups, participants, signatures, state,
+                           jobs):
         self.longest_sent = max(
             np.vectorize(len)(
-                np.char.split(df['Transcription'].unique().astype(str))))
+                np.char.split(
+                    np.asarray(df['Transcription'].unique(), dtype=str))))
+
+        # If the longest sentence has changed, every participant's columns
+        # change
+        previous = state.get('participants', {})
+        if state.get('longest_sent') != int(self.longest_sent):
+            previous = {}
+        state['longest_sent'] = int(self.longest_sent)
+        state['participants'] = dict(zip(participants, signatures))
+
+        timing_cols = _timing_cols(self.longest_sent)
+        frames = [None] * len(groups)
+        stale = []
+        for n, (p, grp_df) in enumerate(zip(participants, groups)):
+            columns = [c for c in grp_df.columns
+                       if not _TIMING_COL.search(c)] + timing_cols
+            if previous.get(p) == signatures[n] and \
+                    list(grp_df.columns) == columns:
+                frames[n] = grp_df.reset_index(drop=True)
+            else:
+                stale.append(n)
+
+        if not stale:
+            self.logger.info(
+                'Timing information is up to date for all participants.')
+            return
+
+        self.logger.info(
+            'Extracting timing information for %(n)s of %(total)s '
+            'participant(s).' % {'n': len(stale), 'total': len(groups)})
+        gentle_dirs = [os.path.join(self.gentle_dir, participants[n])
+                       for n in stale]
+        longest_sents = [self.longest_sent] * len(stale)
+        n_rows = [len(groups[n]) for n in stale]
+
+        # Parsing the .json files is the expensive part, so that can be
+        # spread across processes; the table itself is built in one go
+        with metrics.timer('timing.parse'):
+            timings = _map(
+                _parse_timing_info, jobs, gentle_dirs, longest_sents,
+                [self.files.names(participants[n], 'alignment')
+                 for n in stale], n_rows)
+        metrics.add_bytes('timing.parse', read=_signature_bytes(
+            [signatures[n] for n in stale]))
+
+        for n, timing in zip(stale, timings):
+            frames[n] = self._combine_timing_info(
+                groups[n], timing, self.longest_sent)
 
-        df = df.groupby('Participant', as_index=False).apply(
-            lambda x: self._extract_timing_info(
-                x, self.gentle_dir, self.longest_sent))
+        df = pd.concat(frames, ignore_index=True)
 
-        df.to_csv(self.transcribed_csv, na_rep='NA', index=False)
+        with metrics.timer('csv.write'):
+            df.to_csv(self.transcribed_csv, na_rep='NA', index=False)
+        metrics.add_bytes(
+            'csv.write', written=os.path.getsize(self.transcribed_csv))
         self.logger.info('Wrote file:\n%(f)s' % {'f': self.transcribed_csv})
 
-    def _write_textgrid_file(self, mp3_file, json_file, textgrid_file):
-        with open(json_file, 'r') as j:
-            timing_info = json.load(j)
+    def _write_long_timing(self, long_output, groups, participants,
+                           signatures, state, jobs):
+        # The long format has a row per word rather than a column per word,
+        # so it doesn't need to be padded out to the longest sentence.
+        # Participants that are new since the last run are appended to the
+        # file, and it's only rewritten when a participant that's already in
+        # it has to be replaced.
+        previous = state.get('long', {})
+        if previous.get('file') != os.path.abspath(long_output) or \
+                not os.path.exists(long_output):
+            previous = {}
+        in_file = previous.get('participants', {})
+        state['long'] = {'file': os.path.abspath(long_output),
+                         'participants': dict(zip(participants, signatures))}
 
-        transcription = timing_info['transcript']
-        timing_info = timing_info['words']
+        stale = [n for n, p in enumerate(participants)
+                 if in_file.get(p) != signatures[n]]
+        replaced = set(in_file) - set(participants)
+        replaced.update(participants[n] for n in stale if
+                        participants[n] in in_file)
 
-        tg = ''
-        num_intervals = 0
+        if not stale and not replaced:
+            self.logger.info(
+                'Long-format timing information is up to date for all '
+                'participants.')
+            return
 
+        self.logger.info(
+            'Extracting long-format timing information for %(n)s of '
+            '%(total)s participant(s).' %
+            {'n': len(stale), 'total': len(groups)})
+        gentle_dirs = [os.path.join(self.gentle_dir, participants[n])
+                       for n in stale]
+        with metrics.timer('timing.parse'):
+            words = _map(
+                _parse_word_timing, jobs, gentle_dirs,
+                [self.files.names(participants[n], 'alignment')
+                 for n in stale])
+        metrics.add_bytes('timing.parse', read=_signature_bytes(
+            [signatures[n] for n in stale]))
+        df = pd.concat(
+            [pd.DataFrame(columns=LONG_TIMING_COLS)] +
+            [self._long_timing_info(groups[n], w)
+             for n, w in zip(stale, words)],
+            ignore_index=True)
+
+        appended = 0
+        with metrics.timer('csv.write'):
+            if not in_file:
+                df.to_csv(long_output, na_rep='NA', index=False)
+            elif replaced:
+                kept = pd.read_csv(long_output)
+                kept = kept[~kept['Participant'].map(
+                    lambda p: str(int(p))).isin(replaced)]
+                df = pd.concat([kept, df], ignore_index=True)
+                df.to_csv(long_output, na_rep='NA', index=False)
+            else:
+                appended = os.path.getsize(long_output)
+                df.to_csv(long_output, na_rep='NA', index=False, mode='a',
+                          header=False)
+        metrics.add_bytes(
+            'csv.write', written=os.path.getsize(long_output) - appended)
+        self.logger.info('Wrote file:\n%(f)s' % {'f': long_output})
+
+    def _write_store_timing(self, groups, participants, signatures, state,
+                            jobs):
+        # Each participant's word timings are replaced in the state store
+        # whenever their alignments change
+        previous = state.get('store', {})
+        if previous.get('file') != os.path.abspath(self.state.path):
+            previous = {}
+        in_store = previous.get('participants', {})
+        state['store'] = {'file': os.path.abspath(self.state.path),
+                          'participants': dict(zip(participants, signatures))}
+
+        stale = [n for n, p in enumerate(participants)
+                 if in_store.get(p) != signatures[n]]
+        if not stale:
+            self.logger.info(
+                'Timing information in the state store is up to date for all'
+                ' participants.')
+            return
+
+        self.logger.info(
+            'Storing timing information for %(n)s of %(total)s '
+            'participant(s).' % {'n': len(stale), 'total': len(groups)})
+        gentle_dirs = [os.path.join(self.gentle_dir, participants[n])
+                       for n in stale]
+        with metrics.timer('timing.parse'):
+            words = _map(
+                _parse_word_timing, jobs, gentle_dirs,
+                [self.files.names(participants[n], 'alignment')
+                 for n in stale])
+        metrics.add_bytes('timing.parse', read=_signature_bytes(
+            [signatures[n] for n in stale]))
+        for n, w in zip(stale, words):
+            keep = w['row'] < len(groups[n])
+            self.state.set_timings(
+                participants[n], {k: v[keep] for k, v in w.items()})
+
+    def _write_textgrid_file(self, mp3_file, timing_info, textgrid_file,
+                             duration=None, phones=False):
         # Only collect timing info for TextGrid file if transcription
         # is non-empty
-        if transcription:
-            aligner_successes = [x['case'] for x in timing_info]
-            first_successful_word = aligner_successes.index('success')
+        tiers = [('word', [])]
+        if phones:
+            tiers.append(('phone', []))
+        if timing_info['transcript']:
+            tiers[0] = ('word', word_intervals(timing_info['words']))
+            if phones:
+                tiers[1] = ('phone', phone_intervals(timing_info['words']))
 
-            for i, word_info in enumerate(timing_info):
-                if not word_info['case'] == 'success':
-                    continue
-                else:
-                    num_intervals += 1
-                    if i == first_successful_word:
-                        xmin = 0
-                        xmax = word_info['start']
-                        text = '{SL}'
-
-                        tg = self._append_tg_interval_to_str(
-                            tg, num_intervals, xmin, xmax, text)
-
-                        num_intervals += 1
-                        xmin = word_info['start']
-                        xmax = word_info['end']
-                        text = word_info['alignedWord']
-
-                        tg = self._append_tg_interval_to_str(
-                            tg, num_intervals, xmin, xmax, text)
-
-                        prev_offset = xmax
-                    else:
-                        xmin = word_info['start']
-                        xmax = word_info['end']
-                        text = word_info['alignedWord']
-
-                        if xmin == prev_offset:
-                            tg = self._append_tg_interval_to_str(
-                                tg, num_intervals, xmin, xmax, text)
-                        else:
-                            tg = self._append_tg_interval_to_str(
-                                tg, num_intervals, prev_offset, xmin, '')
-
-                            num_intervals += 1
-
-                            tg = self._append_tg_interval_to_str(
-                                tg, num_intervals, xmin, xmax, text)
-
-                        prev_offset = xmax
-
-        xmin = 0
-        mp3 = AudioSegment.from_file(mp3_file)
-        xmax = mp3.duration_seconds
-
-        with open(textgrid_file, 'w') as tgf:
-            tgf.write('File type = "ooTextFile"\n')
-            tgf.write('Object class = "TextGrid"\n\n')
-            tgf.write(f'xmin = {xmin}\n')
-            tgf.write(f'xmax = {xmax}\n')
-            tgf.write('tiers? <exists>\n')
-            tgf.write('size = 1\n')
-            tgf.write('item []:\n')
-            tgf.write('    item [1]:\n')
-            tgf.write('        class = "IntervalTier"\n')
-            tgf.write('        name = "word"\n')
-            tgf.write(f'        xmin = {xmin}\n')
-            tgf.write(f'        xmax = {xmax}\n')
-            tgf.write(f'        intervals: size = {num_intervals}')
-            if tg:
-                tgf.write(tg)
+        if duration is None:
+            duration = pydub.AudioSegment.from_file(mp3_file).duration_seconds
 
-    @staticmethod
-    def _append_tg_interval_to_str(str_, interval, xmin, xmax, text):
-        str_ += f'\n            intervals [{interval}]:'
-        str_ += f'\n                xmin = {xmin}'
-        str_ += f'\n                xmax = {xmax}'
-        str_ += f'\n                text = "{text}"'
-        return str_
+        write_textgrid(textgrid_file, 0, duration, tiers)
 
     @staticmethod
     def _extract_timing_info(grp_df, gentle_dir, longest_sent):
         gentle_dir = os.path.join(
             gentle_dir, str(int(grp_df['Participant'].unique()[0])))
-        json_files = [f for f in os.listdir(gentle_dir) if '.json' in f]
-        json_files.sort()
-
-        onset_cols = [f'Word{str(i + 1)}Onset' for i in range(longest_sent)]
-        offset_cols = [f'Word{str(i + 1)}Offset' for i in range(longest_sent)]
-        timing_cols = [
-            val for pair in zip(onset_cols, offset_cols) for val in pair]
-
-        timing_df = pd.DataFrame(
-            np.empty((len(json_files), longest_sent * 2), dtype=np.float64),
-            columns=timing_cols)
-        timing_df[:] = np.nan
-
-        for i, f in enumerate(json_files):
-            with open(os.path.join(gentle_dir, f), 'r') as file_:
-                timing_info = json.load(file_)
-            timing_info = timing_info['words']
-
-            for ii, word_info in enumerate(timing_info):
-                if word_info['case'] == 'success':
-                    timing_df.iloc[[i], [(ii * 2)]] = word_info['start']
-                    timing_df.iloc[[i], [(ii * 2) + 1]] = word_info['end']
-                else:
-                    timing_df.iloc[[i], [(ii * 2)]] = float('inf')
-                    timing_df.iloc[[i], [(ii * 2) + 1]] = float('inf')
+        return Aligner._combine_timing_info(
+            grp_df, _parse_timing_info(gentle_dir, longest_sent,
+                                       n_rows=len(grp_df)),
+            longest_sent)
+
+    @staticmethod
+    def _long_timing_info(grp_df, words):
+        # Words are matched to the rows of grp_df by item number, the same
+        # way as the wide timing columns are
+        item_numbers = grp_df['ItemNumber'].to_numpy()
+        keep = words['row'] < len(item_numbers)
+        n_words = int(keep.sum())
+        return pd.DataFrame({
+            'Participant': np.repeat(
+                grp_df['Participant'].to_numpy()[:1], n_words),
+            'ItemNumber': item_numbers[words['row'][keep]],
+            'WordIndex': words['index'][keep] + 1,
+            'Word': words['word'][keep],
+            'Case': words['case'][keep],
+            'Onset': words['onset'][keep],
+            'Offset': words['offset'][keep]}, columns=LONG_TIMING_COLS)
+
+    @staticmethod
+    def _combine_timing_info(grp_df, timing, longest_sent):
+        timing_df = pd.DataFrame(timing, columns=_timing_cols(longest_sent))
 
         # If we've already run the script for at least 1 participant, then
         # the timing columns will also be present in the grp_df DataFrame
@@ -244,28 +684,189 @@ class Aligner:
         # whereas before there was only up to Word14Onset and Word14Offset)
         cols_to_drop = set(grp_df.filter(regex='Word.*Onset'))
         cols_to_drop.update(grp_df.filter(regex='Word.*Offset'))
-        cols_to_drop.update(timing_cols)
-        grp_df.drop(columns=cols_to_drop, inplace=True, errors='ignore')
-        grp_df.reset_index(drop=True, inplace=True)
+        cols_to_drop.update(timing_df.columns)
+        grp_df = grp_df.drop(columns=cols_to_drop, errors='ignore')
+        grp_df = grp_df.reset_index(drop=True)
 
         df = pd.concat([grp_df, timing_df], axis=1)
 
         return df
 
 
+def _json_files(gentle_dir, json_files=None):
+    # The names of the participant's alignment files, in item order. Callers
+    # that have them from the file index pass them in, so that the directory
+    # doesn't have to be listed again.
+    if json_files is not None:
+        return json_files
+    return sorted(f for f in os.listdir(gentle_dir)
+                  if f.endswith('.json') and not f.startswith('.'))
+
+
+def _alignment_signature(gentle_dir, json_files=None):
+    # Changes whenever the alignments for a participant are rewritten
+    store = AlignmentStore(gentle_dir)
+    if store.exists():
+        names = [ITEMS_FILE, WORDS_FILE]
+    else:
+        names = _json_files(gentle_dir, json_files)
+    signature = []
+    for name in names:
+        stat = os.stat(os.path.join(gentle_dir, name))
+        signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _participant(value):
+    # Participant IDs are read as integers by pandas, which is how their
+    # directories are named
+    try:
+        return str(int(value))
+    except ValueError:
+        return value
+
+
+def _is_faux(alignment):
+    # The alignment written for an item whose transcription was 'empty'
+    return not alignment.get('transcript') and not alignment.get('words')
+
+
+def _alignment_status(alignment):
+    if alignment is None:
+        return 'failed'
+    if _is_faux(alignment):
+        return 'empty'
+    return 'aligned'
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _signature_bytes(signatures):
+    return sum(size for signature in signatures
+               for _, size, _ in signature['alignments'])
+
+
+def _timing_cols(longest_sent):
+    onset_cols = [f'Word{str(i + 1)}Onset' for i in range(longest_sent)]
+    offset_cols = [f'Word{str(i + 1)}Offset' for i in range(longest_sent)]
+    return [val for pair in zip(onset_cols, offset_cols) for val in pair]
+
+
+def _item_number(json_file):
+    # Alignment files are named after their item's number (e.g., 03.json)
+    return int(os.path.splitext(json_file)[0])
+
+
+def _parse_timing_info(gentle_dir, longest_sent, json_files=None,
+                       n_rows=None):
+    # Reads the onset and offset of every word in every .json file in the
+    # directory into one preallocated array, with a row per item (of n_rows,
+    # by default up to the last item with a file) and an onset and offset
+    # column per word. Items without a file are left NaN. Words that the
+    # aligner couldn't place get an infinite onset and offset.
+    store = AlignmentStore(gentle_dir)
+    if store.exists():
+        return store.timing(longest_sent, n_rows)
+
+    json_files = _json_files(gentle_dir, json_files)
+    numbers = [_item_number(f) for f in json_files]
+    if n_rows is None:
+        n_rows = max(numbers, default=0)
+
+    rows, words, onsets, offsets = [], [], [], []
+    for n, f in zip(numbers, json_files):
+        if n > n_rows:
+            continue
+        with open(os.path.join(gentle_dir, f), 'r') as file_:
+            timing_info = json.load(file_)['words']
+        rows.extend([n - 1] * len(timing_info))
+        words.extend(range(len(timing_info)))
+        for word_info in timing_info:
+            success = word_info['case'] == 'success'
+            onsets.append(word_info['start'] if success else np.inf)
+            offsets.append(word_info['end'] if success else np.inf)
+
+    timing = np.full((n_rows, longest_sent * 2), np.nan)
+    rows = np.array(rows, dtype=np.intp)
+    cols = np.array(words, dtype=np.intp) * 2
+    timing[rows, cols] = onsets
+    timing[rows, cols + 1] = offsets
+    return timing
+
+
+def _parse_word_timing(gentle_dir, json_files=None):
+    # Reads every word in the participant's alignments into flat arrays: its
+    # item number and the row of its item among the participant's rows (the
+    # item number less one), its position in the item, gentle's case and
+    # the word itself, and its onset and offset (NaN for words that the
+    # aligner couldn't place)
+    store = AlignmentStore(gentle_dir)
+    if store.exists():
+        words = store.words
+        success = words['case'] == 'success'
+        items = np.array(words['item'], dtype=np.intp)
+        return {
+            'item': items,
+            'row': items - 1,
+            'index': np.array(words['index'], dtype=np.intp),
+            'word': np.array(words['word'], dtype=object),
+            'case': np.array(words['case'], dtype=object),
+            'onset': np.where(success, words['start'], np.nan),
+            'offset': np.where(success, words['end'], np.nan)}
+
+    json_files = _json_files(gentle_dir, json_files)
+
+    columns = {'item': [], 'index': [], 'word': [], 'case': [], 'onset': [],
+               'offset': []}
+    for f in json_files:
+        item = _item_number(f)
+        with open(os.path.join(gentle_dir, f), 'r') as file_:
+            timing_info = json.load(file_)['words']
+        for j, word_info in enumerate(timing_info):
+            success = word_info['case'] == 'success'
+            columns['item'].append(item)
+            columns['index'].append(j)
+            columns['word'].append(word_info.get('word', ''))
+            columns['case'].append(word_info['case'])
+            columns['onset'].append(word_info['start'] if success else np.nan)
+            columns['offset'].append(word_info['end'] if success else np.nan)
+    items = np.array(columns['item'], dtype=np.intp)
+    return {
+        'item': items,
+        'row': items - 1,
+        'index': np.array(columns['index'], dtype=np.intp),
+        'word': np.array(columns['word'], dtype=object),
+        'case': np.array(columns['case'], dtype=object),
+        'onset': np.array(columns['onset'], dtype=np.float64),
+        'offset': np.array(columns['offset'], dtype=np.float64)}
+
+
+def _map(fn, jobs, *iterables):
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(fn, *iterables))
+    return list(map(fn, *iterables))
+
+
 def main():
     import argparse
-    from . import log_conf
     from .utils import set_class_log_level
-
-    logging.config.dictConfig(log_conf)
+    from .pcm_cache import PCMCache
+    from .gentle import GentlePool
+    from .alignment_cache import AlignmentCache
+    from .metrics import add_metrics_arguments, report_metrics
+    from .state import add_state_arguments, open_state
+    from .vad import add_vad_arguments, open_vad
 
     parser = argparse.ArgumentParser(
         description='Aligns transcriptions with audio files using the '
         'gentle forced aligner (https://lowerquality.com/gentle/), which'
-        ' must be installed and running on port 8765 for this script to '
-        'work as intended. The forced aligner writes .json files with '
-        'timing information to data_dir/gentle_dir, and this timing info'
+        ' must be installed and running (by default, on port 8765) for this '
+        'script to work as intended. The forced aligner writes .json files '
+        'with timing information to data_dir/gentle_dir, and this timing info'
         ' is then extracted from those .json files and written back to the'
         ' main .csv file with all of the data.')
 
@@ -296,7 +897,8 @@ def main():
         '--transcriptions-dir', '-t', type=str,
         default='transcriptions',
         help='Relative path from data_dir to the directory with all of the'
-        ' transcriptions to be aligned with the .mp3 files.',
+        ' transcriptions to be aligned with the .mp3 files. Only used with '
+        '--transcripts files.',
         dest='transcriptions_dir')
 
     parser.add_argument(
@@ -308,13 +910,15 @@ def main():
 
     parser.add_argument(
         '--overwrite', '-o', action='store_true',
-        help='Overwrites the alignment file if it already exists.',
+        help='Realigns every item, even if its alignment file is up to '
+        'date.',
         dest='overwrite')
 
     parser.add_argument(
         '--no-overwrite', '-n', action='store_false',
-        help='Does not overwrite already existing alignment files (the default'
-        ' behavior).', dest='overwrite')
+        help='Only realigns items whose audio or transcription has changed '
+        'since they were last aligned (the default behavior).',
+        dest='overwrite')
 
     parser.add_argument(
         '--praat-textgrid', '-p', action='store_true',
@@ -328,6 +932,104 @@ def main():
         help='Doesn\'t write a Praat .TextGrid file.',
         dest='praat_textgrid')
 
+    parser.add_argument(
+        '--pcm-cache', type=str, default=None,
+        help='Path to the PCM cache written by to_mp3. The durations needed '
+        'for the .TextGrid files are read from there instead of decoding the'
+        ' .mp3 files.',
+        dest='pcm_cache')
+
+    parser.add_argument(
+        '--gentle-url', type=str, nargs='+',
+        default=['http://localhost:8765'],
+        help='URL(s) of the gentle forced aligner (default is '
+        'http://localhost:8765). With more than one URL, files are sent to '
+        'whichever instance has the fewest files in flight, and instances '
+        'that fail or are much slower than the others are taken out of '
+        'rotation until they recover.',
+        dest='gentle_url')
+
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='Number of alignments to have in flight at once, across all '
+        'gentle instances (default is 1).',
+        dest='concurrency')
+
+    parser.add_argument(
+        '--timeout', type=float, default=300,
+        help='Number of seconds to wait for gentle to align a single file '
+        '(default is 300).',
+        dest='timeout')
+
+    parser.add_argument(
+        '--retries', type=int, default=3,
+        help='Number of times to retry a failed alignment, with exponential '
+        'backoff (default is 3).',
+        dest='retries')
+
+    parser.add_argument(
+        '--alignment-cache', type=str, default=None,
+        help='Path to the directory in which to cache alignments, keyed by '
+        'the content of the .mp3 file and the transcription (default is '
+        'gentle_dir/.cache). Only items whose audio or transcription has '
+        'changed since they were last aligned are sent to gentle again.',
+        dest='alignment_cache')
+
+    parser.add_argument(
+        '--phones', action='store_true',
+        help='Adds a tier with the phone timings from the gentle aligner to '
+        'the Praat .TextGrid files, in addition to the word tier.',
+        dest='phones')
+
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of worker processes to use for reading the timing '
+        'information from the alignment files (default is 1).',
+        dest='jobs')
+
+    parser.add_argument(
+        '--no-json', action='store_false',
+        help='Doesn\'t write a .json file with gentle\'s output for each item.'
+        ' The alignments are always saved in a compact binary store for each'
+        ' participant in gentle_dir, which is what the timing information '
+        'and the Praat .TextGrid files are read from.',
+        dest='json')
+
+    parser.add_argument(
+        '--full', action='store_true',
+        help='Re-extracts the timing information for all participants. By '
+        'default, it is only re-extracted for participants whose alignments'
+        ' have changed since the last run.',
+        dest='full')
+
+    parser.add_argument(
+        '--long-output', type=str, default=None,
+        help='Path to a .csv file to which to write the timing information '
+        'in long format, with a row per word (participant, item number, word'
+        ' index, word, case, onset and offset) instead of an onset and offset'
+        ' column per word.',
+        dest='long_output')
+
+    parser.add_argument(
+        '--no-wide', action='store_false',
+        help='Doesn\'t add the WordNOnset and WordNOffset columns to the '
+        'main .csv file. Use this with --long-output.',
+        dest='wide')
+
+    parser.add_argument(
+        '--transcripts', type=str, default='csv',
+        choices=['csv', 'state', 'files'],
+        help='Where to read the transcripts from: the Transcription column of'
+        ' the .csv file (the default), the state store given with --state, '
+        'or the .txt files in data_dir/transcriptions_dir written by '
+        'extract. Unless it\'s "files", the transcripts are sent to gentle '
+        'straight from memory and no transcription files are needed.',
+        dest='transcripts')
+
+    add_state_arguments(parser)
+    add_vad_arguments(parser)
+    add_metrics_arguments(parser)
+
     parser.set_defaults(praat_textgrid=True, overwrite=False)
 
     parser.add_argument(
@@ -339,10 +1041,32 @@ def main():
 
     args = parser.parse_args()
 
-    aligner = Aligner(args.file_, args.data_dir, args.mp3_dir,
-                      args.transcriptions_dir, args.gentle_dir)
+    if args.transcripts == 'state' and args.state is None:
+        parser.error('--transcripts state needs --state')
+
+    # Loaded only once there's work to do, so that --help stays quick
+    from . import log_conf
+    logging.config.dictConfig(log_conf)
+
+    aligner = Aligner(
+        args.file_, args.data_dir, args.mp3_dir, args.transcriptions_dir,
+        args.gentle_dir,
+        PCMCache(args.pcm_cache) if args.pcm_cache is not None else None,
+        GentlePool(args.gentle_url, args.timeout, args.retries),
+        args.concurrency,
+        AlignmentCache(args.alignment_cache)
+        if args.alignment_cache is not None else None,
+        args.json, open_state(args), transcripts=args.transcripts,
+        vad=open_vad(args))
 
     set_class_log_level(aligner, args.log)
+    if aligner.vad is not None:
+        set_class_log_level(aligner.vad, args.log)
 
-    aligner.align(args.overwrite, args.praat_textgrid)
-    aligner.get_timing_info()
+    with report_metrics(args):
+        try:
+            aligner.align(args.overwrite, args.praat_textgrid, args.phones)
+        finally:
+            aligner.gentle.close()
+        aligner.get_timing_info(
+            args.jobs, not args.full, args.long_output, args.wide)
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+from .utils import load_json, dump_json_atomic
+
+
+KEYS_FILE = '.alignment_keys.json'
+
+
+def normalize_transcript(transcript):
+    return ' '.join(transcript.split())
+
+
+class AlignmentCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def audio_hash(self, mp3_file, known=None):
+        # Hashing an .mp3 file is only redone when its size or mtime changes
+        stat = os.stat(mp3_file)
+        if (known is not None and known.get('mp3_size') == stat.st_size and
+                known.get('mp3_mtime_ns') == stat.st_mtime_ns):
+            return known['mp3_sha256'], stat
+        h = hashlib.sha256()
+        with open(mp3_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest(), stat
+
+    @staticmethod
+    def key(audio_hash, transcript, settings=None):
+        # settings holds anything else that changes what gentle is sent for
+        # the same .mp3 file (e.g., how it's trimmed)
+        h = hashlib.sha256(audio_hash.encode('ascii'))
+        h.update(b'\0')
+        h.update(normalize_transcript(transcript).encode('utf-8'))
+        if settings is not None:
+            h.update(b'\0')
+            h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        return load_json(self._path(key))
+
+    def put(self, key, result):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dump_json_atomic(result, path)
+
+
+class AlignmentKeys:
+    # Records which (audio, transcript) key each alignment file in a
+    # participant's directory was made from
+    def __init__(self, directory):
+        self.path = os.path.join(directory, KEYS_FILE)
+        self.entries = load_json(self.path, {})
+        self.dirty = False
+
+    def get(self, align_name):
+        return self.entries.get(align_name)
+
+    def record(self, align_name, key, audio_hash, stat):
+        self.entries[align_name] = {
+            'key': key, 'mp3_sha256': audio_hash,
+            'mp3_size': stat.st_size, 'mp3_mtime_ns': stat.st_mtime_ns}
+        self.dirty = True
+
+    def record_empty(self, align_name, key):
+        # An empty recording's alignment doesn't depend on its audio, so no
+        # audio hash is kept that a later key could be made from
+        self.entries[align_name] = {'key': key}
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            dump_json_atomic(self.entries, self.path, indent=2,
+                             sort_keys=True)
+            self.dirty = False
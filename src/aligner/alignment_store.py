@@ -0,0 +1,161 @@
+import os
+from .metrics import metrics
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+
+
+ITEMS_FILE = 'alignment.items.npy'
+WORDS_FILE = 'alignment.words.npy'
+PHONES_FILE = 'alignment.phones.npy'
+
+
+def _text_dtype(values):
+    # NumPy record arrays need fixed-width strings, so use the width of the
+    # longest one
+    return f'U{max([len(v) for v in values] + [1])}'
+
+
+def _save(array, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def _equal(a, b):
+    return a.dtype == b.dtype and np.array_equal(a, b)
+
+
+class AlignmentStore:
+    # A participant's alignments as three record arrays (one row per item,
+    # per word and per phone) that are written once when aligning and then
+    # memory-mapped lazily by timing extraction and TextGrid writing
+    def __init__(self, directory):
+        self.directory = directory
+        self._items = None
+        self._words = None
+        self._phones = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.directory, ITEMS_FILE))
+
+    def write(self, alignments):
+        items, words, phones = [], [], []
+        for item in sorted(alignments):
+            alignment = alignments[item]
+            items.append((item, alignment['transcript'],
+                          len(alignment['words'])))
+            for i, w in enumerate(alignment['words']):
+                success = w['case'] == 'success'
+                start = w['start'] if success else np.inf
+                end = w['end'] if success else np.inf
+                words.append((item, i, w['case'], w.get('word', ''),
+                              w.get('alignedWord', ''), start, end))
+                if not success:
+                    continue
+                phone_start = start
+                for phone in w.get('phones', []):
+                    phone_end = phone_start + phone['duration']
+                    phones.append((item, i, phone['phone'], phone_start,
+                                   phone_end, phone['duration']))
+                    phone_start = phone_end
+
+        items = np.array(items, dtype=[
+            ('item', 'i4'), ('transcript', _text_dtype([r[1] for r in items])),
+            ('n_words', 'i4')])
+        words = np.array(words, dtype=[
+            ('item', 'i4'), ('index', 'i4'),
+            ('case', _text_dtype([r[2] for r in words])),
+            ('word', _text_dtype([r[3] for r in words])),
+            ('aligned', _text_dtype([r[4] for r in words])),
+            ('start', 'f8'), ('end', 'f8')])
+        phones = np.array(phones, dtype=[
+            ('item', 'i4'), ('word', 'i4'),
+            ('phone', _text_dtype([r[2] for r in phones])),
+            ('start', 'f8'), ('end', 'f8'), ('duration', 'f8')])
+
+        # Leaving an unchanged store alone keeps its modification time, which
+        # is what tells timing extraction that nothing needs recomputing
+        if self.exists() and _equal(items, self.items) and \
+                _equal(words, self.words) and _equal(phones, self.phones):
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        with metrics.timer('store.write'):
+            _save(words, os.path.join(self.directory, WORDS_FILE))
+            _save(phones, os.path.join(self.directory, PHONES_FILE))
+            # The items file is written last, since its presence is what
+            # marks the store as complete
+            _save(items, os.path.join(self.directory, ITEMS_FILE))
+        metrics.add_bytes('store.write', written=sum(
+            a.nbytes for a in (items, words, phones)))
+        self._items = self._words = self._phones = None
+
+    def _load(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # An empty array can't be memory-mapped
+            return np.load(path)
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = self._load(ITEMS_FILE)
+        return self._items
+
+    @property
+    def words(self):
+        if self._words is None:
+            self._words = self._load(WORDS_FILE)
+        return self._words
+
+    @property
+    def phones(self):
+        if self._phones is None:
+            self._phones = self._load(PHONES_FILE)
+        return self._phones
+
+    def timing(self, longest_sent, n_rows=None):
+        # Same layout as the timing columns of the main .csv file: a row per
+        # item (of n_rows, by default up to the last item with an alignment)
+        # and an onset and offset column per word. Rows are placed by item
+        # number, so items without an alignment are left NaN rather than
+        # shifting the ones after them.
+        words = self.words
+        if n_rows is None:
+            n_rows = int(self.items['item'].max(initial=0))
+        timing = np.full((n_rows, longest_sent * 2), np.nan)
+        rows = words['item'].astype(np.intp) - 1
+        keep = rows < n_rows
+        rows = rows[keep]
+        cols = words['index'][keep].astype(np.intp) * 2
+        timing[rows, cols] = words['start'][keep]
+        timing[rows, cols + 1] = words['end'][keep]
+        return timing
+
+    def to_gentle(self, item):
+        # Rebuilds the parts of gentle's .json output that the rest of the
+        # package uses
+        row = self.items[self.items['item'] == item]
+        if len(row) == 0:
+            return None
+        words = self.words[self.words['item'] == item]
+        phones = self.phones[self.phones['item'] == item]
+        result = {'transcript': str(row['transcript'][0]), 'words': []}
+        for w in words:
+            word = {'case': str(w['case']), 'word': str(w['word'])}
+            if word['case'] == 'success':
+                word_phones = phones[phones['word'] == w['index']]
+                word.update({
+                    'alignedWord': str(w['aligned']),
+                    'start': float(w['start']),
+                    'end': float(w['end']),
+                    'phones': [
+                        {'phone': str(ph['phone']),
+                         'duration': float(ph['duration'])}
+                        for ph in word_phones]})
+            result['words'].append(word)
+        return result
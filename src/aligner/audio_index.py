@@ -0,0 +1,173 @@
+import os
+import struct
+import logging
+from .utils import load_json, dump_json_atomic
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.audio_index.json'
+
+# Indexed by [version][layer] where version is 0 for MPEG-1 and 1 for
+# MPEG-2/2.5, and layer is 0 for Layer I, 1 for Layer II and 2 for Layer III
+_BITRATES = [
+    [[0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+     [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+     [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]],
+    [[0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+     [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+     [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]]]
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000],
+                 0: [11025, 12000, 8000]}
+
+
+def _skip_id3v2(f):
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        # Bit 4 of the flags signals a footer after the tag
+        footer = 10 if header[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def mp3_header_info(mp3_file):
+    # Reads the duration, channel count and sample rate of an .mp3 file from
+    # its first frame header and the Xing/Info and LAME tags that follow it,
+    # without decoding any audio
+    file_size = os.path.getsize(mp3_file)
+    with open(mp3_file, 'rb') as f:
+        start = _skip_id3v2(f)
+        f.seek(start)
+        buf = f.read(4096)
+
+    for pos in range(len(buf) - 4):
+        if buf[pos] != 0xff or buf[pos + 1] & 0xe0 != 0xe0:
+            continue
+        header = struct.unpack('>I', buf[pos:pos + 4])[0]
+        version_bits = (header >> 19) & 0x3
+        layer_bits = (header >> 17) & 0x3
+        bitrate_idx = (header >> 12) & 0xf
+        sample_rate_idx = (header >> 10) & 0x3
+        if (version_bits == 1 or layer_bits == 0 or bitrate_idx in (0, 15)
+                or sample_rate_idx == 3):
+            continue
+        break
+    else:
+        raise ValueError(f'No MPEG audio frame found in {mp3_file}')
+
+    mpeg1 = version_bits == 3
+    layer = 3 - layer_bits
+    bitrate = _BITRATES[0 if mpeg1 else 1][layer][bitrate_idx] * 1000
+    sample_rate = _SAMPLE_RATES[version_bits][sample_rate_idx]
+    channels = 1 if (header >> 6) & 0x3 == 3 else 2
+    if layer == 0:
+        samples_per_frame = 384
+    elif layer == 1 or mpeg1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+
+    side_info = (32 if channels == 2 else 17) if mpeg1 else \
+        (17 if channels == 2 else 9)
+    xing = pos + 4 + side_info
+    duration = None
+    if buf[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', buf[xing + 4:xing + 8])[0]
+        offset = xing + 8
+        frames = None
+        if flags & 0x1:
+            frames = struct.unpack('>I', buf[offset:offset + 4])[0]
+            offset += 4
+        if flags & 0x2:
+            offset += 4
+        if flags & 0x4:
+            offset += 100
+        if flags & 0x8:
+            offset += 4
+        if frames is not None:
+            samples = frames * samples_per_frame
+            # The LAME tag (which ffmpeg also writes, under its own name)
+            # records how many samples of encoder delay and padding were
+            # added, which decoders drop again
+            if buf[offset:offset + 4] in (b'LAME', b'Lavf', b'Lavc'):
+                delay_padding = buf[offset + 21:offset + 24]
+                delay = (delay_padding[0] << 4) | (delay_padding[1] >> 4)
+                padding = ((delay_padding[1] & 0xf) << 8) | delay_padding[2]
+                samples -= delay + padding
+            duration = samples / sample_rate
+
+    if duration is None:
+        # No frame count to go by, so assume a constant bitrate
+        duration = (file_size - start - pos) * 8 / bitrate
+
+    return {'duration': duration, 'channels': channels,
+            'sample_rate': sample_rate}
+
+
+def _probe(mp3_file):
+    try:
+        return mp3_header_info(mp3_file)
+    except (ValueError, IndexError, struct.error):
+        from pydub.utils import mediainfo
+        info = mediainfo(mp3_file)
+        return {'duration': float(info['duration']),
+                'channels': int(info['channels']),
+                'sample_rate': int(info['sample_rate'])}
+
+
+class AudioIndex:
+    def __init__(self, directory):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_FILE)
+        self.entries = load_json(self.path, {})
+        self.dirty = False
+
+    def get(self, filename):
+        stat = os.stat(os.path.join(self.directory, filename))
+        entry = self.entries.get(filename)
+        if (entry is None or entry['size'] != stat.st_size or
+                entry['mtime_ns'] != stat.st_mtime_ns):
+            entry = self.record(filename)
+        return entry
+
+    def refresh(self, extension='.mp3'):
+        # Probes every file in the directory that isn't indexed yet or has
+        # changed since it was, in one pass
+        if not os.path.isdir(self.directory):
+            return
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(extension):
+                    continue
+                stat = entry.stat()
+                indexed = self.entries.get(entry.name)
+                if (indexed is None or indexed['size'] != stat.st_size or
+                        indexed['mtime_ns'] != stat.st_mtime_ns):
+                    try:
+                        self.record(entry.name)
+                    except (KeyError, ValueError):
+                        self.logger.warning(
+                            'Could not probe %(f)s. Skipping.' %
+                            {'f': entry.path})
+
+    def record(self, filename, info=None):
+        mp3_file = os.path.join(self.directory, filename)
+        if info is None:
+            info = _probe(mp3_file)
+            self.logger.debug(
+                'Probed %(f)s: %(info)s' % {'f': mp3_file, 'info': info})
+        stat = os.stat(mp3_file)
+        entry = dict(info, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        self.entries[filename] = entry
+        self.dirty = True
+        return entry
+
+    def save(self):
+        if self.dirty:
+            dump_json_atomic(self.entries, self.path, indent=2,
+                             sort_keys=True)
+            self.dirty = False
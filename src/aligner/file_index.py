@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import logging
+import threading
+from .utils import load_json, dump_json_atomic
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.file_index.json'
+RACY_NS = 2 * 10 ** 9
+
+# How each kind of file is named in its participant's directory, and the
+# directory (by role) that it lives under
+NAMES = {
+    'mp3': ('mp3', 'item_number_{:02}.mp3', r'^item_number_(\d+)\.mp3$'),
+    'textgrid': ('mp3', 'item_number_{:02}.TextGrid',
+                 r'^item_number_(\d+)\.TextGrid$'),
+    'transcript': ('transcriptions', '{:02}.txt', r'^(\d+)\.txt$'),
+    'alignment': ('gentle', '{:02}.json', r'^(\d+)\.json$')}
+
+
+class DirectoryIndex:
+    # Indexes the files in each participant's subdirectory of root by kind
+    # and item number, along with their sizes and mtimes. A participant's
+    # directory is only listed again when its own mtime has changed, which
+    # happens whenever a file in it is created, removed or replaced, so an
+    # unchanged study costs one stat per participant instead of a full
+    # directory walk.
+    def __init__(self, root, kinds):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.root = root
+        self.kinds = {kind: re.compile(NAMES[kind][2]) for kind in kinds}
+        self.path = os.path.join(root, INDEX_FILE)
+        saved = load_json(self.path, {})
+        self.dirs = saved.get('dirs', {})
+        self.files = saved.get('files', {})
+        self.items = {}
+        for p in self.files:
+            self._index(p)
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _index(self, p):
+        items = self.items[p] = {kind: {} for kind in self.kinds}
+        for name in self.files[p]:
+            for kind, pattern in self.kinds.items():
+                match = pattern.match(name)
+                if match:
+                    items[kind][int(match.group(1))] = name
+
+    def refresh(self):
+        if not os.path.isdir(self.root):
+            return
+        with self.lock:
+            seen = set()
+            with os.scandir(self.root) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_dir():
+                        continue
+                    seen.add(entry.name)
+                    mtime_ns = entry.stat().st_mtime_ns
+                    if self.dirs.get(entry.name) != mtime_ns or \
+                            entry.name not in self.files:
+                        self._scan(entry.name, entry.path)
+                        # A directory changed within the last couple of
+                        # seconds could change again without its mtime
+                        # moving on coarse-grained filesystems, so it's
+                        # listed again next time
+                        racy = time.time_ns() - mtime_ns < RACY_NS
+                        self.dirs[entry.name] = None if racy else mtime_ns
+                        self.dirty = True
+            for p in set(self.files) - seen:
+                del self.files[p], self.items[p]
+                self.dirs.pop(p, None)
+                self.dirty = True
+
+    def _scan(self, p, directory):
+        self.logger.debug('Listing %(dir)s' % {'dir': directory})
+        files = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if any(pattern.match(entry.name)
+                       for pattern in self.kinds.values()):
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+        self.files[p] = files
+        self._index(p)
+
+    def participants(self):
+        with self.lock:
+            return sorted(self.files)
+
+    def get(self, p, item, kind):
+        name = self.items.get(p, {}).get(kind, {}).get(item)
+        if name is None:
+            return None
+        size, mtime_ns = self.files[p][name]
+        return {'name': name, 'path': os.path.join(self.root, p, name),
+                'size': size, 'mtime_ns': mtime_ns}
+
+    def numbers(self, p, kind):
+        with self.lock:
+            return sorted(self.items.get(p, {}).get(kind, {}))
+
+    def record(self, p, item, kind):
+        # Picks up a file that was just written (or removed) without waiting
+        # for the next refresh
+        name = NAMES[kind][1].format(item)
+        path = os.path.join(self.root, p, name)
+        with self.lock:
+            if p not in self.files:
+                self.files[p] = {}
+                self.items[p] = {k: {} for k in self.kinds}
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.files[p].pop(name, None)
+                self.items[p][kind].pop(item, None)
+            else:
+                self.files[p][name] = [stat.st_size, stat.st_mtime_ns]
+                self.items[p][kind][item] = name
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if self.dirty and os.path.isdir(self.root):
+                dump_json_atomic({'dirs': self.dirs, 'files': self.files},
+                                 self.path, sort_keys=True)
+                self.dirty = False
+
+
+class FileIndex:
+    # Every tool's view of the study's files, keyed by participant and item
+    # number: the .mp3 file and TextGrid file, the transcription file and
+    # the alignment file for each item, for whichever of the directories
+    # the tool knows about
+    def __init__(self, mp3_dir=None, transcriptions_dir=None,
+                 gentle_dir=None):
+        roots = {'mp3': mp3_dir, 'transcriptions': transcriptions_dir,
+                 'gentle': gentle_dir}
+        self.indexes = {}
+        for role, root in roots.items():
+            if root is None:
+                continue
+            index = DirectoryIndex(
+                root, [kind for kind, (r, _, _) in NAMES.items()
+                       if r == role])
+            for kind in index.kinds:
+                self.indexes[kind] = index
+
+    def _unique(self):
+        return list({id(index): index
+                     for index in self.indexes.values()}.values())
+
+    def refresh(self):
+        for index in self._unique():
+            index.refresh()
+        return self
+
+    def save(self):
+        for index in self._unique():
+            index.save()
+
+    def participants(self, kind):
+        return self.indexes[kind].participants()
+
+    def numbers(self, p, kind):
+        return self.indexes[kind].numbers(str(p), kind)
+
+    def get(self, p, item, kind):
+        return self.indexes[kind].get(str(p), int(item), kind)
+
+    def has(self, p, item, kind):
+        return self.get(p, item, kind) is not None
+
+    def names(self, p, kind):
+        index = self.indexes[kind]
+        return [index.get(str(p), n, kind)['name']
+                for n in index.numbers(str(p), kind)]
+
+    def record(self, p, item, kind):
+        if kind in self.indexes:
+            self.indexes[kind].record(str(p), int(item), kind)
+
+    def gaps(self, p, kinds):
+        # Item numbers that have some but not all of the given kinds of
+        # file, with the kinds each one is missing
+        present = {kind: set(self.numbers(p, kind)) for kind in kinds}
+        gaps = {}
+        for n in sorted(set().union(*present.values())):
+            missing = [kind for kind in kinds if n not in present[kind]]
+            if missing:
+                gaps[n] = missing
+        return gaps
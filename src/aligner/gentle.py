@@ -0,0 +1,215 @@
+import os
+import time
+import logging
+import threading
+from .metrics import metrics
+from .utils import lazy_import
+
+requests = lazy_import('requests')
+
+
+logger = logging.getLogger(__name__)
+
+
+class GentleError(Exception):
+    pass
+
+
+class GentleClient:
+    def __init__(self, url='http://localhost:8765', timeout=300, retries=3,
+                 backoff=1.0):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # One session per thread, so that each thread keeps its own
+        # connection to the aligner alive between requests
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def close(self):
+        if hasattr(self.local, 'session'):
+            self.local.session.close()
+
+    def align(self, audio_file, transcript, audio=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.align_once(audio_file, transcript, audio)
+            except (requests.RequestException, GentleError) as e:
+                if attempt == self.retries:
+                    raise GentleError(
+                        f'Failed to align {audio_file} after '
+                        f'{attempt + 1} attempt(s): {e}') from e
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning(
+                    'Aligning %(f)s failed (%(e)s). Retrying in %(d)s '
+                    'second(s).' % {'f': audio_file, 'e': e, 'd': delay})
+                metrics.count('gentle.retry')
+                time.sleep(delay)
+
+    def align_once(self, audio_file, transcript, audio=None):
+        # The audio is read from audio_file unless its content is passed in
+        # as audio, in which case audio_file only names it
+        transcript = transcript.encode('utf-8')
+        if audio is None:
+            with open(audio_file, 'rb') as f:
+                audio = f.read()
+        with metrics.timer('gentle.request'):
+            response = self.session.post(
+                f'{self.url}/transcriptions',
+                params={'async': 'false'},
+                files={
+                    'audio': (os.path.basename(audio_file), audio),
+                    'transcript': ('transcript.txt', transcript)},
+                timeout=self.timeout)
+        metrics.add_bytes(
+            'gentle.request', read=len(response.content),
+            written=len(audio) + len(transcript))
+        response.raise_for_status()
+        try:
+            result = response.json()
+        except ValueError as e:
+            raise GentleError(f'Response is not JSON: {e}') from e
+        if not isinstance(result, dict) or 'words' not in result:
+            raise GentleError('Response has no word alignments')
+        return result
+
+
+class _Endpoint:
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.failures = 0
+        self.latency = None
+        self.unhealthy_until = 0.0
+
+
+class GentlePool:
+    def __init__(self, urls, timeout=300, retries=3, backoff=1.0,
+                 max_failures=3, cooldown=30.0, slow_factor=3.0,
+                 health_interval=15.0):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.endpoints = [
+            _Endpoint(GentleClient(url, timeout, retries=0)) for url in urls]
+        self.retries = retries
+        self.backoff = backoff
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.slow_factor = slow_factor
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.health_thread = None
+
+    def align(self, audio_file, transcript, audio=None):
+        self._start_health_checks()
+        for attempt in range(self.retries + 1):
+            endpoint = self._acquire()
+            start = time.monotonic()
+            try:
+                result = endpoint.client.align_once(
+                    audio_file, transcript, audio)
+            except (requests.RequestException, GentleError) as e:
+                self._release(endpoint, success=False)
+                if attempt == self.retries:
+                    raise GentleError(
+                        f'Failed to align {audio_file} after '
+                        f'{attempt + 1} attempt(s): {e}') from e
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning(
+                    'Aligning %(f)s with %(url)s failed (%(e)s). Retrying in '
+                    '%(d)s second(s).' %
+                    {'f': audio_file, 'url': endpoint.client.url, 'e': e,
+                     'd': delay})
+                metrics.count('gentle.retry')
+                time.sleep(delay)
+            else:
+                self._release(
+                    endpoint, success=True, latency=time.monotonic() - start)
+                return result
+
+    def close(self):
+        self.stopped.set()
+
+    def _acquire(self):
+        # Least-outstanding-requests scheduling over the endpoints that are
+        # neither failing nor much slower than the fastest one
+        with self.lock:
+            now = time.monotonic()
+            healthy = [e for e in self.endpoints if e.unhealthy_until <= now]
+            if not healthy:
+                # Everything is marked as failing, so give the endpoint that
+                # has been out of rotation the longest another chance
+                healthy = [min(self.endpoints,
+                               key=lambda e: e.unhealthy_until)]
+            latencies = [e.latency for e in healthy if e.latency is not None]
+            if latencies:
+                fastest = min(latencies)
+                fast = [e for e in healthy if e.latency is None or
+                        e.latency <= fastest * self.slow_factor]
+                healthy = fast or healthy
+            endpoint = min(healthy, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint, success, latency=None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.failures = 0
+                # Latencies are smoothed so that one slow file doesn't take
+                # an endpoint out of rotation
+                endpoint.latency = latency if endpoint.latency is None else \
+                    0.8 * endpoint.latency + 0.2 * latency
+            else:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    self._mark_unhealthy(endpoint)
+
+    def _mark_unhealthy(self, endpoint):
+        endpoint.unhealthy_until = time.monotonic() + self.cooldown
+        self.logger.warning(
+            'Taking %(url)s out of rotation for %(s)s second(s).' %
+            {'url': endpoint.client.url, 's': self.cooldown})
+
+    def _start_health_checks(self):
+        with self.lock:
+            if self.health_thread is not None or len(self.endpoints) < 2:
+                return
+            self.health_thread = threading.Thread(
+                target=self._check_health, daemon=True)
+            self.health_thread.start()
+
+    def _check_health(self):
+        session = requests.Session()
+        while not self.stopped.wait(self.health_interval):
+            for endpoint in self.endpoints:
+                try:
+                    session.get(endpoint.client.url, timeout=5)\
+                           .raise_for_status()
+                except requests.RequestException:
+                    with self.lock:
+                        self._mark_unhealthy(endpoint)
+                else:
+                    with self.lock:
+                        if endpoint.unhealthy_until > time.monotonic():
+                            self.logger.info(
+                                'Putting %(url)s back into rotation.' %
+                                {'url': endpoint.client.url})
+                        endpoint.unhealthy_until = 0.0
+                        endpoint.failures = 0
+                        # An endpoint that was left out for being slow gets
+                        # no traffic to show that it has recovered, so forget
+                        # its latency and let it be measured again
+                        latencies = [e.latency for e in self.endpoints
+                                     if e.latency is not None]
+                        if (endpoint.latency is not None and
+                                endpoint.latency >
+                                min(latencies) * self.slow_factor):
+                            endpoint.latency = None
@@ -0,0 +1,233 @@
+import os
+import time
+import json
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 120.0, 300.0, float('inf'))
+
+
+def _quantile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics:
+    # Per-stage timings, byte counts and event counters for a single run.
+    # Like logging, there's one registry per process that every module
+    # reports to, and the CLIs write it out at the end of the run.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.profile_dir = None
+            self.profiles = {}
+            self.started = time.time()
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {
+                'durations': [], 'first': None, 'last': None,
+                'bytes_read': 0, 'bytes_written': 0}
+        return self.stages[stage]
+
+    @contextmanager
+    def timer(self, stage):
+        profile = self._start_profile()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._stop_profile(stage, profile)
+            self.observe(stage, end - start, start)
+
+    def observe(self, stage, seconds, start=None):
+        end = time.perf_counter()
+        start = end - seconds if start is None else start
+        with self.lock:
+            s = self._stage(stage)
+            s['durations'].append(seconds)
+            s['first'] = start if s['first'] is None else min(
+                s['first'], start)
+            s['last'] = end if s['last'] is None else max(s['last'], end)
+
+    def add_bytes(self, stage, read=0, written=0):
+        with self.lock:
+            s = self._stage(stage)
+            s['bytes_read'] += read
+            s['bytes_written'] += written
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def enable_profiling(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir
+
+    def _start_profile(self):
+        # Only the outermost timer in a thread profiles, since a thread can
+        # only have one profiler running at a time
+        if self.profile_dir is None or getattr(self.local, 'active', False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            return None
+        self.local.active = True
+        return profile
+
+    def _stop_profile(self, stage, profile):
+        if profile is None:
+            return
+        profile.disable()
+        self.local.active = False
+        with self.lock:
+            if stage in self.profiles:
+                self.profiles[stage].add(profile)
+            else:
+                self.profiles[stage] = pstats.Stats(profile)
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage, s in sorted(self.stages.items()):
+                durations = s['durations']
+                n = len(durations)
+                wall = (s['last'] - s['first']) if n else 0.0
+                stages[stage] = {
+                    'count': n,
+                    'total_seconds': sum(durations),
+                    'mean_seconds': sum(durations) / n if n else None,
+                    'p50_seconds': _quantile(durations, 0.5),
+                    'p90_seconds': _quantile(durations, 0.9),
+                    'p99_seconds': _quantile(durations, 0.99),
+                    'max_seconds': max(durations) if n else None,
+                    'items_per_second': n / wall if wall > 0 else None,
+                    'bytes_read': s['bytes_read'],
+                    'bytes_written': s['bytes_written'],
+                    'histogram': [
+                        [le if le != float('inf') else '+Inf',
+                         sum(1 for d in durations if d <= le)]
+                        for le in BUCKETS]}
+            return {'started': self.started,
+                    'wall_seconds': time.time() - self.started,
+                    'stages': stages,
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def to_prometheus(self):
+        summary = self.summary()
+        lines = [
+            '# HELP aligner_stage_seconds Time spent on each item in a '
+            'stage.',
+            '# TYPE aligner_stage_seconds histogram']
+        for stage, s in summary['stages'].items():
+            for le, n in s['histogram']:
+                lines.append(
+                    f'aligner_stage_seconds_bucket{{stage="{stage}",'
+                    f'le="{le}"}} {n}')
+            lines.append(
+                f'aligner_stage_seconds_sum{{stage="{stage}"}} '
+                f'{s["total_seconds"]}')
+            lines.append(
+                f'aligner_stage_seconds_count{{stage="{stage}"}} '
+                f'{s["count"]}')
+        for name, help_ in (('bytes_read', 'Bytes read by each stage.'),
+                            ('bytes_written',
+                             'Bytes written by each stage.')):
+            lines.append(f'# HELP aligner_{name}_total {help_}')
+            lines.append(f'# TYPE aligner_{name}_total counter')
+            for stage, s in summary['stages'].items():
+                lines.append(
+                    f'aligner_{name}_total{{stage="{stage}"}} {s[name]}')
+        lines.append('# HELP aligner_items_per_second Items processed per '
+                     'second of wall time in each stage.')
+        lines.append('# TYPE aligner_items_per_second gauge')
+        for stage, s in summary['stages'].items():
+            if s['items_per_second'] is not None:
+                lines.append(
+                    f'aligner_items_per_second{{stage="{stage}"}} '
+                    f'{s["items_per_second"]}')
+        lines.append('# HELP aligner_events_total Number of times each event '
+                     'happened.')
+        lines.append('# TYPE aligner_events_total counter')
+        for name, n in summary['counters'].items():
+            lines.append(f'aligner_events_total{{event="{name}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, fmt=None):
+        # Written to a temporary file and renamed, so that a collector
+        # reading the directory never sees half a file
+        if fmt is None:
+            fmt = 'prometheus' if path.endswith('.prom') else 'json'
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            if fmt == 'prometheus':
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2)
+        os.replace(tmp, path)
+
+    def dump_profiles(self):
+        if self.profile_dir is None:
+            return
+        with self.lock:
+            for stage, stats in self.profiles.items():
+                stats.dump_stats(
+                    os.path.join(self.profile_dir, stage + '.prof'))
+
+
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        '--metrics-out', type=str, default=None,
+        help='Path to which to write timings, throughput and byte counts for '
+        'each stage at the end of the run. Not written by default.',
+        dest='metrics_out')
+
+    parser.add_argument(
+        '--metrics-format', type=str, default=None,
+        choices=['json', 'prometheus'],
+        help='Format of the --metrics-out file: a JSON summary or a '
+        'Prometheus textfile (default is prometheus if the file name ends in'
+        ' .prom, and json otherwise).',
+        dest='metrics_format')
+
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help='Path to a directory in which to write cProfile output for each'
+        ' stage (one .prof file per stage, which can be read with pstats or '
+        'snakeviz). Not profiled by default.',
+        dest='profile')
+
+
+@contextmanager
+def report_metrics(args):
+    # Collects metrics for the duration of a CLI run and writes them out
+    # at the end, even if the run fails partway through
+    metrics.reset()
+    if args.profile is not None:
+        metrics.enable_profiling(args.profile)
+    try:
+        yield metrics
+    finally:
+        if args.metrics_out is not None:
+            metrics.write(args.metrics_out, args.metrics_format)
+        metrics.dump_profiles()
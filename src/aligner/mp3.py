@@ -1,33 +1,195 @@
 import os
+import time
+import shutil
+import subprocess
+import tempfile
 import logging
 import logging.config
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from zipfile import ZipFile
-from pydub import AudioSegment
+from .utils import load_json, dump_json_atomic, file_lock, lazy_import
+from .audio_index import AudioIndex
+from .file_index import FileIndex
+from .metrics import metrics
+
+pd = lazy_import('pandas')
+pydub = lazy_import('pydub')
 
 
 logger = logging.getLogger(__name__)
 
+ENCODER_SETTINGS = {'format': 'mp3', 'codec': 'libmp3lame', 'bitrate': '128k'}
+
+
+def _trim_to_mp3(webm_file, start_seconds, mp3_name, wav_name=None):
+    # Passing -ss before -i makes ffmpeg seek in the input instead of
+    # decoding and discarding everything before the start offset, and the
+    # rest of the recording is streamed straight into the encoder
+    outputs = [mp3_name]
+    command = [
+        pydub.AudioSegment.converter, '-y', '-v', 'error',
+        '-ss', f'{start_seconds:.3f}', '-i', webm_file,
+        '-vn', '-acodec', ENCODER_SETTINGS['codec'],
+        '-b:a', ENCODER_SETTINGS['bitrate'], '-f', ENCODER_SETTINGS['format'],
+        mp3_name + '.part']
+    if wav_name is not None:
+        # The same decoded samples also go to the PCM cache, so that later
+        # stages don't have to decode the .mp3 file again
+        outputs.append(wav_name)
+        command.extend([
+            '-vn', '-acodec', 'pcm_s16le', '-f', 'wav', wav_name + '.part'])
+    proc = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        for output in outputs:
+            if os.path.exists(output + '.part'):
+                os.remove(output + '.part')
+        raise pydub.exceptions.CouldntEncodeError(
+            'ffmpeg returned error code %(code)s:\n%(err)s' %
+            {'code': proc.returncode,
+             'err': proc.stderr.decode('utf-8', errors='replace')})
+    for output in outputs:
+        os.replace(output + '.part', output)
+
+
+def _convert_item(unit):
+    # The member is copied (not decoded) to a temporary file so that ffmpeg
+    # can seek in it, which it can't do when reading from a pipe
+    with ZipFile(unit['archive']) as z:
+        with z.open(unit['webm']) as webm, \
+                tempfile.NamedTemporaryFile(suffix='.webm') as tmp:
+            shutil.copyfileobj(webm, tmp)
+            tmp.flush()
+            _trim_to_mp3(tmp.name, unit['start_time'] / 1000, unit['mp3'],
+                         unit.get('wav'))
+
+
+def _run_unit(unit):
+    # Units may run in another process, so the time each one took is sent
+    # back with its result instead of being recorded here
+    result = dict(unit)
+    start = time.perf_counter()
+    try:
+        _convert_item(unit)
+        result['status'] = 'converted'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class ConversionManifest:
+    def __init__(self, mp3_dir):
+        self.mp3_dir = mp3_dir
+        self.path = os.path.normpath(mp3_dir) + '.manifest.json'
+        self.entries = load_json(self.path, {})
+        self.changed = {}
+
+    def key(self, mp3_name):
+        return os.path.relpath(mp3_name, self.mp3_dir).replace(os.sep, '/')
+
+    def is_current(self, mp3_name, entry, size=None):
+        recorded = self.entries.get(self.key(mp3_name))
+        if recorded is None:
+            return False
+        if size is None:
+            if not os.path.exists(mp3_name):
+                return False
+            size = os.path.getsize(mp3_name)
+        if size != recorded.get('mp3_size'):
+            return False
+        return all(recorded.get(k) == v for k, v in entry.items())
+
+    def record(self, mp3_name, entry):
+        key = self.key(mp3_name)
+        self.entries[key] = self.changed[key] = dict(
+            entry, mp3_size=os.path.getsize(mp3_name))
+
+    def save(self):
+        # Only this converter's own changes are merged into the manifest on
+        # disk, since workers on other machines may have recorded theirs in
+        # the meantime
+        with file_lock(self.path):
+            entries = load_json(self.path, {})
+            entries.update(self.changed)
+            dump_json_atomic(entries, self.path, indent=2, sort_keys=True)
+        self.entries = entries
+        self.changed = {}
+
 
 class WebmToMp3Converter:
-    def __init__(self, tidy_csv, mp3_dir, zip_dir, overwrite):
+    def __init__(self, tidy_csv, mp3_dir, zip_dir, overwrite, jobs=1,
+                 force=False, pcm_cache=None, state=None, files=None):
         self.logger = logger.getChild(self.__class__.__name__)
         self.tidy_csv = tidy_csv
         self.mp3_dir = mp3_dir
         self.zip_dir = zip_dir
         self.overwrite = overwrite
+        self.jobs = jobs
+        self.force = force
+        self.manifest = ConversionManifest(mp3_dir)
+        self.pcm_cache = pcm_cache
+        self.state = state
+        self.files = files if files is not None else FileIndex(mp3_dir)
+        self.audio_indexes = {}
 
     def convert_to_mp3(self):
-        df = pd.read_csv(self.tidy_csv)
+        try:
+            results = self._convert_to_mp3()
+        finally:
+            self._finish()
+        return results
+
+    def _finish(self):
+        self.manifest.save()
+        self.files.save()
+        self.logger.debug('Saved conversion manifest:\n%(f)s' %
+                          {'f': self.manifest.path})
+        for index in self.audio_indexes.values():
+            index.save()
+        if self.pcm_cache is not None:
+            self.pcm_cache.evict()
+
+    def _convert_to_mp3(self):
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.tidy_csv)
+        metrics.add_bytes('csv.read', read=os.path.getsize(self.tidy_csv))
+        if self.state is not None:
+            self.state.add_rows(df)
+        self.files.refresh()
         groupings = df.groupby('Participant')
-        for p, grp_df in groupings:
-            self.logger.info('Working on data for participant %(p)s.' %
-                             {'p': p})
-            self.convert_and_cut(grp_df, self.mp3_dir, self.zip_dir)
+        if self.jobs > 1:
+            units = []
+            results = []
+            for p, grp_df in groupings:
+                self.logger.info('Planning work for participant %(p)s.' %
+                                 {'p': p})
+                results.extend(self._plan(grp_df, self.mp3_dir, self.zip_dir,
+                                          units))
+            results.extend(self._run_parallel(units))
+        else:
+            results = []
+            for p, grp_df in groupings:
+                self.logger.info('Working on data for participant %(p)s.' %
+                                 {'p': p})
+                results.extend(
+                    self.convert_and_cut(grp_df, self.mp3_dir, self.zip_dir))
+        self._log_summary(results)
+        return results
 
     def convert_and_cut(self, grp_df, mp3_dir, zip_dir):
-        mp3_dir = os.path.join(
-            mp3_dir, str(grp_df['Participant'].unique()[0]))
+        units = []
+        results = self._plan(grp_df, mp3_dir, zip_dir, units)
+        for unit in units:
+            results.append(self._log_result(_run_unit(unit)))
+        return results
+
+    def _plan(self, grp_df, mp3_dir, zip_dir, units):
+        # Appends the work units that need converting to units and returns
+        # the results for the items that don't
+        p = grp_df['Participant'].unique()[0]
+        mp3_dir = os.path.join(mp3_dir, str(p))
         if not os.path.exists(mp3_dir):
             self.logger.info(
                 'Creating individual directory for participant\'s .mp3 files:'
@@ -35,52 +197,179 @@ class WebmToMp3Converter:
                 {'mp3_dir': mp3_dir})
             os.makedirs(mp3_dir)
 
+        if self.pcm_cache is not None:
+            os.makedirs(
+                os.path.join(self.pcm_cache.cache_dir, str(p)), exist_ok=True)
+
         zf = os.path.join(zip_dir, grp_df['RecordingsArchive'].unique()[0])
+        results = []
+
+        try:
+            with ZipFile(zf) as z:
+                members = {info.filename: info for info in z.infolist()}
+        except FileNotFoundError:
+            self.logger.warning(
+                'Archive file %(zf)s for participant not found. Skipping' %
+                {'zf': zf})
+            for i, file_ in enumerate(grp_df['WebmFileName']):
+                results.append({
+                    'participant': p, 'item': i + 1, 'archive': zf,
+                    'webm': file_, 'status': 'missing'})
+            self._record_statuses(p, results)
+            return results
+
+        for i, file_ in enumerate(grp_df['WebmFileName']):
+            seconds = grp_df[grp_df['WebmFileName'] == file_][
+                'SecondsToStripFromFrontOfRecording'].iloc[0]
+            unit, status = self._plan_item(
+                p, i + 1, file_, seconds, zf, members, mp3_dir)
+            if status is None:
+                units.append(unit)
+            else:
+                results.append(dict(unit, status=status))
+
+        self._record_statuses(p, results)
+        return results
+
+    def _plan_item(self, p, item, file_, seconds, zf, members, mp3_dir):
+        # Returns the item's work unit, along with its status if it doesn't
+        # need converting (or can't be converted)
+        mp3_name = os.path.join(
+            mp3_dir,
+            'item_number_' + str(item).zfill(2) + '.mp3')
+        start_time = float(seconds * 1000) + 500
+        unit = {'participant': p, 'item': item, 'archive': zf,
+                'webm': file_, 'mp3': mp3_name, 'start_time': start_time}
+
+        if file_ not in members:
+            self.logger.warning(
+                'File %(webm)s not found in archive %(zf)s. Skipping.' %
+                {'webm': file_, 'zf': zf})
+            return unit, 'missing'
+
+        # Everything that determines the contents of the .mp3 file, so
+        # that a rerun only redoes items whose inputs actually changed
+        unit['manifest_entry'] = {
+            'archive': os.path.basename(zf),
+            'webm': file_,
+            'crc': members[file_].CRC,
+            'webm_size': members[file_].file_size,
+            'start_time': start_time,
+            'encoder': ENCODER_SETTINGS}
+
+        indexed = self.files.get(p, item, 'mp3')
+        if indexed is not None and not self.overwrite:
+            self.logger.info(
+                'The .mp3 file, %(mp3_name)s, already exists. '
+                'Skipping.' % {'mp3_name': mp3_name})
+            return unit, 'skipped'
+
+        elif not self.force and indexed is not None and \
+                self.manifest.is_current(
+                    mp3_name, unit['manifest_entry'], indexed['size']):
+            self.logger.info(
+                'The .mp3 file, %(mp3_name)s, is up to date. '
+                'Skipping.' % {'mp3_name': mp3_name})
+            return unit, 'unchanged'
+
+        elif indexed is not None and self.overwrite:
+            self.logger.info(
+                'The .mp3 file, %(mp3_name)s, already exists. '
+                'Overwriting.' % {'mp3_name': mp3_name})
 
+        if self.pcm_cache is not None:
+            unit['wav'], _ = self.pcm_cache.paths(p, item)
+
+        return unit, None
+
+    def _plan_one(self, p, item, row):
+        # Plans a single item from its row in the .csv file, for workers
+        # that are handed the study an item at a time
+        mp3_dir = os.path.join(self.mp3_dir, str(p))
+        os.makedirs(mp3_dir, exist_ok=True)
+        if self.pcm_cache is not None:
+            os.makedirs(
+                os.path.join(self.pcm_cache.cache_dir, str(p)), exist_ok=True)
+
+        zf = os.path.join(self.zip_dir, row['RecordingsArchive'])
         try:
             with ZipFile(zf) as z:
-                self.logger.info(
-                    'Opened zip file:\n%(zf)s' %
-                    {'zf': zf})
-                for i, file_ in enumerate(grp_df['WebmFileName']):
-
-                    mp3_name = os.path.join(
-                        mp3_dir,
-                        'item_number_' + str(i + 1).zfill(2) + '.mp3')
-
-                    if os.path.exists(mp3_name) and not self.overwrite:
-                        self.logger.info(
-                            'The .mp3 file, %(mp3_name)s, already exists. '
-                            'Skipping.' % {'mp3_name': mp3_name})
-
-                    elif os.path.exists(mp3_name) and self.overwrite:
-                        self.logger.info(
-                            'The .mp3 file, %(mp3_name)s, already exists. '
-                            'Overwriting.' % {'mp3_name': mp3_name})
-
-                    if not os.path.exists(mp3_name) or self.overwrite:
-                        start_time = float(
-                            grp_df[grp_df['WebmFileName'] == file_]
-                            ['SecondsToStripFromFrontOfRecording'] *
-                            1000) + 500
-                        with z.open(file_) as webm:
-                            sound = AudioSegment.from_file(webm)
-                            extracted_sound = sound[start_time:]
-                            extracted_sound.export(mp3_name, format='mp3')
-                            self.logger.info('Saved .mp3 file:\n%(mp3_name)s' %
-                                             {'mp3_name': mp3_name})
+                members = {info.filename: info for info in z.infolist()}
         except FileNotFoundError:
             self.logger.warning(
                 'Archive file %(zf)s for participant not found. Skipping' %
                 {'zf': zf})
+            return ({'participant': p, 'item': item, 'archive': zf,
+                     'webm': row['WebmFileName']}, 'missing')
+        return self._plan_item(
+            p, item, row['WebmFileName'],
+            row['SecondsToStripFromFrontOfRecording'], zf, members, mp3_dir)
+
+    def _record_statuses(self, p, results):
+        if self.state is not None:
+            self.state.set_statuses(
+                p, 'convert', {r['item']: r['status'] for r in results})
+
+    def _run_parallel(self, units):
+        results = [None] * len(units)
+        self.logger.info(
+            'Converting %(n)s .webm file(s) with %(jobs)s worker processes.' %
+            {'n': len(units), 'jobs': self.jobs})
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(_run_unit, unit): n
+                       for n, unit in enumerate(units)}
+            for future in as_completed(futures):
+                results[futures[future]] = self._log_result(future.result())
+        return results
+
+    def _log_result(self, result):
+        metrics.observe('convert', result['seconds'])
+        if self.state is not None:
+            self.state.set_status(
+                result['participant'], result['item'], 'convert',
+                result['status'])
+        if result['status'] == 'converted':
+            metrics.add_bytes(
+                'convert', read=result['manifest_entry']['webm_size'],
+                written=sum(os.path.getsize(f) for f in
+                            (result['mp3'], result.get('wav')) if f))
+            self.manifest.record(result['mp3'], result['manifest_entry'])
+            self.files.record(result['participant'], result['item'], 'mp3')
+            # Record the duration now, while it's cheap, so that later
+            # stages never have to decode the .mp3 file just to get it
+            mp3_dir, mp3_name = os.path.split(result['mp3'])
+            if mp3_dir not in self.audio_indexes:
+                self.audio_indexes[mp3_dir] = AudioIndex(mp3_dir)
+            self.audio_indexes[mp3_dir].record(mp3_name)
+            if self.pcm_cache is not None:
+                self.pcm_cache.record(
+                    result['participant'], result['item'], result['mp3'])
+            self.logger.info('Saved .mp3 file:\n%(mp3_name)s' %
+                             {'mp3_name': result['mp3']})
+        else:
+            metrics.count('convert.failed')
+            self.logger.error(
+                'Failed to convert %(webm)s from %(zf)s: %(e)s' %
+                {'webm': result['webm'], 'zf': result['archive'],
+                 'e': result['error']})
+        return result
+
+    def _log_summary(self, results):
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        self.logger.info(
+            'Finished converting: %(summary)s' %
+            {'summary': ', '.join(
+                f'{n} {status}' for status, n in sorted(counts.items()))})
 
 
 def main():
     import argparse
-    from . import log_conf
     from .utils import set_class_log_level
-
-    logging.config.dictConfig(log_conf)
+    from .pcm_cache import PCMCache
+    from .metrics import add_metrics_arguments, report_metrics
+    from .state import add_state_arguments, open_state
 
     parser = argparse.ArgumentParser(
         description='Converts .webm files to .mp3 files from a PCIbex '
@@ -119,9 +408,11 @@ def main():
 
     parser.add_argument(
         '--overwrite', '-o', action='store_true',
-        help='Recreates .mp3 files for all participants (the default). This is'
-        ' the default in case the amount of time to strip from the front of '
-        'the recording is changed.',
+        help='Recreates .mp3 files whose inputs have changed (the default). '
+        'The zip member\'s CRC, the amount of time to strip from the front '
+        'of the recording and the encoder settings are recorded in a manifest'
+        ' next to the mp3 directory, and .mp3 files are only recreated when '
+        'one of these has changed since the last run.',
         dest='overwrite')
 
     parser.add_argument(
@@ -130,13 +421,51 @@ def main():
         'any .mp3 files.',
         dest='overwrite')
 
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of worker processes to use for converting the .webm '
+        'files (default is 1, which converts them one after another).',
+        dest='jobs')
+
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Recreates all .mp3 files, even those that the manifest says '
+        'are up to date.',
+        dest='force')
+
+    parser.add_argument(
+        '--pcm-cache', type=str, default=None,
+        help='Path to a directory in which to also cache the decoded audio '
+        'for each item as a .wav file, so that transcribe and align don\'t '
+        'have to decode the .mp3 files again. Not used by default.',
+        dest='pcm_cache')
+
+    parser.add_argument(
+        '--pcm-cache-size', type=int, default=2048,
+        help='Maximum size of the PCM cache in megabytes (default is 2048). '
+        'The least recently used items are evicted first.',
+        dest='pcm_cache_size')
+
+    add_state_arguments(parser)
+    add_metrics_arguments(parser)
+
     parser.set_defaults(overwrite=True)
 
     args = parser.parse_args()
 
+    # Loaded only once there's work to do, so that --help stays quick
+    from . import log_conf
+    logging.config.dictConfig(log_conf)
+
+    pcm_cache = None
+    if args.pcm_cache is not None:
+        pcm_cache = PCMCache(args.pcm_cache, args.pcm_cache_size * 1024 ** 2)
+
     converter = WebmToMp3Converter(
-        args.file_, args.mp3_dir, args.zip_dir, args.overwrite)
+        args.file_, args.mp3_dir, args.zip_dir, args.overwrite, args.jobs,
+        args.force, pcm_cache, open_state(args))
 
     set_class_log_level(converter, args.log)
 
-    converter.convert_to_mp3()
+    with report_metrics(args):
+        converter.convert_to_mp3()
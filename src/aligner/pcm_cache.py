@@ -0,0 +1,109 @@
+import os
+import struct
+import logging
+from .utils import load_json, dump_json_atomic, evict_lru, lazy_import
+
+np = lazy_import('numpy')
+
+
+logger = logging.getLogger(__name__)
+
+
+def _read_wav_header(wav_file):
+    # Walks the RIFF chunks so that the sample data can be memory-mapped
+    # directly, whatever other chunks ffmpeg decided to write
+    with open(wav_file, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{wav_file} is not a .wav file')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{wav_file} has no data chunk')
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(size - 16 + size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+    if fmt is None:
+        raise ValueError(f'{wav_file} has no fmt chunk')
+    _, channels, sample_rate, _, block_align, bits = fmt
+    # ffmpeg leaves the data size at its maximum when it can't seek back
+    # to fill it in, so trust the file size over the header
+    size = min(size, os.path.getsize(wav_file) - offset)
+    frames = size // block_align
+    return {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'sample_width': bits // 8,
+        'frames': frames,
+        'duration': frames / sample_rate,
+        'data_offset': offset}
+
+
+class PCMCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def paths(self, p, item):
+        base = os.path.join(
+            self.cache_dir, str(p), 'item_number_' + str(item).zfill(2))
+        return base + '.wav', base + '.json'
+
+    def record(self, p, item, mp3_file):
+        wav_file, meta_file = self.paths(p, item)
+        meta = _read_wav_header(wav_file)
+        stat = os.stat(mp3_file)
+        meta['mp3_size'] = stat.st_size
+        meta['mp3_mtime_ns'] = stat.st_mtime_ns
+        dump_json_atomic(meta, meta_file, indent=2)
+        return meta
+
+    def lookup(self, p, item, mp3_file):
+        wav_file, meta_file = self.paths(p, item)
+        meta = load_json(meta_file)
+        if meta is None or not os.path.exists(wav_file):
+            return None
+        try:
+            stat = os.stat(mp3_file)
+        except FileNotFoundError:
+            return None
+        # The cached audio is only valid for the .mp3 file it was decoded
+        # alongside; if the .mp3 file has been recreated since, it's stale
+        if (stat.st_size != meta['mp3_size'] or
+                stat.st_mtime_ns != meta['mp3_mtime_ns']):
+            self.logger.debug('Stale cache entry for %(f)s' %
+                              {'f': mp3_file})
+            return None
+        # Touch the entry so that eviction is least-recently-used
+        os.utime(meta_file)
+        meta['wav_file'] = wav_file
+        return meta
+
+    def load(self, p, item, mp3_file):
+        meta = self.lookup(p, item, mp3_file)
+        if meta is None:
+            return None, None
+        dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[meta['sample_width']]
+        samples = np.memmap(
+            meta['wav_file'], dtype=np.dtype(dtype).newbyteorder('<'),
+            mode='r', offset=meta['data_offset'],
+            shape=(meta['frames'], meta['channels']))
+        return samples, meta
+
+    def evict(self):
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+        removed = evict_lru(self.cache_dir, self.max_bytes)
+        if removed:
+            self.logger.info(
+                'Evicted %(n)s item(s) from the PCM cache %(dir)s' %
+                {'n': removed, 'dir': self.cache_dir})
@@ -0,0 +1,751 @@
+import os
+import queue
+import threading
+import logging
+import logging.config
+from .mp3 import _run_unit
+from .alignment_cache import AlignmentKeys
+from .alignment_store import AlignmentStore
+from .metrics import metrics
+from .utils import lazy_import
+
+pd = lazy_import('pandas')
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('convert', 'transcribe', 'extract', 'align')
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Pipeline:
+    # Streams each item through conversion, transcription, extraction and
+    # alignment instead of running each tool over the whole study before
+    # the next one starts. Every stage has its own pool of worker threads
+    # and a bounded queue in front of it, so that converting the next items
+    # overlaps with waiting on the speech-to-text service and gentle for
+    # earlier ones. A participant's alignment store and TextGrid files are
+    # written as soon as all of their items are through, and the timing
+    # information is extracted at the end.
+    def __init__(self, converter, transcriber, extractor, aligner,
+                 workers=None, queue_size=8, overwrite=False, tg=True,
+                 phones=False, transcript_files=False):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.converter = converter
+        self.transcriber = transcriber
+        self.extractor = extractor
+        self.aligner = aligner
+        self.workers = dict.fromkeys(STAGES, 1)
+        self.workers.update(workers or {})
+        self.queue_size = queue_size
+        self.overwrite = overwrite
+        self.tg = tg
+        self.phones = phones
+        # Transcripts go to gentle straight from memory, so the .txt files
+        # are only written if they're asked for
+        self.transcript_files = transcript_files
+        self.lock = threading.Lock()
+
+    def run(self, jobs=1, incremental=True, long_output=None, wide=True):
+        col = self.transcriber.transcription_col_name
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.transcriber.transcribed_csv)
+        metrics.add_bytes('csv.read', read=os.path.getsize(
+            self.transcriber.transcribed_csv))
+        if col not in df.columns:
+            df[col] = pd.NA
+        # If there aren't yet any strings in the Transcription column, pandas
+        # will treat it as a float, so we must cast it to a string
+        df = df.astype({col: str}, errors='raise')
+        df[col] = df[col].replace('nan', pd.NA)
+        self.transcriber._load_state(df)
+        for files in self._file_indexes():
+            files.refresh()
+
+        self.df = df
+        self.transcribed = 0
+        self.pending = {}
+        self.sizes = {}
+        self.alignments = {}
+        self.keys = {}
+        self.stores = {}
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in STAGES]
+        threads = []
+        for n, stage in enumerate(STAGES):
+            outbox = queues[n + 1] if n + 1 < len(STAGES) else None
+            threads.extend(self._start_stage(stage, queues[n], outbox))
+
+        try:
+            self._feed(df, queues[0])
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+            self.transcriber._save(df)
+            self.converter._finish()
+            self.transcriber._finish()
+            self.aligner.gentle.close()
+            for files in self._file_indexes():
+                files.save()
+
+        self.aligner.get_timing_info(jobs, incremental, long_output, wide)
+
+    def _file_indexes(self):
+        # The stages normally share one index, but each may have its own
+        components = (self.converter, self.transcriber, self.extractor,
+                      self.aligner)
+        return list({id(c.files): c.files for c in components}.values())
+
+    def _feed(self, df, inbox):
+        for p, grp_df in df.groupby('Participant'):
+            units = []
+            results = self.converter._plan(
+                grp_df, self.converter.mp3_dir, self.converter.zip_dir, units)
+            p = str(p)
+
+            transcriptions_dir = os.path.join(
+                self.extractor.data_dir, 'transcriptions', p)
+            gdir = os.path.join(self.aligner.gentle_dir, p)
+            if self.transcript_files:
+                os.makedirs(transcriptions_dir, exist_ok=True)
+            os.makedirs(gdir, exist_ok=True)
+
+            # Items that are already converted go straight on to the next
+            # stage; missing recordings don't enter the pipeline at all
+            items = [(r['item'], None) for r in results
+                     if r['status'] != 'missing']
+            items.extend((u['item'], u) for u in units)
+            items.sort(key=lambda item: item[0])
+
+            with self.lock:
+                self.sizes[p] = len(grp_df)
+                self.pending[p] = len(items)
+                self.alignments[p] = {}
+                self.keys[p] = AlignmentKeys(gdir)
+                self.stores[p] = AlignmentStore(gdir)
+
+            self.logger.info(
+                'Queueing %(n)s item(s) for participant %(p)s.' %
+                {'n': len(items), 'p': p})
+            if not items:
+                self._finish_participant(p)
+            for n, unit in items:
+                inbox.put({'p': p, 'item': n, 'idx': grp_df.index[n - 1],
+                           'unit': unit,
+                           'transcriptions_dir': transcriptions_dir})
+
+    def _start_stage(self, stage, inbox, outbox):
+        fn = getattr(self, '_' + stage)
+        remaining = [self.workers[stage]]
+
+        def work():
+            # However this worker stops, the next stage has to be told once
+            # all of this stage's workers have, or run() would wait on it
+            # for ever
+            try:
+                self._work(stage, fn, inbox, outbox)
+            finally:
+                with self.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and outbox is not None:
+                    outbox.put(_DONE)
+
+        threads = [threading.Thread(target=work, name=f'{stage}-{n}',
+                                    daemon=True)
+                   for n in range(self.workers[stage])]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _work(self, stage, fn, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Leave the marker for this stage's other workers
+                inbox.put(_DONE)
+                return
+            try:
+                with metrics.timer('pipeline.' + stage):
+                    result = fn(item)
+            except Exception as e:
+                self.logger.error(
+                    'Failed to %(stage)s item %(i)s for participant '
+                    '%(p)s: %(e)s' %
+                    {'stage': stage, 'i': item['item'], 'p': item['p'],
+                     'e': e})
+                result = None
+            try:
+                if result is None or outbox is None:
+                    self._done(item)
+                else:
+                    outbox.put(result)
+            except Exception as e:
+                # Finishing the participant (writing their alignment store
+                # and TextGrid files) failed; their other items are done
+                self.logger.error(
+                    'Failed to finish participant %(p)s: %(e)s' %
+                    {'p': item['p'], 'e': e})
+
+    def _convert(self, item):
+        unit = item.pop('unit')
+        if unit is None:
+            return item
+        result = _run_unit(unit)
+        with self.lock:
+            self.converter._log_result(result)
+        if result['status'] != 'converted':
+            return None
+        return item
+
+    def _transcribe(self, item):
+        col = self.transcriber.transcription_col_name
+        with self.lock:
+            transcription = self.df.at[item['idx'], col]
+        if pd.isna(transcription):
+            content, channels = self.transcriber._prepare(
+                item['p'], item['item'])
+            transcription = self.transcriber._recognize(
+                item['p'], item['item'], content, channels)
+            self.transcriber._store(item['p'], item['item'], transcription)
+            with self.lock:
+                self.df.at[item['idx'], col] = transcription
+                self.transcribed += 1
+                self.transcriber._checkpoint(self.df, self.transcribed)
+        item['transcription'] = transcription
+        return item
+
+    def _extract(self, item):
+        if not self.transcript_files:
+            return item
+        self.extractor.write_transcription(
+            item['transcriptions_dir'], item['p'], item['item'] - 1,
+            item['transcription'])
+        return item
+
+    def _align(self, item):
+        p, n = item['p'], item['item']
+        mp3_file = os.path.join(
+            self.aligner.mp3_dir, p, f'item_number_{n:02}.mp3')
+        align_file = os.path.join(
+            self.aligner.gentle_dir, p, str(n).zfill(2) + '.json')
+        transcript = str(item['transcription']) + '\n'
+        alignment, job = self.aligner._plan_alignment(
+            self.keys[p], self.stores[p], p, n, mp3_file, transcript,
+            align_file, self.overwrite)
+        if alignment is None:
+            key, entry = job
+            alignment = self.aligner._submit_alignment(
+                key, mp3_file, transcript)
+            self.aligner._record_alignment(
+                key, alignment, [entry], self.alignments)
+        else:
+            self.alignments[p][n] = alignment
+        self.logger.info(
+            'Finished item %(i)s for participant %(p)s.' % {'i': n, 'p': p})
+        return item
+
+    def _done(self, item):
+        with self.lock:
+            self.pending[item['p']] -= 1
+            last = self.pending[item['p']] == 0
+        if last:
+            self._finish_participant(item['p'])
+
+    def _finish_participant(self, p):
+        alignments = self.alignments[p]
+        self.aligner._keep_existing(
+            p, self.stores[p], alignments, range(1, self.sizes[p] + 1))
+
+        # The store is written before the keys are saved, so that a key is
+        # never recorded for an alignment that didn't make it to disk
+        self.stores[p].write(alignments)
+        self.keys[p].save()
+        files = self.aligner.files
+        self.aligner._record_statuses(p, [
+            n for n in range(1, self.sizes[p] + 1)
+            if files.has(p, n, 'mp3')], alignments)
+
+        if self.tg:
+            items = [
+                (p, n - 1, f'item_number_{n:02}.mp3', None)
+                for n in sorted(alignments) if files.has(p, n, 'mp3')]
+            self.aligner._write_textgrids(items, {p: alignments}, self.phones)
+
+        self.logger.info(
+            'Finished aligning participant %(p)s.' % {'p': p})
+
+
+def main():
+    import argparse
+    from .utils import set_class_log_level
+    from .mp3 import WebmToMp3Converter
+    from .stt import SpeechToText
+    from .transcriptions import TranscriptionExtractor
+    from .aligner import Aligner
+    from .pcm_cache import PCMCache
+    from .recognition_cache import RecognitionCache
+    from .gentle import GentlePool
+    from .alignment_cache import AlignmentCache
+    from .file_index import FileIndex
+    from .metrics import add_metrics_arguments, report_metrics
+    from .state import (StateStore, add_state_arguments, item_numbers,
+                        open_state)
+    from .vad import add_vad_arguments, open_vad
+    from .work_queue import WorkQueue
+    from .worker import Worker
+
+    parser = argparse.ArgumentParser(
+        description='Runs the whole aligner workflow.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Arguments shared by run and worker
+    common = argparse.ArgumentParser(add_help=False)
+
+    common.add_argument(
+        '--file', '-f', type=str,
+        default='/Users/adamliter/Dropbox/Research/PlanningWindow/'
+        'data/exp1_data/ibex_results/exp1_data_tidy_transcribed.csv',
+        help='Path to the tidied .csv file. The transcriptions and the timing'
+        ' information are written back to it.',
+        dest='file_')
+
+    common.add_argument(
+        '--tcol', '-t', type=str, default='Transcription',
+        help='Name of the column in the .csv file containing the '
+        'transcriptions.',
+        dest='tcol')
+
+    common.add_argument(
+        '--data-dir', '-d', type=str,
+        default='/Users/adamliter/Dropbox/Research/PlanningWindow/data/'
+        'exp1_data',
+        help='Path to the parent directory for all of the different data '
+        'files.',
+        dest='data_dir')
+
+    common.add_argument(
+        '--zip-dir', '-z', type=str, default='zip_archives',
+        help='Relative path from data_dir to the directory containing all of'
+        ' the zip archives with the recordings.',
+        dest='zip_dir')
+
+    common.add_argument(
+        '--mp3-dir', '-m', type=str, default='mp3_files',
+        help='Relative path from data_dir to the directory in which to save '
+        'the .mp3 files.',
+        dest='mp3_dir')
+
+    common.add_argument(
+        '--gentle-dir', '-g', type=str, default='gentle_align',
+        help='Relative path from data_dir to the directory where all of the'
+        ' results from aligning the files will be stored.',
+        dest='gentle_dir')
+
+    common.add_argument(
+        '--no-praat-textgrid', '-x', action='store_false',
+        help='Doesn\'t write a Praat .TextGrid file.',
+        dest='praat_textgrid')
+
+    common.add_argument(
+        '--phones', action='store_true',
+        help='Adds a tier with the phone timings from the gentle aligner to '
+        'the Praat .TextGrid files, in addition to the word tier.',
+        dest='phones')
+
+    common.add_argument(
+        '--credentials', '-c', type=str, default='',
+        help='Path to .json credentials file for Google Cloud '
+        'authentication.',
+        dest='credentials')
+
+    common.add_argument(
+        '--rate', type=float, default=None,
+        help='Maximum number of requests per second to send to Google\'s '
+        'Speech-to-Text API. Not limited by default.',
+        dest='rate')
+
+    common.add_argument(
+        '--cache', type=str, default=None,
+        help='Path to a directory in which to cache the responses from '
+        'Google\'s Speech-to-Text API. Not used by default.',
+        dest='cache')
+
+    common.add_argument(
+        '--cache-size', type=int, default=256,
+        help='Maximum size of the response cache in megabytes (default is '
+        '256).',
+        dest='cache_size')
+
+    common.add_argument(
+        '--pcm-cache', type=str, default=None,
+        help='Path to a directory in which to cache the decoded audio for '
+        'each item, so that it only has to be decoded once. Not used by '
+        'default.',
+        dest='pcm_cache')
+
+    common.add_argument(
+        '--pcm-cache-size', type=int, default=2048,
+        help='Maximum size of the PCM cache in megabytes (default is 2048).',
+        dest='pcm_cache_size')
+
+    common.add_argument(
+        '--gentle-url', type=str, nargs='+',
+        default=['http://localhost:8765'],
+        help='URL(s) of the gentle forced aligner (default is '
+        'http://localhost:8765).',
+        dest='gentle_url')
+
+    common.add_argument(
+        '--timeout', type=float, default=300,
+        help='Number of seconds to wait for gentle to align a single file '
+        '(default is 300).',
+        dest='timeout')
+
+    common.add_argument(
+        '--retries', type=int, default=3,
+        help='Number of times to retry a failed alignment, with exponential '
+        'backoff (default is 3).',
+        dest='retries')
+
+    common.add_argument(
+        '--alignment-cache', type=str, default=None,
+        help='Path to the directory in which to cache alignments (default is '
+        'gentle_dir/.cache).',
+        dest='alignment_cache')
+
+    common.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of worker processes to use for reading the timing '
+        'information from the alignment files (default is 1).',
+        dest='jobs')
+
+    common.add_argument(
+        '--long-output', type=str, default=None,
+        help='Path to a .csv file to which to write the timing information '
+        'in long format, with a row per word.',
+        dest='long_output')
+
+    common.add_argument(
+        '--no-wide', action='store_false',
+        help='Doesn\'t add the WordNOnset and WordNOffset columns to the '
+        'main .csv file.',
+        dest='wide')
+
+    common.add_argument(
+        '--log', '-l', type=str,
+        default='warning',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        help='Set the logging level.',
+        dest='log')
+
+    add_vad_arguments(common)
+    add_metrics_arguments(common)
+
+    run = subparsers.add_parser(
+        'run', parents=[common],
+        description='Streams each item through the whole workflow: converts'
+        ' its .webm file to an .mp3 file, transcribes it with Google Cloud\'s'
+        ' Speech-to-Text API (unless the .csv file already has a '
+        'transcription for it) and aligns it with gentle (writing the '
+        'transcription to a .txt file first with --transcript-files). Each '
+        'stage has its own workers, so that later items are being converted '
+        'while earlier ones are being transcribed or aligned. The timing '
+        'information is written back to the .csv file at the end.',
+        help='Runs every stage of the workflow on each item.')
+
+    run.add_argument(
+        '--overwrite', '-o', action='store_true',
+        help='Rewrites every transcription file whose content has changed '
+        '(with --transcript-files) and realigns every item, even if it is up'
+        ' to date.',
+        dest='overwrite')
+
+    run.add_argument(
+        '--save-every-n', '-n', type=int, default=10,
+        help='Save the transcriptions to disk after every n submissions to '
+        'Google\'s Speech-to-Text API (default is 10).',
+        dest='save_every_n')
+
+    run.add_argument(
+        '--convert-workers', type=int, default=os.cpu_count() or 1,
+        help='Number of .webm files to convert at once (default is the '
+        'number of CPUs).',
+        dest='convert_workers')
+
+    run.add_argument(
+        '--transcribe-workers', type=int, default=4,
+        help='Number of requests to have in flight to Google\'s '
+        'Speech-to-Text API at once (default is 4).',
+        dest='transcribe_workers')
+
+    run.add_argument(
+        '--extract-workers', type=int, default=1,
+        help='Number of workers writing the transcription files (default is '
+        '1). Only used with --transcript-files.',
+        dest='extract_workers')
+
+    run.add_argument(
+        '--transcript-files', action='store_true',
+        help='Also writes each transcription to a .txt file in '
+        'data_dir/transcriptions, as extract does. The transcriptions are '
+        'sent to gentle straight from memory either way.',
+        dest='transcript_files')
+
+    run.add_argument(
+        '--align-workers', type=int, default=2,
+        help='Number of alignments to have in flight at once, across all '
+        'gentle instances (default is 2).',
+        dest='align_workers')
+
+    run.add_argument(
+        '--queue-size', type=int, default=8,
+        help='Maximum number of items waiting in front of each stage '
+        '(default is 8).',
+        dest='queue_size')
+
+    run.add_argument(
+        '--full', action='store_true',
+        help='Re-extracts the timing information for all participants.',
+        dest='full')
+
+    add_state_arguments(run)
+
+    export = subparsers.add_parser(
+        'export-csv',
+        description='Writes the tidy .csv file, with the transcriptions and '
+        'the timing information, from a state store kept with --state, for '
+        'the scripts that analyze the results.',
+        help='Writes the .csv files from a state store.')
+
+    export.add_argument(
+        '--state', type=str, required=True,
+        help='Path to the state store to export.',
+        dest='state')
+
+    export.add_argument(
+        '--file', '-f', type=str, required=True,
+        help='Path to which to write the .csv file.',
+        dest='file_')
+
+    export.add_argument(
+        '--tcol', '-t', type=str, default='Transcription',
+        help='Name of the column in which to put the transcriptions.',
+        dest='tcol')
+
+    export.add_argument(
+        '--long-output', type=str, default=None,
+        help='Path to a .csv file to which to also write the timing '
+        'information in long format, with a row per word.',
+        dest='long_output')
+
+    export.add_argument(
+        '--no-wide', action='store_false',
+        help='Leaves the WordNOnset and WordNOffset columns out of the .csv '
+        'file.',
+        dest='wide')
+
+    export.add_argument(
+        '--log', '-l', type=str,
+        default='warning',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        help='Set the logging level.',
+        dest='log')
+
+    add_metrics_arguments(export)
+
+    enqueue = subparsers.add_parser(
+        'enqueue',
+        description='Queues every item in the tidy .csv file for "aligner '
+        'worker" processes to work through, on this machine or on others '
+        'that share the data directory. The queue is kept in the state '
+        'store. Items that were queued before start over, except for any '
+        'that a worker is busy with.',
+        help='Queues the study\'s items for workers.')
+
+    enqueue.add_argument(
+        '--state', type=str, required=True,
+        help='Path to the state store in which to keep the queue.',
+        dest='state')
+
+    enqueue.add_argument(
+        '--file', '-f', type=str, required=True,
+        help='Path to the tidied .csv file.',
+        dest='file_')
+
+    enqueue.add_argument(
+        '--tcol', '-t', type=str, default='Transcription',
+        help='Name of the column in the .csv file containing the '
+        'transcriptions.',
+        dest='tcol')
+
+    enqueue.add_argument(
+        '--log', '-l', type=str,
+        default='warning',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        help='Set the logging level.',
+        dest='log')
+
+    work = subparsers.add_parser(
+        'worker', parents=[common],
+        description='Works through the items queued with "aligner enqueue",'
+        ' alongside any number of other workers. Each worker leases an item '
+        'at a time from the queue, converts, transcribes and aligns it, and '
+        'keeps renewing its leases while it works, so that if it dies, the '
+        'items it held are picked up by another worker once their leases '
+        'expire. Once all of a participant\'s items are through, one worker '
+        'merges their alignments into the participant\'s alignment store and'
+        ' TextGrid files, and once every participant is, one worker writes '
+        'the .csv file.',
+        help='Works through the queued items.')
+
+    work.add_argument(
+        '--state', type=str, required=True,
+        help='Path to the state store that the items were queued in. Every '
+        'worker must use the same one.',
+        dest='state')
+
+    work.add_argument(
+        '--threads', type=int, default=4,
+        help='Number of items to work on at once (default is 4).',
+        dest='threads')
+
+    work.add_argument(
+        '--lease', type=float, default=60,
+        help='Number of seconds that a lease on an item lasts without being '
+        'renewed (default is 60). Leases are renewed every third of that, '
+        'and an item whose lease has expired can be claimed by another '
+        'worker.',
+        dest='lease')
+
+    work.add_argument(
+        '--max-attempts', type=int, default=3,
+        help='Number of times to try an item before giving up on it (default'
+        ' is 3).',
+        dest='max_attempts')
+
+    work.add_argument(
+        '--poll', type=float, default=5,
+        help='Number of seconds to wait before checking the queue again when'
+        ' there\'s nothing to claim (default is 5).',
+        dest='poll')
+
+    work.add_argument(
+        '--wait', action='store_true',
+        help='Keeps waiting for new items once the queue is empty, instead of'
+        ' exiting.',
+        dest='wait')
+
+    work.add_argument(
+        '--name', type=str, default=None,
+        help='Name of the worker in the queue (default is the host name and '
+        'process ID).',
+        dest='name')
+
+    args = parser.parse_args()
+
+    # Loaded only once there's work to do, so that --help stays quick
+    from . import log_conf
+    logging.config.dictConfig(log_conf)
+
+    if args.command == 'export-csv':
+        state = StateStore(args.state)
+        set_class_log_level(state, args.log)
+        with report_metrics(args):
+            state.export_csv(
+                args.file_, args.tcol, args.long_output, args.wide)
+        return
+
+    if args.command == 'enqueue':
+        state = StateStore(args.state)
+        work_queue = WorkQueue(args.state)
+        set_class_log_level(state, args.log)
+        set_class_log_level(work_queue, args.log)
+        df = pd.read_csv(args.file_)
+        state.add_rows(df, args.tcol)
+        work_queue.enqueue(zip(df['Participant'], item_numbers(df)))
+        return
+
+    if args.credentials != '':
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.credentials
+
+    mp3_dir = os.path.join(args.data_dir, args.mp3_dir)
+    os.makedirs(mp3_dir, exist_ok=True)
+    if args.command == 'run' and args.transcript_files:
+        os.makedirs(os.path.join(args.data_dir, 'transcriptions'),
+                    exist_ok=True)
+
+    pcm_cache = None
+    if args.pcm_cache is not None:
+        pcm_cache = PCMCache(args.pcm_cache, args.pcm_cache_size * 1024 ** 2)
+    state = open_state(args)
+    vad = open_vad(args)
+    files = FileIndex(
+        mp3_dir, os.path.join(args.data_dir, 'transcriptions'),
+        os.path.join(args.data_dir, args.gentle_dir))
+
+    converter = WebmToMp3Converter(
+        args.file_, mp3_dir, os.path.join(args.data_dir, args.zip_dir),
+        overwrite=True, pcm_cache=pcm_cache, state=state, files=files)
+    transcriber = SpeechToText(
+        args.mp3_dir, args.data_dir, args.file_, args.tcol,
+        args.save_every_n if args.command == 'run' else None,
+        pcm_cache, rate=args.rate,
+        recognition_cache=RecognitionCache(
+            args.cache, args.cache_size * 1024 ** 2)
+        if args.cache is not None else None, state=state, files=files,
+        vad=vad)
+
+    if args.command == 'worker':
+        # Workers take the transcriptions from the state store, which is
+        # where they all put the ones they recognize
+        aligner = Aligner(
+            args.file_, args.data_dir, args.mp3_dir, 'transcriptions',
+            args.gentle_dir, pcm_cache,
+            GentlePool(args.gentle_url, args.timeout, args.retries),
+            args.threads,
+            AlignmentCache(args.alignment_cache)
+            if args.alignment_cache is not None else None, state=state,
+            files=files, transcripts='state', vad=vad)
+        worker = Worker(
+            WorkQueue(args.state, args.lease, args.max_attempts), converter,
+            transcriber, aligner, args.threads, args.wait, args.poll,
+            args.praat_textgrid, args.phones, args.jobs, args.long_output,
+            args.wide, args.name)
+        for component in (worker, worker.queue, converter, transcriber,
+                          aligner, vad):
+            if component is not None:
+                set_class_log_level(component, args.log)
+        with report_metrics(args):
+            worker.run()
+        return
+
+    extractor = TranscriptionExtractor(
+        args.file_, args.tcol, args.data_dir, args.overwrite, state, files)
+    aligner = Aligner(
+        args.file_, args.data_dir, args.mp3_dir, 'transcriptions',
+        args.gentle_dir, pcm_cache,
+        GentlePool(args.gentle_url, args.timeout, args.retries),
+        alignment_cache=AlignmentCache(args.alignment_cache)
+        if args.alignment_cache is not None else None, state=state,
+        files=files, vad=vad)
+
+    pipeline = Pipeline(
+        converter, transcriber, extractor, aligner,
+        {'convert': args.convert_workers,
+         'transcribe': args.transcribe_workers,
+         'extract': args.extract_workers,
+         'align': args.align_workers},
+        args.queue_size, args.overwrite, args.praat_textgrid, args.phones,
+        args.transcript_files)
+
+    for component in (pipeline, converter, transcriber, extractor, aligner,
+                      vad):
+        if component is not None:
+            set_class_log_level(component, args.log)
+
+    with report_metrics(args):
+        pipeline.run(args.jobs, not args.full, args.long_output, args.wide)
@@ -0,0 +1,64 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from .utils import load_json, dump_json_atomic, evict_lru
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecognitionCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(content, config):
+        # The same audio submitted with a different language or channel count
+        # can come back with a different transcript, so the config is part of
+        # the key too
+        h = hashlib.sha256(content)
+        h.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        entry = load_json(path)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dump_json_atomic(entry, path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def evict(self):
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+        removed = evict_lru(self.cache_dir, self.max_bytes)
+        if removed:
+            self.logger.info(
+                'Evicted %(n)s response(s) from the recognition cache '
+                '%(dir)s' % {'n': removed, 'dir': self.cache_dir})
@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from .metrics import metrics
+from .utils import lazy_import
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+
+logger = logging.getLogger(__name__)
+
+_TIMING_COL = re.compile(r'Word.*(Onset|Offset)')
+
+
+def item_numbers(df):
+    # The item number that each row of the .csv file is stored under: its
+    # position among its participant's rows, counting from 1, which is also
+    # how the .mp3 files are numbered. The ItemNumber column isn't used, so
+    # that nothing depends on it matching the order of the rows.
+    return df.groupby('Participant').cumcount() + 1
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS items (
+    participant TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (participant, item));
+CREATE TABLE IF NOT EXISTS status (
+    participant TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (participant, item, stage));
+CREATE TABLE IF NOT EXISTS transcriptions (
+    participant TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    transcription TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (participant, item));
+CREATE TABLE IF NOT EXISTS timings (
+    participant TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    word_index INTEGER NOT NULL,
+    word TEXT,
+    "case" TEXT,
+    onset REAL,
+    offset REAL,
+    PRIMARY KEY (participant, item, word_index));
+'''
+
+
+class StateStore:
+    # Per-item state for every stage, kept in a SQLite database in WAL
+    # mode. Each stage upserts the rows for the items it has just finished,
+    # so a checkpoint costs the size of the item rather than the size of the
+    # study, and a crash partway through a write can't corrupt anything that
+    # was already committed. Items are keyed by participant and by their
+    # (1-based) position among the participant's rows, the same way as the
+    # .mp3, transcription and alignment files are numbered.
+    def __init__(self, path):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        # One connection is shared by all of a stage's worker threads, and
+        # the lock makes sure only one of them uses it at a time
+        self.connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _write(self, sql, rows=None, many=False):
+        with self.lock, metrics.timer('state.write'), self.connection:
+            if many:
+                self.connection.executemany(sql, rows)
+            else:
+                self.connection.execute(sql, rows or ())
+
+    def _read(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def add_rows(self, df, transcription_col_name=None):
+        # Records the rows of the .csv file, apart from any timing columns,
+        # along with any transcriptions that are already in it, so that the
+        # .csv file can be exported again from the store alone. Rows that
+        # haven't changed aren't rewritten.
+        columns = [c for c in df.columns if not _TIMING_COL.search(c)]
+        data_cols = [c for c in columns if c != transcription_col_name]
+        records = json.loads(df[data_cols].to_json(orient='records'))
+        participants = [str(p) for p in df['Participant']]
+        items = [int(n) for n in item_numbers(df)]
+        now = time.time()
+        with self.lock, metrics.timer('state.write'), self.connection:
+            self.connection.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                ('columns', json.dumps(columns)))
+            self.connection.executemany(
+                'INSERT INTO items (participant, item, position, data) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (participant, item) DO '
+                'UPDATE SET position = excluded.position, data = '
+                'excluded.data WHERE position IS NOT excluded.position OR '
+                'data IS NOT excluded.data',
+                [(p, i, n, json.dumps(record))
+                 for n, (p, i, record) in enumerate(
+                     zip(participants, items, records))])
+            if transcription_col_name in df.columns:
+                # Transcriptions in the .csv file (e.g., ones corrected by
+                # hand) take precedence over the ones in the store
+                self.connection.executemany(
+                    'INSERT INTO transcriptions (participant, item, '
+                    'transcription, updated) VALUES (?, ?, ?, ?) ON CONFLICT '
+                    '(participant, item) DO UPDATE SET transcription = '
+                    'excluded.transcription, updated = excluded.updated '
+                    'WHERE transcription IS NOT excluded.transcription',
+                    [(p, i, str(t), now) for p, i, t in zip(
+                        participants, items, df[transcription_col_name])
+                     if not pd.isna(t)])
+
+    def set_status(self, p, item, stage, status):
+        self._write(
+            'INSERT INTO status (participant, item, stage, status, updated) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (participant, item, stage) '
+            'DO UPDATE SET status = excluded.status, updated = '
+            'excluded.updated',
+            (str(p), int(item), stage, status, time.time()))
+
+    def set_statuses(self, p, stage, statuses):
+        now = time.time()
+        self._write(
+            'INSERT INTO status (participant, item, stage, status, updated) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (participant, item, stage) '
+            'DO UPDATE SET status = excluded.status, updated = '
+            'excluded.updated',
+            [(str(p), int(item), stage, status, now)
+             for item, status in statuses.items()], many=True)
+
+    def statuses(self, stage):
+        return {(p, item): status for p, item, status in self._read(
+            'SELECT participant, item, status FROM status WHERE stage = ?',
+            (stage,))}
+
+    def set_transcription(self, p, item, transcription):
+        self._write(
+            'INSERT INTO transcriptions (participant, item, transcription, '
+            'updated) VALUES (?, ?, ?, ?) ON CONFLICT (participant, item) DO '
+            'UPDATE SET transcription = excluded.transcription, updated = '
+            'excluded.updated',
+            (str(p), int(item), transcription, time.time()))
+
+    def transcriptions(self, p=None):
+        if p is None:
+            return {(p, item): t for p, item, t in self._read(
+                'SELECT participant, item, transcription FROM '
+                'transcriptions')}
+        return {(p, item): t for p, item, t in self._read(
+            'SELECT participant, item, transcription FROM transcriptions '
+            'WHERE participant = ?', (str(p),))}
+
+    def transcription(self, p, item):
+        rows = self._read(
+            'SELECT transcription FROM transcriptions WHERE participant = ? '
+            'AND item = ?', (str(p), int(item)))
+        return rows[0][0] if rows else None
+
+    def row(self, p, item):
+        # The item's row of the .csv file, as recorded by add_rows
+        rows = self._read(
+            'SELECT data FROM items WHERE participant = ? AND item = ?',
+            (str(p), int(item)))
+        return json.loads(rows[0][0]) if rows else None
+
+    def fill_transcriptions(self, df, transcription_col_name):
+        # Fills in missing transcriptions in df from the store, e.g., the
+        # ones recognized before an earlier run was interrupted
+        known = self.transcriptions()
+        if not known:
+            return 0
+        items = item_numbers(df)
+        filled = {}
+        for idx in df.index[df[transcription_col_name].isna()]:
+            t = known.get((str(df.at[idx, 'Participant']), int(items[idx])))
+            if t is not None:
+                filled[idx] = t
+        if not filled:
+            return 0
+        # A column with no transcriptions in it yet is read as floats
+        if pd.api.types.is_float_dtype(df[transcription_col_name]):
+            df[transcription_col_name] = \
+                df[transcription_col_name].astype(object)
+        for idx, t in filled.items():
+            df.at[idx, transcription_col_name] = t
+        self.logger.info(
+            'Took %(n)s transcription(s) from the state store.' %
+            {'n': len(filled)})
+        return len(filled)
+
+    def set_timings(self, p, words):
+        # Replaces all of a participant's word timings in one transaction.
+        # words holds flat arrays, as returned by _parse_word_timing, with
+        # the number of each word's item.
+        p = str(p)
+        with self.lock, metrics.timer('state.write'), self.connection:
+            self.connection.execute(
+                'DELETE FROM timings WHERE participant = ?', (p,))
+            self.connection.executemany(
+                'INSERT INTO timings (participant, item, word_index, word, '
+                '"case", onset, offset) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                zip([p] * len(words['item']),
+                    (int(n) for n in words['item']),
+                    (int(i) + 1 for i in words['index']),
+                    words['word'], words['case'],
+                    (None if np.isnan(o) else float(o)
+                     for o in words['onset']),
+                    (None if np.isnan(o) else float(o)
+                     for o in words['offset'])))
+
+    def to_frame(self, transcription_col_name='Transcription', wide=True):
+        # Rebuilds the tidy .csv file: the rows it was made from, the
+        # transcriptions and, if there are any, a pair of onset and offset
+        # columns per word
+        meta = dict(self._read('SELECT key, value FROM meta'))
+        columns = json.loads(meta.get('columns', '[]'))
+        rows = self._read(
+            'SELECT participant, item, data FROM items ORDER BY position')
+        df = pd.DataFrame([json.loads(data) for _, _, data in rows],
+                          columns=[c for c in columns
+                                   if c != transcription_col_name])
+        keys = [(p, item) for p, item, _ in rows]
+        known = self.transcriptions()
+        if known or transcription_col_name in columns:
+            df[transcription_col_name] = pd.Series(
+                [known.get(key, pd.NA) for key in keys], dtype=object)
+            if transcription_col_name in columns:
+                df = df[columns]
+        if not wide:
+            return df
+
+        timings = self._read(
+            'SELECT participant, item, word_index, "case", onset, offset '
+            'FROM timings')
+        if not timings:
+            return df
+        # As in the .csv file written by align, words that gentle couldn't
+        # place get an infinite onset and offset, and the columns run to the
+        # longest transcription
+        longest_sent = max(
+            len(str(t).split()) for t in df[transcription_col_name].unique())
+        timing = np.full((len(df), longest_sent * 2), np.nan)
+        rows_by_key = {key: n for n, key in enumerate(keys)}
+        for p, item, word_index, case, onset, offset in timings:
+            n = rows_by_key.get((p, item))
+            if n is None or word_index > longest_sent:
+                continue
+            success = case == 'success'
+            timing[n, word_index * 2 - 2] = onset if success else np.inf
+            timing[n, word_index * 2 - 1] = offset if success else np.inf
+        onset_cols = [f'Word{i + 1}Onset' for i in range(longest_sent)]
+        offset_cols = [f'Word{i + 1}Offset' for i in range(longest_sent)]
+        timing_cols = [c for pair in zip(onset_cols, offset_cols)
+                       for c in pair]
+        return pd.concat(
+            [df, pd.DataFrame(timing, columns=timing_cols)], axis=1)
+
+    def to_long_frame(self):
+        return pd.DataFrame(
+            [(p, item, word_index, word, case, onset, offset)
+             for p, item, word_index, word, case, onset, offset in self._read(
+                 'SELECT t.participant, json_extract(i.data, '
+                 '\'$.ItemNumber\'), t.word_index, t.word, t."case", '
+                 't.onset, t.offset FROM timings t JOIN items i ON '
+                 't.participant = i.participant AND t.item = i.item '
+                 'ORDER BY i.position, t.word_index')],
+            columns=['Participant', 'ItemNumber', 'WordIndex', 'Word', 'Case',
+                     'Onset', 'Offset'])
+
+    def export_csv(self, path, transcription_col_name='Transcription',
+                   long_output=None, wide=True):
+        df = self.to_frame(transcription_col_name, wide)
+        with metrics.timer('csv.write'):
+            df.to_csv(path, na_rep='NA', index=False)
+        metrics.add_bytes('csv.write', written=os.path.getsize(path))
+        self.logger.info('Wrote file:\n%(f)s' % {'f': path})
+        if long_output is not None:
+            with metrics.timer('csv.write'):
+                self.to_long_frame().to_csv(
+                    long_output, na_rep='NA', index=False)
+            metrics.add_bytes(
+                'csv.write', written=os.path.getsize(long_output))
+            self.logger.info('Wrote file:\n%(f)s' % {'f': long_output})
+
+
+def add_state_arguments(parser):
+    parser.add_argument(
+        '--state', type=str, default=None,
+        help='Path to a SQLite database in which to keep the state of every '
+        'item (its conversion, transcription and alignment status, its '
+        'transcription and its word timings), updated an item at a time as '
+        'each one finishes. The .csv files can be written from it with '
+        '"aligner export-csv". Not used by default.',
+        dest='state')
+
+
+def open_state(args):
+    return StateStore(args.state) if args.state is not None else None
@@ -1,11 +1,20 @@
 import os
-import io
+import asyncio
+import subprocess
+import threading
 import logging
 import logging.config
-import pandas as pd
-from google.cloud import speech
-from pydub import AudioSegment
-from pydub.utils import mediainfo
+from concurrent.futures import ThreadPoolExecutor
+from .audio_index import AudioIndex
+from .file_index import FileIndex
+from .state import item_numbers
+from .vad import decode, encode_flac
+from .utils import TokenBucket, lazy_import
+from .metrics import metrics
+
+pd = lazy_import('pandas')
+speech = lazy_import('google.cloud.speech')
+pydub = lazy_import('pydub')
 
 
 logger = logging.getLogger(__name__)
@@ -13,93 +22,289 @@ logger = logging.getLogger(__name__)
 
 class SpeechToText:
     def __init__(self, mp3_dir, data_dir, transcribed_csv,
-                 transcription_col_name, save_every_n):
+                 transcription_col_name, save_every_n, pcm_cache=None,
+                 concurrency=1, rate=None, client=None,
+                 recognition_cache=None, state=None, files=None, vad=None):
         self.logger = logger.getChild(self.__class__.__name__)
         self.data_dir = data_dir
         self.mp3_dir = os.path.join(data_dir, mp3_dir)
         self.transcribed_csv = transcribed_csv
         self.transcription_col_name = transcription_col_name
         self.save_every_n = save_every_n
-        self.client = speech.SpeechClient()
+        self.pcm_cache = pcm_cache
+        self.concurrency = concurrency
+        self.limiter = TokenBucket(rate) if rate else None
+        self.recognition_cache = recognition_cache
+        self.state = state
+        self.vad = vad
+        self.files = files if files is not None else FileIndex(self.mp3_dir)
+        self.audio_indexes = {}
+        self.audio_indexes_lock = threading.Lock()
+        self.client = client if client is not None else speech.SpeechClient()
 
     def transcribe(self):
-        df = pd.read_csv(self.transcribed_csv)
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.transcribed_csv)
+        metrics.add_bytes(
+            'csv.read', read=os.path.getsize(self.transcribed_csv))
 
         # If there aren't yet any strings in the Transcription column, pandas
         # will treat it as a float, so we must cast it to a string
         df = df.astype({self.transcription_col_name: str}, errors='raise')
         df[self.transcription_col_name] = \
             df[self.transcription_col_name].replace('nan', pd.NA)
+        self._load_state(df)
 
-        i = 1
+        # Items are numbered by their position among the participant's rows,
+        # like the .mp3 files and the state store
+        items = item_numbers(df)
+        rows = []
+        self.files.refresh()
         for idx in df[df[self.transcription_col_name].isna()].index:
-            p = df.iloc[idx]['Participant']
-            item = df.iloc[idx]['ItemNumber']
+            p, item = df.at[idx, 'Participant'], int(items[idx])
+            if not self.files.has(p, item, 'mp3'):
+                self.logger.warning(
+                    'File not found: %(mp3_file)s. Skipping.' %
+                    {'mp3_file': os.path.join(
+                        self.mp3_dir, f'{p}/item_number_{item:02}.mp3')})
+                continue
+            rows.append((idx, p, item))
 
-            mp3_file = os.path.join(
-                self.mp3_dir, f'{p}/item_number_{item:02}.mp3')
+        if self.concurrency > 1:
             try:
-                mp3 = AudioSegment.from_mp3(mp3_file)
-                info = mediainfo(mp3_file)
-                self.logger.debug(
-                    'Audio file, %(mp3_file)s has %(channel)s channel(s).' %
-                    {'mp3_file': mp3_file, 'channel': info['channels']})
-                content = io.BytesIO()
-                # Convert to flac since the Google Cloud speech-to-text support
-                # for .mp3 files is only in beta mode so far
-                mp3.export(content, format='flac')
-
-                audio = speech.RecognitionAudio(content=content.read())
-                config = speech.RecognitionConfig(
-                    encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
-                    language_code='en-US',
-                    audio_channel_count=int(info['channels']))
-                self.logger.info(
-                    'Submitting .mp3 file for item number %(item)s for '
-                    'participant %(p)s to Google\'s Speech-to-Text service.' %
-                    {'p': p, 'item': item})
-                response = self.client.recognize(config=config, audio=audio)
-                self.logger.debug(
-                    'Response from Google\'s Speech-to-Text service:\n'
-                    '%(response)s' % {'response': response})
-                if response.results:
-                    transcription = \
-                        response.results[0].alternatives[0].transcript\
-                                                           .capitalize() + '?'
-                else:
-                    self.logger.warning(
-                        'No audio detected for item number %(i)s for '
-                        'participant %(p)s.' %
-                        {'i': item,
-                         'p': p})
-                    transcription = 'Empty'
-
-                df.at[idx, self.transcription_col_name] = transcription
-
-                if i % self.save_every_n == 0:
-                    df.to_csv(self.transcribed_csv, na_rep='NA', index=False)
-                    self.logger.debug(
-                        'Saved file %(f)s' %
-                        {'f': self.transcribed_csv})
-                i += 1
-
-            except FileNotFoundError:
+                asyncio.run(self._transcribe_async(df, rows))
+            finally:
+                self._save(df)
+        else:
+            self._transcribe_serial(df, rows)
+            self._save(df)
+
+        self._finish()
+
+    def _load_state(self, df):
+        # Transcriptions that made it into the store but not into the .csv
+        # file (because a run was interrupted between checkpoints) don't
+        # have to be recognized again
+        if self.state is not None:
+            self.state.add_rows(df, self.transcription_col_name)
+            self.state.fill_transcriptions(df, self.transcription_col_name)
+
+    def _store(self, p, item, transcription):
+        if self.state is not None:
+            self.state.set_transcription(p, item, transcription)
+            self.state.set_status(
+                p, item, 'transcribe',
+                'empty' if transcription == 'Empty' else 'transcribed')
+
+    def _checkpoint(self, df, done):
+        # With a state store, every transcription is saved as soon as it
+        # comes back, so the .csv file only has to be written at the end
+        if self.state is None and done % self.save_every_n == 0:
+            self._save(df)
+
+    def _finish(self):
+        for index in self.audio_indexes.values():
+            index.save()
+        self.files.save()
+
+        if self.recognition_cache is not None:
+            self.recognition_cache.evict()
+            self.logger.info(
+                'Recognition cache: %(hits)s hit(s), %(misses)s miss(es).' %
+                self.recognition_cache.stats())
+
+    def _transcribe_serial(self, df, rows):
+        i = 1
+        for idx, p, item in rows:
+            try:
+                content, channels = self._prepare(p, item)
+            except FileNotFoundError as e:
                 self.logger.warning(
                     'File not found: %(mp3_file)s. Skipping.' %
-                    {'mp3_file': mp3_file})
+                    {'mp3_file': e.filename})
+                continue
+
+            df.at[idx, self.transcription_col_name] = self._recognize(
+                p, item, content, channels)
+            self._store(p, item, df.at[idx, self.transcription_col_name])
+
+            self._checkpoint(df, i)
+            i += 1
+
+    async def _transcribe_async(self, df, rows):
+        # Audio is prepared by one set of workers and submitted by another,
+        # so that the next files are already converted by the time a slot
+        # for submitting them frees up. Results are written back to the rows
+        # they belong to in whatever order they arrive.
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue()
+        for row in rows:
+            pending.put_nowait(row)
+        prepared = asyncio.Queue(maxsize=self.concurrency * 2)
+        done = 0
+
+        async def prepare():
+            while True:
+                try:
+                    idx, p, item = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    content, channels = await loop.run_in_executor(
+                        executor, self._prepare, p, item)
+                except FileNotFoundError as e:
+                    self.logger.warning(
+                        'File not found: %(mp3_file)s. Skipping.' %
+                        {'mp3_file': e.filename})
+                    continue
+                await prepared.put((idx, p, item, content, channels))
+
+        async def submit():
+            nonlocal done
+            while True:
+                job = await prepared.get()
+                if job is None:
+                    return
+                idx, p, item, content, channels = job
+                df.at[idx, self.transcription_col_name] = \
+                    await loop.run_in_executor(
+                        executor, self._recognize, p, item, content, channels)
+                self._store(p, item, df.at[idx, self.transcription_col_name])
+                done += 1
+                self._checkpoint(df, done)
+
+        async def prepare_all():
+            await asyncio.gather(
+                *[prepare() for _ in range(self.concurrency)])
+            for _ in range(self.concurrency):
+                await prepared.put(None)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency * 2) as executor:
+            await asyncio.gather(
+                prepare_all(), *[submit() for _ in range(self.concurrency)])
+
+    def _prepare(self, p, item):
+        mp3_file = os.path.join(
+            self.mp3_dir, f'{p}/item_number_{item:02}.mp3')
+        meta = samples = None
+        if self.pcm_cache is not None:
+            if self.vad is not None:
+                samples, meta = self.pcm_cache.load(p, item, mp3_file)
+            else:
+                meta = self.pcm_cache.lookup(p, item, mp3_file)
+        if meta is not None:
+            source = meta['wav_file']
+        else:
+            source = mp3_file
+            # The channel count comes from the index, which probes the whole
+            # directory once from the .mp3 headers
+            meta = self._audio_index(p).get(f'item_number_{item:02}.mp3')
+        self.logger.debug(
+            'Audio file, %(mp3_file)s has %(channel)s channel(s).' %
+            {'mp3_file': mp3_file, 'channel': meta['channels']})
+        if self.vad is not None:
+            # Only the span of the recording with speech in it is sent, so
+            # the samples are decoded (unless they're cached already) to
+            # find it, and just that span is encoded as flac
+            rate = int(meta['sample_rate'])
+            if samples is None:
+                samples = decode(source, rate, int(meta['channels']))
+            samples, _ = self.vad.trim(samples, rate)
+            return encode_flac(samples, rate), int(meta['channels'])
+        # Convert to flac since the Google Cloud speech-to-text support
+        # for .mp3 files is only in beta mode so far. A single ffmpeg run
+        # decodes the audio and encodes the samples it decoded as flac.
+        with metrics.timer('stt.encode'):
+            proc = subprocess.run(
+                [pydub.AudioSegment.converter, '-v', 'error', '-i', source,
+                 '-vn', '-f', 'flac', '-'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        metrics.add_bytes('stt.encode', read=os.path.getsize(source),
+                          written=len(proc.stdout))
+        if proc.returncode != 0:
+            raise pydub.exceptions.CouldntEncodeError(
+                'ffmpeg returned error code %(code)s:\n%(err)s' %
+                {'code': proc.returncode,
+                 'err': proc.stderr.decode('utf-8', errors='replace')})
+        return proc.stdout, int(meta['channels'])
+
+    def _recognize(self, p, item, content, channels):
+        config = {'encoding': 'FLAC', 'language_code': 'en-US',
+                  'audio_channel_count': channels}
+
+        entry = None
+        if self.recognition_cache is not None:
+            key = self.recognition_cache.key(content, config)
+            entry = self.recognition_cache.get(key)
+            metrics.count('stt.cache_hit' if entry is not None
+                          else 'stt.cache_miss')
+            if entry is not None:
+                self.logger.info(
+                    'Found cached transcription for item number %(item)s for '
+                    'participant %(p)s.' % {'p': p, 'item': item})
+
+        if entry is None:
+            # Only requests that actually go out count against the quota
+            if self.limiter is not None:
+                self.limiter.acquire()
+            audio = speech.RecognitionAudio(content=content)
+            self.logger.info(
+                'Submitting .mp3 file for item number %(item)s for '
+                'participant %(p)s to Google\'s Speech-to-Text service.' %
+                {'p': p, 'item': item})
+            with metrics.timer('stt.request'):
+                response = self.client.recognize(
+                    config=speech.RecognitionConfig(
+                        encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+                        language_code=config['language_code'],
+                        audio_channel_count=channels),
+                    audio=audio)
+            metrics.add_bytes('stt.request', written=len(content))
+            self.logger.debug(
+                'Response from Google\'s Speech-to-Text service:\n'
+                '%(response)s' % {'response': response})
+            entry = {'transcript': None}
+            if response.results:
+                entry['transcript'] = \
+                    response.results[0].alternatives[0].transcript
+            if self.recognition_cache is not None:
+                self.recognition_cache.put(key, entry)
+
+        if entry['transcript'] is not None:
+            return entry['transcript'].capitalize() + '?'
+        self.logger.warning(
+            'No audio detected for item number %(i)s for '
+            'participant %(p)s.' %
+            {'i': item,
+             'p': p})
+        return 'Empty'
 
-        df.to_csv(self.transcribed_csv, na_rep='NA', index=False)
+    def _save(self, df):
+        with metrics.timer('csv.write'):
+            df.to_csv(self.transcribed_csv, na_rep='NA', index=False)
+        metrics.add_bytes(
+            'csv.write', written=os.path.getsize(self.transcribed_csv))
         self.logger.debug(
             'Saved file %(f)s' %
             {'f': self.transcribed_csv})
 
+    def _audio_index(self, p):
+        with self.audio_indexes_lock:
+            if p not in self.audio_indexes:
+                self.audio_indexes[p] = AudioIndex(
+                    os.path.join(self.mp3_dir, str(p)))
+                self.audio_indexes[p].refresh()
+            return self.audio_indexes[p]
+
 
 def main():
     import argparse
-    from . import log_conf
     from .utils import set_class_log_level
-
-    logging.config.dictConfig(log_conf)
+    from .pcm_cache import PCMCache
+    from .recognition_cache import RecognitionCache
+    from .metrics import add_metrics_arguments, report_metrics
+    from .state import add_state_arguments, open_state
+    from .vad import add_vad_arguments, open_vad
 
     parser = argparse.ArgumentParser(
         description='Attempts a first-pass transcription of the .mp3 files '
@@ -135,7 +340,8 @@ def main():
         'Speech-to-Text API (default is 10). This avoids being billed for '
         '(too many) resubmissions in case the script errors out and you have '
         'to rerun it after fixing the error. Setting to 1 increases disk I/O '
-        'but maximizes money savings.',
+        'but maximizes money savings. Not needed with --state, which saves '
+        'every transcription as soon as it comes back.',
         dest='save_every_n')
 
     parser.add_argument(
@@ -150,14 +356,66 @@ def main():
         help='Set the logging level.',
         dest='log')
 
+    parser.add_argument(
+        '--pcm-cache', type=str, default=None,
+        help='Path to the PCM cache written by to_mp3. Items found in the '
+        'cache are read from there instead of decoding the .mp3 file again.',
+        dest='pcm_cache')
+
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='Number of requests to have in flight to Google\'s '
+        'Speech-to-Text API at once (default is 1, which submits the files '
+        'one after another). With more than 1, the next files are converted '
+        'while earlier ones are being transcribed.',
+        dest='concurrency')
+
+    parser.add_argument(
+        '--rate', type=float, default=None,
+        help='Maximum number of requests per second to send to Google\'s '
+        'Speech-to-Text API, to stay within the API quota. Not limited by '
+        'default.',
+        dest='rate')
+
+    parser.add_argument(
+        '--cache', type=str, default=None,
+        help='Path to a directory in which to cache the responses from '
+        'Google\'s Speech-to-Text API, keyed by the audio and the recognition'
+        ' settings, so that audio that has already been transcribed is never '
+        'submitted (and billed) again. Not used by default.',
+        dest='cache')
+
+    parser.add_argument(
+        '--cache-size', type=int, default=256,
+        help='Maximum size of the response cache in megabytes (default is '
+        '256). The least recently used responses are evicted first.',
+        dest='cache_size')
+
+    add_state_arguments(parser)
+    add_vad_arguments(parser)
+    add_metrics_arguments(parser)
+
     args = parser.parse_args()
 
+    # Loaded only once there's work to do, so that --help stays quick
+    from . import log_conf
+    logging.config.dictConfig(log_conf)
+
     if args.credentials != '':
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.credentials
 
     transcriber = SpeechToText(
-        args.mp3_dir, args.data_dir, args.file_, args.tcol, args.save_every_n)
+        args.mp3_dir, args.data_dir, args.file_, args.tcol, args.save_every_n,
+        PCMCache(args.pcm_cache) if args.pcm_cache is not None else None,
+        args.concurrency, args.rate,
+        recognition_cache=RecognitionCache(
+            args.cache, args.cache_size * 1024 ** 2)
+        if args.cache is not None else None,
+        state=open_state(args), vad=open_vad(args))
 
     set_class_log_level(transcriber, args.log)
+    if transcriber.vad is not None:
+        set_class_log_level(transcriber.vad, args.log)
 
-    transcriber.transcribe()
+    with report_metrics(args):
+        transcriber.transcribe()
@@ -0,0 +1,118 @@
+import re
+from .metrics import metrics
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+
+
+def _fill_gaps(intervals):
+    # Praat expects the intervals of a tier to be contiguous, so the time
+    # before the first interval is marked as silence and any later gaps get
+    # an empty interval
+    filled = []
+    prev_offset = None
+    for xmin, xmax, text in intervals:
+        if prev_offset is None:
+            filled.append((0, xmin, '{SL}'))
+        elif xmin != prev_offset:
+            filled.append((prev_offset, xmin, ''))
+        filled.append((xmin, xmax, text))
+        prev_offset = xmax
+    return filled
+
+
+def word_intervals(words):
+    return _fill_gaps(
+        (w['start'], w['end'], w['alignedWord'])
+        for w in words if w['case'] == 'success')
+
+
+def phone_intervals(words):
+    def phones():
+        for w in words:
+            if w['case'] != 'success':
+                continue
+            start = w['start']
+            for phone in w.get('phones', []):
+                end = start + phone['duration']
+                yield start, end, phone['phone']
+                start = end
+    return _fill_gaps(phones())
+
+
+def write_textgrid(textgrid_file, xmin, xmax, tiers):
+    # Each interval is written straight to the (buffered) file as it's
+    # formatted, rather than building up the whole file as one string
+    with metrics.timer('textgrid.write'), \
+            open(textgrid_file, 'w', buffering=1 << 16) as tgf:
+        tgf.write('File type = "ooTextFile"\n')
+        tgf.write('Object class = "TextGrid"\n\n')
+        tgf.write(f'xmin = {xmin}\n')
+        tgf.write(f'xmax = {xmax}\n')
+        tgf.write('tiers? <exists>\n')
+        tgf.write(f'size = {len(tiers)}\n')
+        tgf.write('item []:')
+        for n, (name, intervals) in enumerate(tiers):
+            tgf.write(f'\n    item [{n + 1}]:\n')
+            tgf.write('        class = "IntervalTier"\n')
+            tgf.write(f'        name = "{name}"\n')
+            tgf.write(f'        xmin = {xmin}\n')
+            tgf.write(f'        xmax = {xmax}\n')
+            tgf.write(f'        intervals: size = {len(intervals)}')
+            for i, (start, end, text) in enumerate(intervals):
+                text = str(text).replace('"', '""')
+                tgf.write(f'\n            intervals [{i + 1}]:'
+                          f'\n                xmin = {start}'
+                          f'\n                xmax = {end}'
+                          f'\n                text = "{text}"')
+        metrics.add_bytes('textgrid.write', written=tgf.tell())
+
+
+_FIELD = re.compile(r'^\s*(xmin|xmax|text|name|class) = (.*?)\s*$')
+
+
+def _value(raw):
+    if raw.startswith('"'):
+        return raw[1:-1].replace('""', '"')
+    return float(raw)
+
+
+def read_textgrid(textgrid_file):
+    # Parses a TextGrid in Praat's long text format into the file's
+    # xmin/xmax and, for each tier, NumPy arrays of interval start and end
+    # times and labels
+    textgrid = {'xmin': None, 'xmax': None, 'tiers': {}}
+    tier = None
+    interval = None
+    with open(textgrid_file, 'r', buffering=1 << 16) as tgf:
+        for line in tgf:
+            stripped = line.strip()
+            if stripped.startswith('item [') and stripped != 'item []:':
+                tier = {'xmin': [], 'xmax': [], 'text': []}
+                interval = None
+                continue
+            if stripped.startswith('intervals ['):
+                interval = {}
+                continue
+            match = _FIELD.match(line)
+            if match is None:
+                continue
+            field, value = match.group(1), _value(match.group(2))
+            if tier is None:
+                if field in ('xmin', 'xmax'):
+                    textgrid[field] = value
+            elif interval is None:
+                if field == 'name':
+                    textgrid['tiers'][value] = tier
+            else:
+                interval[field] = value
+                if field == 'text':
+                    for key in ('xmin', 'xmax', 'text'):
+                        tier[key].append(interval[key])
+
+    for name, tier in textgrid['tiers'].items():
+        textgrid['tiers'][name] = {
+            'xmin': np.array(tier['xmin'], dtype=np.float64),
+            'xmax': np.array(tier['xmax'], dtype=np.float64),
+            'text': np.array(tier['text'], dtype=object)}
+    return textgrid
@@ -1,7 +1,12 @@
 import os
 import logging
 import logging.config
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import metrics
+from .file_index import FileIndex
+from .utils import lazy_import
+
+pd = lazy_import('pandas')
 
 
 logger = logging.getLogger(__name__)
@@ -13,23 +18,47 @@ class TranscriptionExtractor:
             transcribed_csv,
             transcription_col_name,
             data_dir,
-            overwrite):
+            overwrite,
+            state=None,
+            files=None,
+            jobs=1):
         self.logger = logger.getChild(self.__class__.__name__)
         self.transcribed_csv = transcribed_csv
         self.transcription_col_name = transcription_col_name
         self.data_dir = data_dir
         self.overwrite = overwrite
+        self.state = state
+        self.jobs = jobs
+        self.files = files if files is not None else FileIndex(
+            transcriptions_dir=os.path.join(data_dir, 'transcriptions'))
 
     def get_transcriptions(self):
-        df = pd.read_csv(self.transcribed_csv)
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.transcribed_csv)
+        metrics.add_bytes(
+            'csv.read', read=os.path.getsize(self.transcribed_csv))
+        if self.state is not None:
+            self.state.fill_transcriptions(df, self.transcription_col_name)
+        self.files.refresh()
         groupings = df.groupby('Participant')
-        for _, grp_df in groupings:
-            self.extract_transcriptions(
-                grp_df,
-                self.transcription_col_name,
-                self.data_dir)
-
-    def extract_transcriptions(self, grp_df, col_name, data_dir):
+        # Most of the time goes into waiting on the filesystem, so the files
+        # are written from several threads at once
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = []
+            for _, grp_df in groupings:
+                futures.extend(self.extract_transcriptions(
+                    grp_df,
+                    self.transcription_col_name,
+                    self.data_dir,
+                    executor))
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                self.files.save()
+
+    def extract_transcriptions(self, grp_df, col_name, data_dir,
+                               executor=None):
         p = str(grp_df['Participant'].unique()[0])
         transcriptions = grp_df[col_name].tolist()
 
@@ -40,39 +69,75 @@ class TranscriptionExtractor:
             self.logger.info(
                 'Created directory:\n%(dir)s' % {'dir': transcriptions_dir})
 
-        for i, t in enumerate(transcriptions):
-            if str(t) == 'nan':
-                self.logger.warning(
-                    'Missing transcription for item %(i)s for participant '
-                    '%(p)s' % {'i': i + 1, 'p': p})
-            else:
-                f = os.path.join(
-                    transcriptions_dir, str(i + 1).zfill(2) + '.txt')
-
-                if os.path.exists(f) and not self.overwrite:
-                    self.logger.info('File, %(f)s, already exists. Skipping.' %
-                                     {'f': f})
-
-                if os.path.exists(f) and self.overwrite:
-                    self.logger.info('File, %(f)s, already exists. '
-                                     'Overwriting.' % {'f': f})
-
-                if self.overwrite or not os.path.exists(f):
-                    with open(f, 'w', encoding='utf-8') as file_:
-                        file_.write(str(t) + '\n')
-                    self.logger.info('Wrote file %(f)s' % {'f': f})
+        if executor is None:
+            for i, t in enumerate(transcriptions):
+                self.write_transcription(transcriptions_dir, p, i, t)
+            return []
+        return [executor.submit(
+            self.write_transcription, transcriptions_dir, p, i, t)
+            for i, t in enumerate(transcriptions)]
+
+    def _unchanged(self, p, item, content):
+        # Whether the transcription file already holds content. Its size is
+        # known from the file index, so only a file of the right size has to
+        # be read to tell.
+        indexed = self.files.get(p, item, 'transcript')
+        encoded = content.encode('utf-8')
+        if indexed is None or indexed['size'] != len(encoded):
+            return False
+        try:
+            with open(indexed['path'], 'rb') as file_:
+                return file_.read() == encoded
+        except FileNotFoundError:
+            return False
+
+    def write_transcription(self, transcriptions_dir, p, i, t):
+        if str(t) == 'nan':
+            self.logger.warning(
+                'Missing transcription for item %(i)s for participant '
+                '%(p)s' % {'i': i + 1, 'p': p})
+        else:
+            f = os.path.join(
+                transcriptions_dir, str(i + 1).zfill(2) + '.txt')
+
+            content = str(t) + '\n'
+            exists = self.files.has(p, i + 1, 'transcript')
+
+            if exists and not self.overwrite:
+                self.logger.info('File, %(f)s, already exists. Skipping.' %
+                                 {'f': f})
+                return
+
+            if exists and self._unchanged(p, i + 1, content):
+                metrics.count('extract.unchanged')
+                self.logger.info('File, %(f)s, is up to date. Skipping.' %
+                                 {'f': f})
+                return
+
+            if exists:
+                self.logger.info('File, %(f)s, has changed. '
+                                 'Overwriting.' % {'f': f})
+
+            with metrics.timer('extract.write'), \
+                    open(f, 'w', encoding='utf-8') as file_:
+                file_.write(content)
+            metrics.add_bytes('extract.write', written=os.path.getsize(f))
+            self.files.record(p, i + 1, 'transcript')
+            self.logger.info('Wrote file %(f)s' % {'f': f})
 
 
 def main():
     import argparse
-    from . import log_conf
     from .utils import set_class_log_level
-
-    logging.config.dictConfig(log_conf)
+    from .metrics import add_metrics_arguments, report_metrics
+    from .state import add_state_arguments, open_state
 
     parser = argparse.ArgumentParser(
         description='Extracts transcriptions from a .csv file to a single '
-        'file per transcription for input into a forced aligner.')
+        'file per transcription. align reads the transcriptions straight '
+        'from the .csv file or the state store, so this is only needed to '
+        'keep a copy of them as .txt files (or for align --transcripts '
+        'files).')
 
     parser.add_argument(
         '--file', '-f', type=str,
@@ -105,11 +170,18 @@ def main():
     parser.add_argument(
         '--overwrite', '-o', action='store_true',
         help='Re-extracts transcriptions for all participants in case the '
-        'transcription in the .csv file has changed.',
+        'transcription in the .csv file has changed. Only the files whose '
+        'content has changed are rewritten.',
         dest='overwrite')
 
     parser.set_defaults(overwrite=False)
 
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=4,
+        help='Number of transcription files to write at once (default is '
+        '4).',
+        dest='jobs')
+
     parser.add_argument(
         '--log', '-l', type=str,
         default='warning',
@@ -117,11 +189,20 @@ def main():
         help='Set the logging level.',
         dest='log')
 
+    add_state_arguments(parser)
+    add_metrics_arguments(parser)
+
     args = parser.parse_args()
 
+    # Loaded only once there's work to do, so that --help stays quick
+    from . import log_conf
+    logging.config.dictConfig(log_conf)
+
     extractor = TranscriptionExtractor(
-        args.file_, args.tcol, args.data_dir, args.overwrite)
+        args.file_, args.tcol, args.data_dir, args.overwrite,
+        open_state(args), jobs=args.jobs)
 
     set_class_log_level(extractor, args.log)
 
-    extractor.get_transcriptions()
+    with report_metrics(args):
+        extractor.get_transcriptions()
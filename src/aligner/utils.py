@@ -1,4 +1,13 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import types
 import logging
+import importlib
+import threading
+import contextlib
 
 
 def set_class_log_level(cls, level):
@@ -9,3 +18,113 @@ def set_class_log_level(cls, level):
         'info': logging.INFO,
         'debug': logging.DEBUG}
     cls.logger.setLevel(levels[level])
+
+
+class _LazyModule(types.ModuleType):
+    # Stands in for a module until one of its attributes is first used, at
+    # which point the module is imported and its attributes copied over
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lock'] = threading.Lock()
+
+    def __getattr__(self, attr):
+        with self._lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    # Lets modules name their heavy dependencies (pandas, numpy, pydub, the
+    # Speech-to-Text client) at the top as usual without paying for them,
+    # or needing them installed, until they're used, so that --help and
+    # runs with nothing to do start quickly
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def dump_json_atomic(obj, path, **kwargs):
+    # Write to a temporary file first so that a crash mid-write never
+    # leaves a truncated file behind. The temporary file is named after the
+    # process and thread, so that workers writing the same file at once
+    # don't write into each other's.
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, **kwargs)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    # Holds an exclusive lock on path + '.lock' for the duration, so that
+    # processes (on the same machine, or on several machines sharing a
+    # filesystem with POSIX locks) can read, merge and rewrite a shared file
+    # without losing each other's changes
+    with open(path + '.lock', 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def evict_lru(root, max_bytes):
+    # Files that share a name up to their extension (e.g., an audio file
+    # and its metadata) are evicted together, oldest modification first
+    groups = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stem = os.path.splitext(path)[0]
+            size, mtime, paths = groups.get(stem, (0, 0, []))
+            groups[stem] = (
+                size + stat.st_size, max(mtime, stat.st_mtime), paths + [path])
+
+    total = sum(size for size, _, _ in groups.values())
+    removed = 0
+    for size, _, paths in sorted(groups.values(), key=lambda g: g[1]):
+        if total <= max_bytes:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        removed += 1
+    return removed
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
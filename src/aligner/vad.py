@@ -0,0 +1,180 @@
+import math
+import logging
+import subprocess
+from .metrics import metrics
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+pydub = lazy_import('pydub')
+
+
+logger = logging.getLogger(__name__)
+
+# How ffmpeg names the raw sample formats that the samples can come in
+_RAW_FORMATS = {'uint8': 'u8', 'int16': 's16le', 'int32': 's32le'}
+
+
+class VoiceActivityDetector:
+    # Finds the span of a recording that has speech in it from the energy of
+    # short frames of its samples, so that the silence before and after it
+    # doesn't have to be sent to the speech-to-text service or to gentle. A
+    # frame counts as speech if it's within range_db of the loudest frame
+    # and at least margin_db above the noise floor (the energy of the
+    # quietest tenth of the frames), and the span runs from the first to the
+    # last run of at least min_speech_ms of speech, widened by padding_ms on
+    # either side so that soft onsets and offsets aren't clipped.
+    def __init__(self, frame_ms=10, range_db=35, margin_db=10,
+                 min_speech_ms=60, padding_ms=250):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.frame_ms = frame_ms
+        self.range_db = range_db
+        self.margin_db = margin_db
+        self.min_speech_ms = min_speech_ms
+        self.padding_ms = padding_ms
+
+    def settings(self):
+        # Everything that decides where the span falls, which goes into the
+        # keys of anything cached from trimmed audio
+        return {'frame_ms': self.frame_ms, 'range_db': self.range_db,
+                'margin_db': self.margin_db,
+                'min_speech_ms': self.min_speech_ms,
+                'padding_ms': self.padding_ms}
+
+    def frame_energies(self, samples, sample_rate):
+        # The mean energy of each whole frame in dB, with the channels mixed
+        # down first
+        samples = np.asarray(samples)
+        mono = samples.astype(np.float32)
+        if samples.dtype == np.uint8:
+            mono -= 128
+        if mono.ndim == 2:
+            mono = mono.mean(axis=1)
+        size = max(1, sample_rate * self.frame_ms // 1000)
+        frames = mono[:len(mono) // size * size].reshape(-1, size)
+        power = np.einsum('ij,ij->i', frames, frames) / size
+        return 10 * np.log10(power + 1e-10), size
+
+    def span(self, samples, sample_rate):
+        # Returns the first sample of the speech and the sample after its
+        # last one, or None if there's no speech to be found
+        with metrics.timer('vad'):
+            energies, size = self.frame_energies(samples, sample_rate)
+            if energies.size == 0:
+                return None
+            floor = np.percentile(energies, 10)
+            threshold = max(energies.max() - self.range_db,
+                            floor + self.margin_db)
+            run = max(1, math.ceil(self.min_speech_ms / self.frame_ms))
+            # A window of run frames that are all above the threshold is
+            # speech; shorter bursts (clicks, bumps of the microphone) aren't
+            windows = np.convolve(
+                energies >= threshold, np.ones(run, dtype=int), 'valid')
+            starts = np.flatnonzero(windows == run)
+            if starts.size == 0:
+                return None
+            padding = sample_rate * self.padding_ms // 1000
+            start = max(0, int(starts[0]) * size - padding)
+            end = min(len(samples),
+                      (int(starts[-1]) + run) * size + padding)
+        metrics.count('vad.trimmed_ms', round(
+            (len(samples) - (end - start)) * 1000 / sample_rate))
+        return start, end
+
+    def trim(self, samples, sample_rate):
+        # Returns the samples that have speech in them and the number of
+        # seconds that were cut from the front. Recordings with no speech in
+        # them, or no silence to speak of, are left whole.
+        span = self.span(samples, sample_rate)
+        if span is None:
+            self.logger.debug('Found no speech to trim around.')
+            return samples, 0.0
+        start, end = span
+        self.logger.debug(
+            'Found speech from %(start).3fs to %(end).3fs of %(len).3fs.' %
+            {'start': start / sample_rate, 'end': end / sample_rate,
+             'len': len(samples) / sample_rate})
+        return samples[start:end], start / sample_rate
+
+
+def decode(source, sample_rate, channels):
+    # Decodes an audio file to 16-bit samples with ffmpeg, resampled and
+    # mixed to the given rate and number of channels
+    with metrics.timer('vad.decode'):
+        proc = subprocess.run(
+            [pydub.AudioSegment.converter, '-v', 'error', '-i', source,
+             '-vn', '-ac', str(channels), '-ar', str(sample_rate),
+             '-f', 's16le', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise pydub.exceptions.CouldntDecodeError(
+            'ffmpeg returned error code %(code)s:\n%(err)s' %
+            {'code': proc.returncode,
+             'err': proc.stderr.decode('utf-8', errors='replace')})
+    metrics.add_bytes('vad.decode', written=len(proc.stdout))
+    samples = np.frombuffer(proc.stdout, dtype='<i2')
+    return samples[:len(samples) // channels * channels].reshape(
+        -1, channels)
+
+
+def encode_flac(samples, sample_rate):
+    # Encodes samples (one column per channel) as flac with ffmpeg
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    with metrics.timer('vad.encode'):
+        proc = subprocess.run(
+            [pydub.AudioSegment.converter, '-v', 'error',
+             '-f', _RAW_FORMATS[samples.dtype.name], '-ar', str(sample_rate),
+             '-ac', str(samples.shape[1]), '-i', '-', '-f', 'flac', '-'],
+            input=np.ascontiguousarray(samples).tobytes(),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise pydub.exceptions.CouldntEncodeError(
+            'ffmpeg returned error code %(code)s:\n%(err)s' %
+            {'code': proc.returncode,
+             'err': proc.stderr.decode('utf-8', errors='replace')})
+    metrics.add_bytes('vad.encode', read=samples.nbytes,
+                      written=len(proc.stdout))
+    return proc.stdout
+
+
+def shift_alignment(alignment, offset):
+    # Moves the word timings in an alignment of trimmed audio back onto the
+    # timeline of the whole recording, and records how far they were moved
+    if offset:
+        for word in alignment.get('words', []):
+            for field in ('start', 'end'):
+                if field in word:
+                    word[field] = round(word[field] + offset, 6)
+    alignment['audio_offset'] = offset
+    return alignment
+
+
+def add_vad_arguments(parser):
+    parser.add_argument(
+        '--vad', action='store_true',
+        help='Trims the silence before and after the speech in each '
+        'recording, found from the energy of its samples, before it\'s sent '
+        'to the speech-to-text service or to gentle. The word timings are '
+        'still relative to the start of the whole recording. Not used by '
+        'default.',
+        dest='vad')
+
+    parser.add_argument(
+        '--vad-range', type=float, default=35,
+        help='With --vad, how many dB below the loudest part of a recording '
+        'still counts as speech (default is 35).',
+        dest='vad_range')
+
+    parser.add_argument(
+        '--vad-padding', type=int, default=250,
+        help='With --vad, the number of milliseconds of audio to keep before '
+        'and after the speech (default is 250).',
+        dest='vad_padding')
+
+
+def open_vad(args):
+    if not args.vad:
+        return None
+    return VoiceActivityDetector(range_db=args.vad_range,
+                                 padding_ms=args.vad_padding)
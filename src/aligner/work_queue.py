@@ -0,0 +1,216 @@
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    kind TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, participant, item));
+CREATE INDEX IF NOT EXISTS queue_status ON queue (status, position);
+'''
+
+# A participant's unit can only be claimed once all of its items are
+# through, and the study's once every participant is
+_CLAIMABLE = '''
+SELECT kind, participant, item, status, owner, attempts FROM queue q
+WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+AND (kind = 'item'
+     OR (kind = 'participant' AND NOT EXISTS (
+         SELECT 1 FROM queue d WHERE d.kind = 'item'
+         AND d.participant = q.participant
+         AND d.status IN ('pending', 'leased')))
+     OR (kind = 'study' AND NOT EXISTS (
+         SELECT 1 FROM queue d WHERE d.kind != 'study'
+         AND d.status IN ('pending', 'leased'))))
+ORDER BY kind = 'item', position
+LIMIT 1
+'''
+
+
+class WorkQueue:
+    # Units of work shared by workers on any number of machines, kept in a
+    # table of a SQLite database (normally the state store's). There's a
+    # unit per (participant, item), which converts, transcribes and aligns
+    # the item; a unit per participant, which merges the participant's
+    # alignments into their alignment store and TextGrid files once all of
+    # their items are through; and a unit for the study, which writes the
+    # .csv file at the end. A worker claims a unit by taking a lease on it,
+    # which it has to keep renewing; a unit whose lease has expired (e.g.,
+    # because its worker died) can be claimed by any other worker.
+    def __init__(self, path, lease_seconds=60, max_attempts=3):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Transactions are begun by hand, so that a claim can take the
+        # database's write lock before it reads which units are free
+        self.connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock, metrics.timer('queue.write'):
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def enqueue(self, items):
+        # items holds a (participant, item) pair per row of the .csv file, in
+        # order. Every unit that isn't currently leased starts over, so that
+        # a new pass picks up whatever has changed since the last one.
+        items = list(items)
+        now = time.time()
+        units = [('item', str(p), int(n), position)
+                 for position, (p, n) in enumerate(items)]
+        last = {}
+        for _, p, _, position in units:
+            last[p] = position
+        units.extend(('participant', p, 0, position)
+                     for p, position in last.items())
+        units.append(('study', '', 0, len(items)))
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM queue WHERE status != 'leased'")
+            connection.executemany(
+                'INSERT OR IGNORE INTO queue (kind, participant, item, '
+                'position, status, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                [unit + ('pending', now) for unit in units])
+        self.logger.info(
+            'Queued %(n)s item(s) for %(p)s participant(s).' %
+            {'n': len(items), 'p': len(last)})
+        return len(units)
+
+    def claim(self, owner):
+        # Leases the next unit that's free to be worked on, or returns None
+        # if there isn't one right now
+        with self._transaction() as connection:
+            while True:
+                now = time.time()
+                row = connection.execute(_CLAIMABLE, (now,)).fetchone()
+                if row is None:
+                    return None
+                kind, p, n, status, previous, attempts = row
+                key = (kind, p, n)
+                if status == 'leased':
+                    metrics.count('queue.reclaimed')
+                    self.logger.warning(
+                        'The lease that %(owner)s held on %(unit)s has '
+                        'expired. Reclaiming it.' %
+                        {'owner': previous, 'unit': _describe(key)})
+                    if attempts >= self.max_attempts:
+                        # A unit that keeps taking its worker down with it
+                        # is given up on rather than passed round for ever
+                        connection.execute(
+                            "UPDATE queue SET status = 'failed', owner = "
+                            'NULL, lease_expires = NULL, error = ?, '
+                            'updated = ? WHERE kind = ? AND participant = ? '
+                            'AND item = ?',
+                            ('Lease expired %(n)s times' % {'n': attempts},
+                             now) + key)
+                        continue
+                connection.execute(
+                    "UPDATE queue SET status = 'leased', owner = ?, "
+                    'lease_expires = ?, attempts = attempts + 1, updated = ? '
+                    'WHERE kind = ? AND participant = ? AND item = ?',
+                    (owner, now + self.lease_seconds, now) + key)
+                metrics.count('queue.claimed')
+                return key
+
+    def renew(self, owner):
+        # Extends all of owner's leases, and returns how many it still holds
+        now = time.time()
+        with self._transaction() as connection:
+            return connection.execute(
+                'UPDATE queue SET lease_expires = ?, updated = ? WHERE '
+                "owner = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, owner)).rowcount
+
+    def _finish(self, owner, key, status, error=None):
+        with self._transaction() as connection:
+            finished = connection.execute(
+                'UPDATE queue SET status = ?, owner = NULL, lease_expires = '
+                'NULL, error = ?, updated = ? WHERE kind = ? AND '
+                "participant = ? AND item = ? AND owner = ? AND status = "
+                "'leased'",
+                (status, error, time.time()) + key + (owner,)).rowcount
+        if not finished:
+            # The work is idempotent, so the worst this costs is the other
+            # worker doing it again
+            metrics.count('queue.lost')
+            self.logger.warning(
+                'Lost the lease on %(unit)s before it was finished; another '
+                'worker has claimed it.' % {'unit': _describe(key)})
+        return bool(finished)
+
+    def complete(self, owner, key):
+        return self._finish(owner, key, 'done')
+
+    def fail(self, owner, key, error):
+        # Puts the unit back in the queue, unless it has already had all of
+        # its attempts
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT attempts FROM queue WHERE kind = ? AND participant = '
+                '? AND item = ?', key).fetchone()
+        retry = row is not None and row[0] < self.max_attempts
+        return self._finish(
+            owner, key, 'pending' if retry else 'failed', error)
+
+    def counts(self):
+        # The number of units of each kind in each status
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT kind, status, COUNT(*) FROM queue GROUP BY kind, '
+                'status').fetchall()
+        counts = {}
+        for kind, status, n in rows:
+            counts.setdefault(kind, {})[status] = n
+        return counts
+
+    def unfinished(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM queue WHERE status IN '
+                "('pending', 'leased')").fetchone()[0]
+
+    def failures(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT kind, participant, item, error FROM queue WHERE '
+                "status = 'failed' ORDER BY position").fetchall()
+
+
+def _describe(key):
+    kind, p, n = key
+    if kind == 'item':
+        return 'item %(i)s for participant %(p)s' % {'i': n, 'p': p}
+    if kind == 'participant':
+        return 'participant %(p)s' % {'p': p}
+    return 'the study'
@@ -0,0 +1,192 @@
+import os
+import time
+import socket
+import logging
+import threading
+from .mp3 import _run_unit
+from .alignment_cache import AlignmentKeys
+from .alignment_store import AlignmentStore
+from .work_queue import _describe
+from .metrics import metrics
+from .utils import lazy_import
+
+pd = lazy_import('pandas')
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    # Works through the units in a WorkQueue alongside any number of other
+    # workers, on this machine or on others that share the data directory
+    # and the state store. Everything an item unit writes is either its own
+    # (its .mp3 file and alignment file), keyed by content (the caches), a
+    # row in the state store or merged under a file lock (the conversion
+    # manifest), so items of the same participant can be worked on anywhere
+    # at once. The files that cover a whole participant (the
+    # alignment store and keys, and the TextGrid files) are only written by
+    # the participant's unit, and the .csv file by the study's, which the
+    # queue doesn't hand out until everything before them is through.
+    def __init__(self, queue, converter, transcriber, aligner, threads=1,
+                 wait=False, poll_seconds=5, tg=True, phones=False, jobs=1,
+                 long_output=None, wide=True, name=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.queue = queue
+        self.converter = converter
+        self.transcriber = transcriber
+        self.aligner = aligner
+        self.state = aligner.state
+        self.files = aligner.files
+        self.threads = threads
+        self.wait = wait
+        self.poll_seconds = poll_seconds
+        self.tg = tg
+        self.phones = phones
+        self.jobs = jobs
+        self.long_output = long_output
+        self.wide = wide
+        self.owner = name if name is not None else \
+            f'{socket.gethostname()}:{os.getpid()}'
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.processed = 0
+
+    def run(self):
+        self.logger.info('Starting worker %(owner)s with %(n)s thread(s).' %
+                         {'owner': self.owner, 'n': self.threads})
+        heartbeat = threading.Thread(
+            target=self._heartbeat, name='heartbeat', daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self._work, name=f'worker-{n}',
+                                    daemon=True)
+                   for n in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.stopped.set()
+            heartbeat.join()
+            with self.lock:
+                self.converter._finish()
+            self.transcriber._finish()
+            self.files.save()
+            self.aligner.gentle.close()
+
+        for kind, p, n, error in self.queue.failures():
+            self.logger.error(
+                'Gave up on %(unit)s: %(e)s' %
+                {'unit': _describe((kind, p, n)), 'e': error})
+        self.logger.info(
+            'Worker %(owner)s finished %(n)s unit(s).' %
+            {'owner': self.owner, 'n': self.processed})
+
+    def _heartbeat(self):
+        # Leases are renewed three times per lease, so that one slow renewal
+        # doesn't let them lapse
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.renew(self.owner)
+            except Exception as e:
+                self.logger.error(
+                    'Failed to renew leases: %(e)s' % {'e': e})
+
+    def _work(self):
+        while True:
+            key = self.queue.claim(self.owner)
+            if key is None:
+                # Whatever is left is either waiting on units that other
+                # workers hold (whose leases might yet expire) or, with
+                # wait, on units that haven't been queued yet
+                if not self.wait and self.queue.unfinished() == 0:
+                    return
+                time.sleep(self.poll_seconds)
+                continue
+
+            kind, p, n = key
+            try:
+                with metrics.timer('worker.' + kind):
+                    self._process(kind, p, n)
+            except Exception as e:
+                self.logger.error(
+                    'Failed to process %(unit)s: %(e)s' %
+                    {'unit': _describe(key), 'e': e})
+                self.queue.fail(self.owner, key, repr(e))
+            else:
+                self.queue.complete(self.owner, key)
+            with self.lock:
+                self.processed += 1
+
+    def _process(self, kind, p, n):
+        # Other workers may have written files since the last unit
+        self.files.refresh()
+        if kind == 'item':
+            self._item(p, n)
+        elif kind == 'participant':
+            self._participant(p)
+        else:
+            self._study()
+
+    def _item(self, p, n):
+        row = self.state.row(p, n)
+        if row is None:
+            self.logger.warning(
+                'Item %(i)s for participant %(p)s isn\'t in the state store. '
+                'Skipping.' % {'i': n, 'p': p})
+            return
+
+        unit, status = self.converter._plan_one(p, n, row)
+        if status is None:
+            result = _run_unit(unit)
+            with self.lock:
+                self.converter._log_result(result)
+                # Saved straight away, so that a worker that dies doesn't
+                # take the record of what it converted with it
+                self.converter.manifest.save()
+            if result['status'] != 'converted':
+                raise RuntimeError(result['error'])
+        else:
+            self.converter._record_statuses(p, [dict(unit, status=status)])
+            if status == 'missing':
+                return
+
+        transcription = self.state.transcription(p, n)
+        if transcription is None:
+            content, channels = self.transcriber._prepare(p, n)
+            transcription = self.transcriber._recognize(
+                p, n, content, channels)
+            self.transcriber._store(p, n, transcription)
+
+        # Only the alignment itself is needed here: it goes into the
+        # alignment cache, which the participant's unit takes it from
+        gdir = os.path.join(self.aligner.gentle_dir, p)
+        os.makedirs(gdir, exist_ok=True)
+        mp3_file = os.path.join(
+            self.converter.mp3_dir, p, f'item_number_{n:02}.mp3')
+        transcript = str(transcription) + '\n'
+        _, job = self.aligner._plan_alignment(
+            AlignmentKeys(gdir), AlignmentStore(gdir), p, n, mp3_file,
+            transcript, os.path.join(gdir, str(n).zfill(2) + '.json'), False)
+        if job is not None:
+            self.aligner._submit_alignment(job[0], mp3_file, transcript)
+
+    def _participant(self, p):
+        self.aligner.align(False, self.tg, self.phones, [p])
+        with self.lock:
+            self.converter._finish()
+        self.logger.info(
+            'Finished aligning participant %(p)s.' % {'p': p})
+
+    def _study(self):
+        col = self.transcriber.transcription_col_name
+        with metrics.timer('csv.read'):
+            df = pd.read_csv(self.transcriber.transcribed_csv)
+        metrics.add_bytes('csv.read', read=os.path.getsize(
+            self.transcriber.transcribed_csv))
+        if col not in df.columns:
+            df[col] = pd.NA
+        self.transcriber._load_state(df)
+        self.transcriber._save(df)
+        self.aligner.get_timing_info(
+            self.jobs, True, self.long_output, self.wide)